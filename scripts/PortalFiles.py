@@ -7,31 +7,127 @@ from __future__ import unicode_literals
 
 import abc
 import argparse
+import array
+import collections
+import concurrent.futures
+import contextlib
 import csv
 import gzip
+import hashlib
+import heapq
+import io
 import itertools
+import json
+import math
+import mmap
 import os
 import random
+import re
+import shutil
+import sys
+import tempfile
 import time
+import zlib
+
+import numpy as np
 
 # Constants
 # The expected header
+c_BINARY_COORDINATES_EXT = ".bin"
+c_BINARY_COORDINATES_MAGIC = b"SCPCOORD"
+c_BINARY_COORDINATES_VERSION = 1
+c_BARCODE_BASES = "ACGT"
+c_BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+c_BGZF_MAX_BLOCK_SIZE = 1 << 16
+c_BARCODE_BYTES = ["".join(bases) for bases in itertools.product(c_BARCODE_BASES, repeat=4)]
+c_BARCODE_DIGITS = str.maketrans(c_BARCODE_BASES, "0123")
+c_BARCODE_PATTERN = re.compile(r"^([ACGT]{1,16})(?:-(0|[1-9][0-9]{0,6}))?$")
+c_BLOOM_BITS = 1 << 27
+c_BLOOM_HASHES = 7
+c_BUCKET_BITS = 16
 c_CELL_ID = "cell"
+c_CELL_NAMES_BLOOM = "bloom"
+c_CELL_NAMES_COMPACT = "compact"
+c_CELL_NAMES_EXACT = "exact"
+c_CELL_NAMES_MODES = [c_CELL_NAMES_EXACT, c_CELL_NAMES_COMPACT, c_CELL_NAMES_BLOOM]
+c_CHECK_BLOCK_SIZE = 10000
+c_CONVENTION_ARRAY_DELIM = "|"
+c_CONVENTION_BOOLEANS = ["true", "false"]
+c_CONVENTION_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".scp_conventions")
+c_CONVENTION_CACHE_PREFIX = "alexandria_convention_"
+c_CONVENTION_CELL_ID = "CellID"
+c_CONVENTION_EXAMPLES = 3
+c_CONVENTION_NUMERIC_TYPES = ["number", "integer"]
 c_COORDINATES_HEADER = ["NAME", "X", "Y"]
 c_COORDINATES_OPTIONAL_Z = "Z"
 c_COORDINATES_HEADER_LENGTH = len(c_COORDINATES_HEADER)
+c_COUNT_DTYPES = ["uint16", "uint32"]
+c_DEDUPLICATED_POSTFIX = "_deduplicated"
 c_DEFAULT_DELIM = "\t"
 c_DEID_POSTFIX = "_deidentifed"
+c_DENSE_EXT = ".txt"
+c_DOWNSAMPLE_CELLS_POSTFIX = "_downsampled_cells"
+c_DOWNSAMPLE_METHODS = ["grid", "random"]
+c_DOWNSAMPLE_POOL_FACTOR = 2
+c_DOWNSAMPLE_POSTFIX = "_downsampled"
+c_DOWNSAMPLE_RESERVOIR = 2
+c_EXACT_CARDINALITY_LIMIT = 1000
 c_EXPRESSION_00_ELEMENT = "GENE"
+c_EXPRESSION_ZERO = "0"
+c_FALLBACK_CODE_FLAG = 1 << 63
+c_FORMAT_DENSE_GZIP = "dense_gzip"
+c_FORMAT_DENSE_TSV = "dense_tsv"
+c_FORMAT_MTX_GZIP = "mtx_gzip"
+c_FORMATS = [c_FORMAT_DENSE_TSV, c_FORMAT_DENSE_GZIP, c_FORMAT_MTX_GZIP]
 c_GENE_LIST_00_ELEMENT = "GENE NAMES"
+c_GENE_NAMES_TAG = "genes"
+c_GZIP_BLOCK_SIZE = 1 << 20
+c_GZIP_EXT = ".txt.gz"
+c_GZIP_MAGIC = b"\x1f\x8b"
+c_GZIP_LEVEL = 9
+c_HASH_BLOCK_SIZE = 1 << 20
+c_HLL_PRECISION = 12
 c_MAP_DELIM = "\t->\t"
 c_MAP_POSTFIX = "_mapping"
+c_MATRIX_CACHE_EXT = ".npz"
+c_MATRIX_TAG = "matrix"
+c_MERGE_POSTFIX = "_merged"
+c_MTX_BARCODES_POSTFIX = "_barcodes.tsv.gz"
+c_MTX_GENES_POSTFIX = "_genes.tsv.gz"
+c_MTX_HEADER = "%%MatrixMarket matrix coordinate real general"
+c_MTX_MATRIX_POSTFIX = "_matrix.mtx.gz"
 c_METADATA_00_ELEMENT = "NAME"
+c_NA_VALUES = ["NA","nA","Na","na"]
+c_PEEK_MAX_SIZE = 1 << 24
+c_PEEK_SIZE = 8192
+c_PROFILE_TAG = "profile"
+c_QUICK_BGZF = "bgzf_block_seek"
+c_QUICK_BYTES = "byte_seek"
+c_QUICK_FIRST_ROWS = "first_rows"
+c_QUICK_SAMPLE_SIZE = 1000
 c_REPORT_LINE_NUMBER_BLOCK = 500
+c_SIDECAR_EXT = ".json"
+c_SPARSITY_SAMPLE_SIZE = 1 << 20
+c_SUMMARY_TAG = "summary"
+c_SPATIAL_INDEX_EXT = ".npz"
+c_SPATIAL_INDEX_POINTS_PER_CELL = 64
+c_SPATIAL_INDEX_TAG = "spatial"
+c_STREAM_FILE_NAME = "-"
+c_STAGE_BODY = "body_check"
+c_STAGE_DUPLICATES = "duplicate_check"
+c_STAGE_HEADER = "header_check"
 c_SUBSET_POSTFIX = "_subset"
 c_TYPE_HEADER_ID = "TYPE"
 c_TYPE_NUMERIC = "numeric"
 c_TYPE_GROUP = "group"
+c_UINT64_MASK = (1 << 64) - 1
+c_VALIDATION_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".scp_validation")
+# Change when checks change so cached validations are not reused
+c_VALIDATOR_VERSION = "2"
+c_VALIDATION_RESULTS = ["summary", "profile", "value_profile", "duplicate_genes", "duplicate_rows"]
+c_VALUES_TAG = "values"
+# Normal quantile of 95% confidence bounds
+c_WILSON_Z = 1.96
 c_VALID_TYPES = [c_TYPE_NUMERIC, c_TYPE_GROUP]
 
 # Demo links
@@ -52,28 +148,160 @@ expression_cell_names = []
 
 class ParentPortalFile:
 
+    # Compression of gzipped files written, set on the class for all files
+    compress_level = c_GZIP_LEVEL
+    compress_threads = None
+
     def __init__(self, file_name,
                  file_delimiter,
                  has_type=True,
                  expected_header=None,
-                 demo_file_link=None):
+                 demo_file_link=None,
+                 cell_names_mode=c_CELL_NAMES_EXACT,
+                 lazy=False):
         """
         Create object. This is an objec that must be inherited
         due to abstract methods that are not implemented.
+        Cell names are kept as a list of strings or, with the compact
+        cell names mode, as CompactCellNames.
+        Lazy objects do not open the file until the header
+        or cell names are first needed.
         Tested
         """
         self.file_has_error = False
+        self.cell_names_mode = cell_names_mode
         self.delimiter = file_delimiter
         self.demo_file = demo_file_link
         self.expected_header = expected_header
         self.expected_header_length = len(expected_header) if expected_header else 0
-        self.file_name = os.path.abspath(file_name)
-        init_handle = self.csv_handle
-        self.header = next(init_handle)
-        self.type_header = next(init_handle) if has_type else None
-        self.header_length = len(self.header)
+        # Files read from a stream are named -
+        self.file_name = file_name if file_name == c_STREAM_FILE_NAME else os.path.abspath(file_name)
+        self.has_type = has_type
+        self.lazy = lazy
+        self._header = None
+        self._type_header = None
+        self._header_length = None
+        self._cell_names = None
+        if not lazy:
+            self.read_header()
         self.line_number = 1
-        self.cell_names = None
+        self.stage_timings = []
+
+    def read_header(self):
+        """
+        Read the header and, if the file has one, the type row.
+        """
+        with self.open_file() as header_handle:
+            init_handle = csv.reader(header_handle, delimiter=self.delimiter)
+            self.set_header(next(init_handle),
+                            next(init_handle) if self.has_type else None)
+
+    def set_header(self, header, type_header=None):
+        """
+        Keep the header rows of the file.
+        """
+        self._header = header
+        self._type_header = type_header
+        self._header_length = len(header)
+
+    @property
+    def header(self):
+        """
+        First row of the file, read when first needed.
+        """
+        if self._header is None:
+            self.read_header()
+        return(self._header)
+
+    @header.setter
+    def header(self, header):
+        self._header = header
+
+    @property
+    def type_header(self):
+        """
+        Type row of the file, if it has one.
+        """
+        if self._header is None:
+            self.read_header()
+        return(self._type_header)
+
+    @type_header.setter
+    def type_header(self, type_header):
+        self._type_header = type_header
+
+    @property
+    def header_length(self):
+        """
+        Number of columns of the header.
+        """
+        if self._header is None:
+            self.read_header()
+        return(self._header_length)
+
+    @header_length.setter
+    def header_length(self, header_length):
+        self._header_length = header_length
+
+    @property
+    def cell_names(self):
+        """
+        Cell names of the file, for lazy objects read when first needed.
+        """
+        if self._cell_names is None and self.lazy:
+            self.update_cell_names()
+        return(self._cell_names)
+
+    @cell_names.setter
+    def cell_names(self, cell_names):
+        self._cell_names = cell_names
+
+    def peek(self, peek_size=c_PEEK_SIZE, max_peek_size=c_PEEK_MAX_SIZE):
+        """
+        Cheap look at the start of the file, reading the peek size in
+        (uncompressed) bytes, or more until the header rows are complete
+        up to the max peek size. Returns the file size, if it is gzipped,
+        and the complete rows read: the header, the type row if the file
+        has one, and the first rows of the body, with whether the max peek
+        size cut the header rows. Header rows read are kept so they are not
+        read again.
+        """
+        header_rows = 2 if self.has_type else 1
+        blocks = []
+        read_size = peek_size
+        peeked_size = 0
+        line_count = 0
+        with self.open_file("rb") as peek_handle:
+            while True:
+                block = peek_handle.read(read_size)
+                blocks.append(block)
+                peeked_size += len(block)
+                line_count += block.count(b"\n")
+                # The whole file was read
+                if len(block) < read_size:
+                    break
+                if line_count >= header_rows or peeked_size >= max_peek_size:
+                    break
+                read_size = min(peeked_size, max_peek_size - peeked_size)
+        start = b"".join(blocks)
+        lines = start.split(b"\n")
+        # The last line is partial unless the whole file was read
+        is_complete = len(block) < read_size
+        lines = lines[:-1] if not is_complete or not lines[-1] else lines
+        rows = list(csv.reader([line.decode("utf-8", "replace").rstrip("\r") for line in lines],
+                               delimiter=self.delimiter))
+        if self._header is None and len(rows) >= header_rows:
+            self.set_header(rows[0], rows[1] if self.has_type else None)
+        return({"file_name": self.file_name,
+                "size": os.path.getsize(self.file_name),
+                "gzipped": self.is_gzipped(),
+                "header": rows[0] if rows else None,
+                "header_length": len(rows[0]) if rows else None,
+                "type_header": rows[1] if self.has_type and len(rows) > 1 else None,
+                "rows": rows[header_rows:],
+                "peeked_size": peeked_size,
+                "header_cut": len(rows) < header_rows and not is_complete,
+                "complete": is_complete})
 
     @property
     def csv_handle(self):
@@ -82,13 +310,21 @@ class ParentPortalFile:
         fresh handle at the beginning of the file.
         Tested
         """
+        return(csv.reader(self.open_file(), delimiter=self.delimiter))
 
-        file_handle = None
-        if ".gz" == os.path.splitext(self.file_name)[-1]:
-            file_handle = gzip.open(self.file_name, 'rt')
-        else:
-            file_handle = open(self.file_name, 'r')
-        return(csv.reader(file_handle, delimiter=self.delimiter))
+    def open_file(self, mode="rt"):
+        """
+        Open a fresh gzip or standard handle to the file for reading.
+        """
+        if self.is_gzipped():
+            return(gzip.open(self.file_name, mode))
+        return(open(self.file_name, mode.replace("t", "")))
+
+    def is_gzipped(self):
+        """
+        Whether the file is gzipped, going by its extension.
+        """
+        return(os.path.splitext(self.file_name)[-1] == ".gz")
 
     @abc.abstractmethod
     def check_header(self):
@@ -100,23 +336,39 @@ class ParentPortalFile:
         return()
 
     @abc.abstractmethod
-    def check_body(self):
+    def check_body(self, rows=None):
         """
         Check body of the file. If an error occurs set the object
         indicate an error occured. (file_has_error attribute).
+        Rows, if given, are checked in place of the rows of the file.
         Must be over written per file given files have different formats.
         """
         return()
 
-    def check(self):
+    def check(self, rows=None):
         """
         Checks the header and body of the file.
+        Rows, if given, are checked in place of the body of the file.
         Tested
         """
         print("Checking " + self.file_name)
-        self.check_header()
-        self.check_body()
-        self.check_duplicate_cell_names()
+        with timed_stage(self.stage_timings, c_STAGE_HEADER) as stage_timing:
+            self.check_header()
+            header_rows = [header_row for header_row in [self.header, self.type_header]
+                           if header_row is not None]
+            stage_timing["rows"] = len(header_rows)
+            stage_timing["bytes_read"] = sum(len(self.delimiter.join(header_row)) + 1
+                                             for header_row in header_rows)
+        with timed_stage(self.stage_timings, c_STAGE_BODY) as stage_timing:
+            if rows is None:
+                self.check_body()
+                stage_timing["bytes_read"] = os.path.getsize(self.file_name)
+            else:
+                self.check_body(rows)
+            stage_timing["rows"] = self.line_number - 1
+        with timed_stage(self.stage_timings, c_STAGE_DUPLICATES) as stage_timing:
+            self.check_duplicate_cell_names()
+            stage_timing["rows"] = len(self.cell_names)
         if self.file_has_error and self.demo_file:
             print(" ".join(["Error!\tThe provided file \"",
                             self.file_name,
@@ -144,11 +396,14 @@ class ParentPortalFile:
         Check for duplicate cell names.
         Tested
         """
-        cell_count = len(self.cell_names)
-        if cell_count != len(set(self.cell_names)):
+        if isinstance(self.cell_names, (CompactCellNames, CellNameSketch)):
+            duplicates = self.cell_names.duplicates()
+        else:
+            duplicates = self.get_duplicates(self.cell_names)
+        if duplicates:
             print(" ".join(["Error!\t",
                             self.file_name,
-                            "file has duplicate cell names:"] + list(self.get_duplicates(self.cell_names))))
+                            "file has duplicate cell names:"] + list(duplicates)))
             self.file_has_error = True
         return(self.file_has_error)
 
@@ -186,6 +441,90 @@ class ParentPortalFile:
                             ",".join(c_VALID_TYPES), "."]))
         return(self.file_has_error)
 
+    def check_typed_body(self, check_handle, missing_values=None, column_profiles=None):
+        """
+        Check the body rows of a file with a type row, a block of rows
+        at a time. Rows are transposed into columns so whole numeric
+        columns are converted at once; group columns are strings so they
+        are only checked for empty values when missing values are allowed.
+        Columns are added to the column profiles if given.
+        """
+        numeric_columns = set(token for token, type_value in enumerate(self.type_header)
+                              if type_value == c_TYPE_NUMERIC)
+        while True:
+            block = list(itertools.islice(check_handle, c_CHECK_BLOCK_SIZE))
+            if not block:
+                break
+            block_rows = []
+            block_line_numbers = []
+            for file_line in block:
+                self.line_number += 1
+                if len(file_line) != self.header_length:
+                    self.file_has_error = True
+                    print(" ".join(["Error!\tLine:",
+                                    str(self.line_number),
+                                    "Expected", str(self.header_length),
+                                    "columns but received",
+                                    str(len(file_line)), "."]))
+                else:
+                    block_rows.append(file_line)
+                    block_line_numbers.append(self.line_number)
+            for token, column in enumerate(zip(*block_rows)):
+                column_profile = column_profiles[token] if column_profiles else None
+                if token in numeric_columns:
+                    self.check_numeric_column(column, token, block_line_numbers,
+                                              missing_values, column_profile)
+                else:
+                    if missing_values is not None and "" in column:
+                        self.report_empty_values(column, token, block_line_numbers)
+                    if column_profile:
+                        column_profile.add_labels(column, missing_values or ())
+
+    def check_numeric_column(self, column, token, line_numbers,
+                             missing_values=None, column_profile=None):
+        """
+        Convert a block of a numeric column, falling back to
+        converting value by value to report the values in error.
+        """
+        try:
+            values = np.array(column, dtype=np.float64)
+            missing_count = 0
+        except ValueError:
+            converted = []
+            missing_count = 0
+            for line_number, value in zip(line_numbers, column):
+                if missing_values is not None and not value:
+                    self.file_has_error = True
+                    print(" ".join(["Expected a value for entry: line",
+                                    str(line_number+1), ", element",
+                                    str(token+1)]))
+                elif missing_values is not None and value in missing_values:
+                    missing_count += 1
+                else:
+                    try:
+                        converted.append(float(value))
+                    except ValueError:
+                        self.file_has_error = True
+                        print(" ".join(["Error!\tUnexpected type. Line:",
+                                        str(line_number),
+                                        "Value:", value,
+                                        "Expected Type:", self.type_header[token]]))
+            values = np.array(converted, dtype=np.float64)
+        if column_profile:
+            column_profile.add_numbers(values)
+            column_profile.add_missing(missing_count)
+
+    def report_empty_values(self, column, token, line_numbers):
+        """
+        Report the empty values of a block of a column.
+        """
+        self.file_has_error = True
+        for line_number, value in zip(line_numbers, column):
+            if not value:
+                print(" ".join(["Expected a value for entry: line",
+                                str(line_number+1), ", element",
+                                str(token+1)]))
+
     def compare_cell_names(self, portal_file):
         """
         Check cell names of this portal file wih another.
@@ -204,13 +543,26 @@ class ParentPortalFile:
                             str(len(portal_file.cell_names)),
                             "unique cells."]))
         # Check composition of lists
-        difference = set(self.cell_names) - set(portal_file.cell_names)
+        names_modes = [self.cell_names_mode, portal_file.cell_names_mode]
+        if c_CELL_NAMES_BLOOM in names_modes:
+            these_names = CellNameSketch.from_names(self.cell_names)
+            other_names = CellNameSketch.from_names(portal_file.cell_names)
+            difference, other_difference = these_names.differences(other_names)
+        else:
+            if c_CELL_NAMES_COMPACT in names_modes:
+                these_names = CompactCellNames.from_names(self.cell_names)
+                other_names = CompactCellNames.from_names(portal_file.cell_names)
+            else:
+                these_names = set(self.cell_names)
+                other_names = set(portal_file.cell_names)
+            difference = these_names - other_names
+            other_difference = other_names - these_names
         if len(difference) > 0:
             compare_error = True
             print(" ".join(["Gene names unique to",
                             self.file_name,
                             ":"]+list(difference)))
-        difference = set(portal_file.cell_names) - set(self.cell_names)
+        difference = other_difference
         if len(difference) > 0:
             compare_error = True
             print(" ".join(["Gene names unique to",
@@ -228,11 +580,9 @@ class ParentPortalFile:
         if not file_name:
             return(None)
 
-        file_pieces = file_name.split(".")
-        file_base = file_pieces[0]
-        file_ext = ".".join(file_pieces[1:])
+        file_base, file_ext = split_file_name(file_name)
         current_time = time.strftime("%Y_%m_%d_%H_%M_%S",time.gmtime())
-        new_file_name = file_base + "_" + current_time + "." + file_ext
+        new_file_name = file_base + "_" + current_time + file_ext
 
         if os.path.exists(new_file_name):
             print(" ".join(["ERROR!\tCan not find a safe file name, ",
@@ -242,15 +592,196 @@ class ParentPortalFile:
             return(None)
         return(new_file_name)
 
-    def get_write_handle(self,new_file_name):
+    def iter_row_offsets(self, skip_rows=0):
+        """
+        Iterate over the rows of the file with the byte offset where
+        each row starts, after skipping the given number of header rows.
+        """
+        with self.open_file("rb") as offset_handle:
+            for skip_row in range(skip_rows):
+                offset_handle.readline()
+            row_offset = offset_handle.tell()
+            for file_line in iter(offset_handle.readline, b""):
+                yield (row_offset, next(csv.reader([file_line.decode("utf-8")],
+                                                   delimiter=self.delimiter)))
+                row_offset = offset_handle.tell()
+
+    def read_rows_at(self, row_offsets):
+        """
+        Read the rows starting at the given byte offsets.
+        """
+        rows = []
+        with self.open_file("rb") as read_handle:
+            for row_offset in row_offsets:
+                read_handle.seek(row_offset)
+                rows.append(next(csv.reader([read_handle.readline().decode("utf-8")],
+                                            delimiter=self.delimiter)))
+        return(rows)
+
+    def is_bgzf(self):
+        """
+        Whether the file is gzipped in BGZF blocks, which can be seeked.
+        """
+        if not self.is_gzipped():
+            return(False)
+        with open(self.file_name, "rb") as bgzf_handle:
+            block_header = bgzf_handle.read(18)
+        return(is_bgzf_block_header(block_header))
+
+    def sample_rows(self, sample_size=c_QUICK_SAMPLE_SIZE, seed=None):
+        """
+        Random sample of body rows read through seeks, so the file is not
+        read through. Uncompressed files are seeked to random bytes, taking
+        the row after each; BGZF files to random blocks, taking a random
+        whole row of each. Other gzipped files can not be seeked so their
+        first rows are taken. Returns the sampling method and a list of
+        where each row was found and the row.
+        """
+        random_source = random.Random(seed)
+        header_rows = 2 if self.has_type else 1
+        file_size = os.path.getsize(self.file_name)
+        sampled = {}
+        if not self.is_gzipped():
+            with open(self.file_name, "rb") as sample_handle:
+                for header_row in range(header_rows):
+                    sample_handle.readline()
+                body_start = sample_handle.tell()
+                if body_start >= file_size:
+                    return(c_QUICK_BYTES, [])
+                for sample_offset in sorted(random_source.randrange(body_start, file_size)
+                                            for sample in range(sample_size)):
+                    # Finish the line the offset is in, the row after it is sampled
+                    sample_handle.seek(sample_offset - 1)
+                    sample_handle.readline()
+                    row_offset = sample_handle.tell()
+                    file_line = sample_handle.readline()
+                    if file_line and row_offset not in sampled:
+                        sampled[row_offset] = file_line
+            return(c_QUICK_BYTES, [("byte " + str(row_offset),
+                                    next(csv.reader([file_line.decode("utf-8").rstrip("\r\n")],
+                                                    delimiter=self.delimiter)))
+                                   for row_offset, file_line in sorted(sampled.items())])
+        if not self.is_bgzf():
+            sample_handle = self.csv_handle
+            for header_row in range(header_rows):
+                next(sample_handle)
+            return(c_QUICK_FIRST_ROWS, [("line " + str(line_number), file_line)
+                                        for line_number, file_line
+                                        in enumerate(itertools.islice(sample_handle, sample_size),
+                                                     header_rows + 1)])
+        with open(self.file_name, "rb") as sample_handle:
+            for sample_offset in sorted(random_source.randrange(0, file_size)
+                                        for sample in range(sample_size)):
+                block_offset, block_data = read_bgzf_block(sample_handle, sample_offset)
+                if block_data is None:
+                    continue
+                block_lines = block_data.split(b"\n")
+                # The last line goes on in the next block, the first
+                # is the header or goes on from the block before
+                block_lines = block_lines[header_rows if block_offset == 0 else 1:-1]
+                if not block_lines:
+                    continue
+                line_index = random_source.randrange(len(block_lines))
+                sampled.setdefault((block_offset, line_index), block_lines[line_index])
+        return(c_QUICK_BGZF, [("block " + str(block_offset) + " row " + str(line_index),
+                               next(csv.reader([file_line.decode("utf-8").rstrip("\r")],
+                                               delimiter=self.delimiter)))
+                              for (block_offset, line_index), file_line in sorted(sampled.items())])
+
+    def quick_check(self, sample_size=c_QUICK_SAMPLE_SIZE, seed=None):
+        """
+        Check the header fully and a random sample of body rows, to triage
+        files too large to check quickly. Each sampled row is checked on
+        its own so the rows with errors are counted. Returns the sampling
+        method, the rows sampled and with errors, and the estimated error
+        rate of rows with its Wilson score confidence bounds.
+        """
+        print("Quick checking " + self.file_name)
+        self.check_header()
+        sampling_method, sample = self.sample_rows(sample_size, seed)
+        row_checker = self.new_portal_file(self.file_name)
+        row_checker.set_header(self.header, self.type_header)
+        error_rows = 0
+        for row_location, file_line in sample:
+            row_checker.file_has_error = False
+            row_checker.line_number = 1
+            row_output = io.StringIO()
+            with contextlib.redirect_stdout(row_output):
+                row_checker.check_body([file_line])
+            if row_checker.file_has_error:
+                error_rows += 1
+                self.file_has_error = True
+                print("Sampled row at " + row_location + ":")
+                print("\n".join([line for line in row_output.getvalue().splitlines()
+                                 if line.startswith("Error!")]))
+        return({"method": sampling_method,
+                "sampled_rows": len(sample),
+                "error_rows": error_rows,
+                "error_rate": error_rows / len(sample) if sample else None,
+                "error_rate_bounds": wilson_interval(error_rows, len(sample))})
+
+    def get_write_handle(self, new_file_name, mode="w", gzipped=None):
         """
         Get a gzip or standard handle to a file with write functionality.
+        The new file is gzipped like this file unless told otherwise.
         """
-
-        if os.path.splitext(self.file_name)[-1] == ".gz":
-            return(gzip.open(new_file_name,"wt"))
+        if gzipped is None:
+            gzipped = os.path.splitext(self.file_name)[-1] == ".gz"
+        if gzipped:
+            return(self.get_gzip_write_handle(new_file_name))
         else:
-            return(open(new_file_name, 'wb'))
+            return(open(new_file_name, mode))
+
+    def get_gzip_write_handle(self, new_file_name):
+        """
+        Get a handle writing a gzip file compressed on a pool of threads.
+        """
+        return(ParallelGzipWriter(new_file_name,
+                                  compress_level=self.compress_level,
+                                  threads=self.compress_threads))
+
+    def file_signature(self):
+        """
+        Size and modification time of the file, used to tell
+        if a sidecar was written for the current file contents.
+        """
+        file_stat = os.stat(self.file_name)
+        return({"size": file_stat.st_size, "mtime": file_stat.st_mtime})
+
+    def sidecar_file_name(self, tag, extension=c_SIDECAR_EXT):
+        """
+        Name of the sidecar file holding the given tag's data for this file.
+        """
+        return(self.file_name + "." + tag + extension)
+
+    def read_sidecar(self, tag):
+        """
+        Read the data of a sidecar file. Returns None if the sidecar
+        does not exist or was written for different file contents.
+        """
+        sidecar_file = self.sidecar_file_name(tag)
+        if not os.path.exists(sidecar_file):
+            return(None)
+        try:
+            with open(sidecar_file, "r") as sidecar_handle:
+                sidecar = json.load(sidecar_handle)
+        except ValueError:
+            print("Note: Ignoring unreadable sidecar file " + sidecar_file)
+            return(None)
+        if sidecar.get("source") != self.file_signature():
+            return(None)
+        return(sidecar.get(tag))
+
+    def write_sidecar(self, tag, contents):
+        """
+        Write data for the file to a sidecar file next to it.
+        Returns the sidecar file name.
+        """
+        sidecar_file = self.sidecar_file_name(tag)
+        with open(sidecar_file, "w") as sidecar_handle:
+            json.dump({"source": self.file_signature(), tag: contents},
+                      sidecar_handle)
+        return(sidecar_file)
 
     def tag_file_name(self,tag):
         """
@@ -260,10 +791,8 @@ class ParentPortalFile:
         if not tag:
             return(None)
 
-        file_pieces = self.file_name.split(".")
-        file_base = file_pieces[0]
-        file_ext = ".".join(file_pieces[1:])
-        new_file = file_base + tag + "." + file_ext
+        file_base, file_ext = split_file_name(self.file_name)
+        new_file = file_base + tag + file_ext
         return(self.create_safe_file_name(new_file))
 
     @abc.abstractmethod
@@ -274,13 +803,142 @@ class ParentPortalFile:
         """
         return()
 
+    def new_portal_file(self, file_name):
+        """
+        Lazy portal file of the same type and options for a new file.
+        """
+        return(type(self)(file_name,
+                          file_delimiter=self.delimiter,
+                          expected_header=self.expected_header,
+                          demo_file_link=self.demo_file,
+                          cell_names_mode=self.cell_names_mode,
+                          lazy=True))
+
+    def transform_rows(self, keep_cells=None, cell_names_change=None, transform_handle=None):
+        """
+        Stream the rows of a file with a cell per row, keeping only the
+        kept cells and renaming them through the cell names change.
+        Rows are read from the transform handle if given.
+        Returns the header rows, the rows and the list of cell names,
+        which is filled as the rows are read.
+        """
+        if transform_handle is None:
+            transform_handle = self.csv_handle
+        # Need to keep the 2 header rows
+        header_rows = [next(transform_handle), next(transform_handle)]
+        cell_names = []
+
+        def rows():
+            for file_line in transform_handle:
+                if keep_cells is not None and file_line[0] not in keep_cells:
+                    continue
+                if cell_names_change is not None:
+                    file_line[0] = deidentified_cell_name(file_line[0], cell_names_change)
+                cell_names.append(file_line[0])
+                yield file_line
+        return(header_rows, rows(), cell_names)
+
+    def check_stream(self, stream):
+        """
+        Check the file read once from a binary stream, such as stdin or
+        a pipe from a download, instead of from the file name. Gzipped
+        streams are decompressed as they are read. The header, body and
+        cell names are taken in the one pass.
+        """
+        header_rows, stream_rows, cell_names = self.transform_rows(
+            transform_handle=csv.reader(open_stream(stream), delimiter=self.delimiter))
+        self.set_header(*header_rows)
+
+        def checked_rows():
+            for file_line in stream_rows:
+                yield file_line
+            # The body is checked before duplicate cell names
+            self.set_cell_names(lambda: iter(cell_names))
+
+        return(self.check(rows=checked_rows()))
+
+    def is_stream(self):
+        """
+        Whether the file is read from a stream instead of from its name.
+        """
+        return(self.file_name == c_STREAM_FILE_NAME)
+
+    def transform_cells(self, keep_cells=None, cell_names_change=None):
+        """
+        Subsample and / or deidentify cells in one pass, writing one new
+        file that is checked as it is written. Cells are subsampled to
+        the keep cells if given and renamed if a cell names change is
+        given; cells not yet in the change are given new names and added
+        to it so files transformed in turn share one mapping.
+        Returns the checked portal file of the new file or None.
+        """
+        tag = "".join([c_SUBSET_POSTFIX if keep_cells is not None else "",
+                       c_DEID_POSTFIX if cell_names_change is not None else ""])
+        transformed_file_name = self.tag_file_name(tag)
+        if transformed_file_name is None:
+            return(None)
+        if keep_cells is not None:
+            keep_cells = set(keep_cells)
+        header_rows, transformed_rows, cell_names = self.transform_rows(keep_cells,
+                                                                        cell_names_change)
+        transformed_file = self.new_portal_file(transformed_file_name)
+        transformed_file.set_header(*header_rows)
+
+        def write_rows():
+            with self.get_write_handle(transformed_file_name) as transformed_handle:
+                file_writer = csv.writer(transformed_handle,
+                                         delimiter=self.delimiter,
+                                         lineterminator="\n")
+                file_writer.writerows(header_rows)
+                for file_line in transformed_rows:
+                    file_writer.writerow(file_line)
+                    yield file_line
+            # The body is checked before duplicate cell names
+            transformed_file.set_cell_names(lambda: iter(cell_names))
+
+        transformed_file.check(rows=write_rows())
+        return(transformed_file)
+
+    def write_cell_names_mapping(self, cell_names_change):
+        """
+        Write the mapping of original to deidentified cell names
+        next to the file. Returns the mapping file name or None.
+        """
+        mapping_file_name = self.tag_file_name(c_MAP_POSTFIX)
+        if mapping_file_name is None:
+            return(None)
+        with self.get_write_handle(mapping_file_name) as map_file:
+            map_file.write("\n".join(sorted([name_key+c_MAP_DELIM+name_value
+                                             for name_key, name_value
+                                             in cell_names_change.items()])))
+        return(mapping_file_name)
+
     def update_cell_names(self):
         """
         Update cell names from file.
         Tested
         """
-        if not self.cell_names:
-            self.cell_names = [line[0] for line in self.csv_handle][2:]
+        if not self._cell_names:
+            self.set_cell_names(self.iter_cell_names)
+
+    def iter_cell_names(self):
+        """
+        Stream the cell names of the file.
+        """
+        # Need to skip the 2 header rows
+        return(line[0] for line in itertools.islice(self.csv_handle, 2, None))
+
+    def set_cell_names(self, cell_names_source):
+        """
+        Keep cell names in the form of the cell names mode,
+        given a function returning a fresh iterator of the names.
+        """
+        if self.cell_names_mode == c_CELL_NAMES_COMPACT:
+            self.cell_names = CompactCellNames(cell_names_source())
+        elif self.cell_names_mode == c_CELL_NAMES_BLOOM:
+            self.cell_names = CellNameSketch(cell_names_source)
+        else:
+            self.cell_names = list(cell_names_source())
 
     @abc.abstractmethod
     def deidentify_cell_names(self):
@@ -304,11 +962,844 @@ class ParentPortalFile:
         contents.append("CellNames:"+str(self.cell_names))
         return("; ".join(contents))
 
+class HyperLogLog:
+
+    def __init__(self, precision=c_HLL_PRECISION):
+        """
+        Sketch estimating the number of distinct values
+        added to it in a fixed amount of memory.
+        """
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, value):
+        """
+        Add a label to the sketch.
+        """
+        self.add_hashes(np.array([int.from_bytes(hashlib.blake2b(value.encode("utf-8"),
+                                                                 digest_size=8).digest(),
+                                                 "little")], dtype=np.uint64))
+
+    def add_numbers(self, values):
+        """
+        Add an array of numbers to the sketch.
+        """
+        # Adding zero turns -0.0 into 0.0 so both hash the same
+        keys = (np.asarray(values, dtype=np.float64) + 0.0).view(np.uint64)
+        # SplitMix64 finalizer to spread the bits of the floats
+        keys = keys + np.uint64(0x9E3779B97F4A7C15)
+        keys = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        self.add_hashes(keys ^ (keys >> np.uint64(31)))
+
+    def add_hashes(self, hashes):
+        """
+        Add an array of 64 bit hashes to the sketch.
+        """
+        remaining_bits = 64 - self.precision
+        register_index = (hashes >> np.uint64(remaining_bits)).astype(np.intp)
+        remainder = hashes & np.uint64((1 << remaining_bits) - 1)
+        # The exponent of frexp is the bit length of the remainder
+        rank = remaining_bits - np.frexp(remainder.astype(np.float64))[1] + 1
+        np.maximum.at(self.registers, register_index, rank.astype(np.uint8))
+
+    def cardinality(self):
+        """
+        Estimate of the number of distinct values added.
+        """
+        register_count = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / register_count)
+        estimate = alpha * register_count ** 2 / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        empty_registers = int(np.count_nonzero(self.registers == 0))
+        # Small range correction
+        if estimate <= 2.5 * register_count and empty_registers:
+            estimate = register_count * math.log(register_count / empty_registers)
+        return(int(round(estimate)))
+
+class ColumnProfile:
+
+    def __init__(self, name, column_type, cardinality_limit=c_EXACT_CARDINALITY_LIMIT):
+        """
+        Running profile of the values of a column.
+        Distinct values are counted exactly until the cardinality limit
+        is reached, after which a HyperLogLog sketch is used and
+        label frequencies of group columns are no longer kept.
+        """
+        self.name = name
+        self.column_type = column_type
+        self.cardinality_limit = cardinality_limit
+        self.count = 0
+        self.missing = 0
+        self.nan = 0
+        self.minimum = None
+        self.maximum = None
+        self.distinct = set()
+        self.labels = collections.Counter() if column_type == c_TYPE_GROUP else None
+        self.missing_labels = set()
+        self.sketch = None
+
+    def add_labels(self, labels, missing_values=()):
+        """
+        Add a block of labels of the column. Labels that are
+        empty or one of the missing values are counted as missing,
+        keeping which of them were found.
+        """
+        block_labels = collections.Counter(labels)
+        for missing_value in itertools.chain([""], missing_values):
+            missing_count = block_labels.pop(missing_value, 0)
+            if missing_count:
+                self.missing += missing_count
+                self.missing_labels.add(missing_value)
+        self.count += sum(block_labels.values())
+        if self.labels is not None:
+            self.labels.update(block_labels)
+        if self.sketch:
+            for label in block_labels:
+                self.sketch.add(label)
+        else:
+            self.add_distinct(block_labels.keys())
+
+    def add_numbers(self, values):
+        """
+        Add an array of converted numbers of the column.
+        """
+        self.count += len(values)
+        nan_values = np.isnan(values)
+        self.nan += int(np.count_nonzero(nan_values))
+        values = values[~nan_values]
+        if not len(values):
+            return
+        block_minimum = float(values.min())
+        block_maximum = float(values.max())
+        if self.minimum is None or block_minimum < self.minimum:
+            self.minimum = block_minimum
+        if self.maximum is None or block_maximum > self.maximum:
+            self.maximum = block_maximum
+        if self.sketch:
+            self.sketch.add_numbers(values)
+        else:
+            self.add_distinct(np.unique(values).tolist())
+
+    def add_distinct(self, values):
+        """
+        Count distinct values exactly, moving to a sketch
+        once there are more than the cardinality limit.
+        """
+        self.distinct.update(values)
+        if len(self.distinct) > self.cardinality_limit:
+            self.sketch = HyperLogLog()
+            if self.column_type == c_TYPE_NUMERIC:
+                self.sketch.add_numbers(list(self.distinct))
+            else:
+                for distinct_value in self.distinct:
+                    self.sketch.add(distinct_value)
+            self.distinct = None
+            self.labels = None
+
+    def add_missing(self, count=1):
+        """
+        Count NA values of the column.
+        """
+        self.missing += count
+
+    def cardinality(self):
+        """
+        Number of distinct values, estimated above the cardinality limit.
+        """
+        if self.sketch:
+            return(self.sketch.cardinality())
+        return(len(self.distinct))
+
+    def to_dict(self):
+        """
+        Summary of the profile.
+        """
+        summary = {"name": self.name,
+                   "type": self.column_type,
+                   "count": self.count,
+                   "missing": self.missing,
+                   "cardinality": self.cardinality(),
+                   "cardinality_is_estimate": self.sketch is not None}
+        if self.column_type == c_TYPE_NUMERIC:
+            summary.update({"min": self.minimum,
+                            "max": self.maximum,
+                            "nan": self.nan})
+        else:
+            summary["labels"] = dict(self.labels) if self.labels is not None else None
+            summary["missing_labels"] = sorted(self.missing_labels)
+        return(summary)
+
+class SparsityProfile:
+
+    def __init__(self, header, delimiter=c_DEFAULT_DELIM,
+                 block_size=c_CHECK_BLOCK_SIZE, sample_size=c_SPARSITY_SAMPLE_SIZE):
+        """
+        Running count of the zeros of an expression matrix, by gene and by
+        block of rows, with the text sizes the matrix would have as a dense
+        table and as MTX entries. The first rows, up to the sample size in
+        characters, are kept in both forms to estimate gzip compression.
+        """
+        self.delimiter = delimiter
+        self.block_size = block_size
+        self.sample_size = sample_size
+        self.cell_count = len(header) - 1
+        # Characters of each 1 based cell index as written in MTX entries
+        self.cell_digits = np.array([len(str(cell + 1)) for cell in range(self.cell_count)],
+                                    dtype=np.int64)
+        self.gene_nonzeros = array.array("Q")
+        self.block_zeros = []
+        self.dense_size = len(delimiter.join(header)) + 1
+        self.mtx_size = 0
+        self.genes_size = 0
+        self.barcodes_text = "".join([cell_name + "\n" for cell_name in header[1:]])
+        self.dense_sample = []
+        self.mtx_sample = []
+        self.sampled_size = 0
+
+    def add_row(self, file_line, values):
+        """
+        Add a row of the matrix, given as its tokens and values.
+        """
+        nonzero = values != 0
+        nonzero_count = int(np.count_nonzero(nonzero))
+        gene_number = len(self.gene_nonzeros) + 1
+        self.gene_nonzeros.append(nonzero_count)
+        if len(self.gene_nonzeros) % self.block_size == 1 or self.block_size == 1:
+            self.block_zeros.append(0)
+        self.block_zeros[-1] += len(values) - nonzero_count
+        token_lengths = np.fromiter(map(len, file_line[1:]), dtype=np.int64,
+                                    count=len(file_line) - 1)
+        # Tokens, delimiters and the new line
+        self.dense_size += len(file_line[0]) + int(token_lengths.sum()) + len(file_line)
+        # Gene index, cell index and value of each entry, with 2 spaces and the new line
+        self.mtx_size += (nonzero_count * (len(str(gene_number)) + 3) +
+                          int(self.cell_digits[nonzero].sum()) +
+                          int(token_lengths[nonzero].sum()))
+        # Genes are written with an id and a name column
+        self.genes_size += 2 * len(file_line[0]) + 2
+        if self.sampled_size < self.sample_size:
+            dense_line = self.delimiter.join(file_line) + "\n"
+            self.dense_sample.append(dense_line)
+            self.mtx_sample.extend([" ".join([str(gene_number), str(cell + 1), file_line[cell + 1]]) + "\n"
+                                    for cell in np.flatnonzero(nonzero).tolist()])
+            self.sampled_size += len(dense_line)
+
+    def to_dict(self, gzip_size=None):
+        """
+        Summary of the sparsity with the projected size of each format
+        and the smallest as the recommended format. The gzip size of
+        the file, if it is gzipped, is used instead of its projection.
+        """
+        gene_count = len(self.gene_nonzeros)
+        nonzero_count = sum(self.gene_nonzeros)
+        entry_count = gene_count * self.cell_count
+        mtx_header = "".join([c_MTX_HEADER, "\n",
+                              " ".join([str(gene_count), str(self.cell_count), str(nonzero_count)]),
+                              "\n"])
+        if gzip_size is None:
+            gzip_size = int(self.dense_size * compression_ratio("".join(self.dense_sample)))
+        genes_ratio = compression_ratio(self.barcodes_text)
+        sizes = {c_FORMAT_DENSE_TSV: self.dense_size,
+                 c_FORMAT_DENSE_GZIP: gzip_size,
+                 c_FORMAT_MTX_GZIP: int(len(mtx_header) +
+                                        self.mtx_size * compression_ratio("".join(self.mtx_sample)) +
+                                        self.genes_size * genes_ratio +
+                                        len(zlib.compress(self.barcodes_text.encode("utf-8"),
+                                                          c_GZIP_LEVEL)))}
+        return({"genes": gene_count,
+                "cells": self.cell_count,
+                "nonzero": nonzero_count,
+                "density": nonzero_count / entry_count if entry_count else 0.0,
+                "block_size": self.block_size,
+                "block_zeros": self.block_zeros,
+                "gene_nonzeros": self.gene_nonzeros.tolist(),
+                "projected_sizes": sizes,
+                "recommended_format": min(c_FORMATS, key=lambda file_format: sizes[file_format])})
+
+def split_file_name(file_name):
+    """
+    Split a file name into its base and its extension, keeping a .gz
+    extension with the extension before it. Dots in directory names
+    are kept in the base.
+    """
+    file_base, file_ext = os.path.splitext(file_name)
+    if file_ext == ".gz":
+        file_base, inner_ext = os.path.splitext(file_base)
+        file_ext = inner_ext + file_ext
+    return(file_base, file_ext)
+
+def gene_names_digest(gene_names):
+    """
+    Hash of the sorted unique gene names.
+    """
+    gene_hash = hashlib.blake2b(digest_size=16)
+    for gene in sorted(set(gene_names)):
+        gene_hash.update(gene.encode("utf-8") + b"\n")
+    return(gene_hash.hexdigest())
+
+def compression_ratio(text):
+    """
+    Ratio of the gzip compressed size to the size of a sample of text.
+    """
+    if not text:
+        return(1.0)
+    encoded_text = text.encode("utf-8")
+    return(len(zlib.compress(encoded_text, c_GZIP_LEVEL)) / len(encoded_text))
+
+class CompactCellNames:
+
+    def __init__(self, cell_names=()):
+        """
+        Cell names held as 64 bit codes. Barcodes of up to 16 bases with
+        an optional numeric suffix (such as AAACCTGAGAAGGCCT-1) are packed
+        2 bits per base with their length and suffix; other names are
+        kept in a fallback string table and coded by their position in it.
+        Iterating gives the names back in their original order.
+        """
+        codes = array.array("Q")
+        self.fallback_names = []
+        for cell_name in cell_names:
+            code = self.encode(cell_name)
+            if code is None:
+                code = c_FALLBACK_CODE_FLAG | len(self.fallback_names)
+                self.fallback_names.append(cell_name)
+            codes.append(code)
+        self.codes = np.frombuffer(codes, dtype=np.uint64) if codes else np.zeros(0, dtype=np.uint64)
+        self.barcodes = self.codes[self.codes < np.uint64(c_FALLBACK_CODE_FLAG)]
+        self.sorted_barcodes = None
+        self.fallback_set = None
+
+    @classmethod
+    def from_names(cls, cell_names):
+        """
+        Returns the cell names as CompactCellNames, encoding them if needed.
+        """
+        if isinstance(cell_names, cls):
+            return(cell_names)
+        return(cls(cell_names))
+
+    @staticmethod
+    def encode(cell_name):
+        """
+        Code of a barcode cell name, or None if the name is not a barcode.
+        """
+        barcode_match = c_BARCODE_PATTERN.match(cell_name)
+        if not barcode_match:
+            return(None)
+        barcode, suffix = barcode_match.groups()
+        code = int(barcode.translate(c_BARCODE_DIGITS), 4) | (len(barcode) << 32)
+        if suffix is not None:
+            code |= (int(suffix) + 1) << 37
+        return(code)
+
+    def decode(self, code):
+        """
+        Cell name of a code.
+        """
+        if code & c_FALLBACK_CODE_FLAG:
+            return(self.fallback_names[code & ~c_FALLBACK_CODE_FLAG])
+        # Bases are read 4 at a time, a byte of the code
+        barcode = "".join([c_BARCODE_BYTES[(code >> shift) & 255]
+                           for shift in (24, 16, 8, 0)])[-((code >> 32) & 31):]
+        if code >> 37:
+            return(barcode + "-" + str((code >> 37) - 1))
+        return(barcode)
+
+    def duplicates(self):
+        """
+        Returns the cell names found more than once.
+        """
+        unique_codes, code_counts = np.unique(self.barcodes, return_counts=True)
+        duplicates = set(self.decode(code) for code in unique_codes[code_counts > 1].tolist())
+        visited = set()
+        for cell_name in self.fallback_names:
+            if cell_name in visited:
+                duplicates.add(cell_name)
+            else:
+                visited.add(cell_name)
+        return(duplicates)
+
+    def __sub__(self, other):
+        """
+        Set of the cell names not found in the other cell names.
+        """
+        other = CompactCellNames.from_names(other)
+        difference = set(self.decode(code) for code in
+                         np.setdiff1d(self.barcodes, other.barcodes).tolist())
+        if self.fallback_names:
+            difference.update(set(self.fallback_names) - other.get_fallback_set())
+        return(difference)
+
+    def get_fallback_set(self):
+        """
+        Set of the names in the fallback string table.
+        """
+        if self.fallback_set is None:
+            self.fallback_set = set(self.fallback_names)
+        return(self.fallback_set)
+
+    def __contains__(self, cell_name):
+        code = self.encode(cell_name)
+        if code is None:
+            return(cell_name in self.get_fallback_set())
+        if self.sorted_barcodes is None:
+            self.sorted_barcodes = np.sort(self.barcodes)
+        position = np.searchsorted(self.sorted_barcodes, np.uint64(code))
+        return(bool(position < len(self.sorted_barcodes) and
+                    self.sorted_barcodes[position] == code))
+
+    def __iter__(self):
+        for code in self.codes.tolist():
+            yield self.decode(code)
+
+    def __len__(self):
+        return(len(self.codes))
+
+    def __str__(self):
+        return(str(list(self)))
+
+class CellNameSketch:
+
+    def __init__(self, cell_names_source, bloom_bits=c_BLOOM_BITS, hash_count=c_BLOOM_HASHES):
+        """
+        Cell names summarized in a fixed amount of memory: a Bloom filter,
+        the number of names and an order independent digest (the sum of
+        the 64 bit name hashes). Names are not stored; hashes of names
+        possibly seen before are kept as candidate duplicates, and
+        iterating streams the names again from the source, a function
+        returning a fresh iterator of the names.
+        """
+        self.source = cell_names_source
+        self.bloom_bits = bloom_bits
+        self.hash_count = hash_count
+        self.bits = np.zeros(bloom_bits // 8, dtype=np.uint8)
+        self.count = 0
+        self.digest = 0
+        self.duplicate_hashes = set()
+        for cell_names, hashes in self.iter_hashes():
+            bit_positions = self.bit_positions(hashes)
+            # Names all of whose bits are set were possibly added before,
+            # as were names repeated in the block
+            unique_hashes, unique_index, hash_counts = np.unique(hashes, return_inverse=True,
+                                                                 return_counts=True)
+            candidates = self.has_bits(bit_positions) | (hash_counts[unique_index] > 1)
+            self.duplicate_hashes.update(hashes[candidates].tolist())
+            np.bitwise_or.at(self.bits, bit_positions >> np.uint64(3),
+                             np.left_shift(1, bit_positions & np.uint64(7)).astype(np.uint8))
+            self.count += len(hashes)
+            self.digest = (self.digest + int(np.sum(hashes, dtype=np.uint64))) & c_UINT64_MASK
+
+    @classmethod
+    def from_names(cls, cell_names):
+        """
+        Returns the cell names as a CellNameSketch, sketching them if needed.
+        """
+        if isinstance(cell_names, cls):
+            return(cell_names)
+        return(cls(lambda: iter(cell_names)))
+
+    def iter_hashes(self):
+        """
+        Stream blocks of cell names with their 64 bit hashes.
+        """
+        names_iterator = self.source()
+        for cell_names in iter(lambda: list(itertools.islice(names_iterator, c_CHECK_BLOCK_SIZE)), []):
+            yield(cell_names, np.array([int.from_bytes(hashlib.blake2b(cell_name.encode("utf-8"),
+                                                                       digest_size=8).digest(),
+                                                       "little") for cell_name in cell_names],
+                                       dtype=np.uint64))
+
+    def bit_positions(self, hashes):
+        """
+        Filter bits of each hash, by double hashing with a remixed hash.
+        """
+        step = hashes * np.uint64(0xBF58476D1CE4E5B9)
+        step = (step ^ (step >> np.uint64(31))) | np.uint64(1)
+        hash_index = np.arange(self.hash_count, dtype=np.uint64)
+        return((hashes[:, None] + hash_index[None, :] * step[:, None]) & np.uint64(self.bloom_bits - 1))
+
+    def has_bits(self, bit_positions):
+        """
+        Which rows of filter bits are all set.
+        """
+        bit_values = self.bits[bit_positions >> np.uint64(3)] >> (bit_positions & np.uint64(7)).astype(np.uint8)
+        return(np.all(bit_values & 1, axis=1))
+
+    def false_positive_rate(self):
+        """
+        Chance a name not added is still found in the filter.
+        """
+        set_fraction = np.count_nonzero(np.unpackbits(self.bits)) / float(self.bloom_bits)
+        return(set_fraction ** self.hash_count)
+
+    def duplicates(self):
+        """
+        Returns the cell names found more than once, checking
+        only the names of candidate duplicates exactly.
+        """
+        if not self.duplicate_hashes:
+            return(set())
+        candidate_hashes = np.array(sorted(self.duplicate_hashes), dtype=np.uint64)
+        candidate_counts = collections.Counter()
+        for cell_names, hashes in self.iter_hashes():
+            for index in np.flatnonzero(np.isin(hashes, candidate_hashes)).tolist():
+                candidate_counts[cell_names[index]] += 1
+        return(set(cell_name for cell_name, count in candidate_counts.items() if count > 1))
+
+    def missing_from(self, other):
+        """
+        Names definitely not added to the other sketch's filter.
+        """
+        missing = set()
+        for cell_names, hashes in self.iter_hashes():
+            found = other.has_bits(other.bit_positions(hashes))
+            missing.update(cell_names[index] for index in np.flatnonzero(~found).tolist())
+        return(missing)
+
+    def differences(self, other):
+        """
+        Returns the names unique to this and to the other sketch.
+        Matching counts and digests are taken as the same names.
+        Otherwise the filters find the names missing from each other;
+        only if they find none, hidden by false positives or repeated
+        names, are the names of the hash buckets whose counts or digests
+        differ compared exactly.
+        """
+        if self.count == other.count and self.digest == other.digest:
+            return(set(), set())
+        difference = self.missing_from(other)
+        other_difference = other.missing_from(self)
+        if not difference and not other_difference:
+            buckets = self.differing_buckets(other)
+            these_names = self.names_in_buckets(buckets)
+            other_names = other.names_in_buckets(buckets)
+            difference = these_names - other_names
+            other_difference = other_names - these_names
+        return(difference, other_difference)
+
+    def bucket_totals(self):
+        """
+        Count and digest of the name hashes in each bucket,
+        bucketed by the top bits of the hashes.
+        """
+        counts = np.zeros(1 << c_BUCKET_BITS, dtype=np.int64)
+        digests = np.zeros(1 << c_BUCKET_BITS, dtype=np.uint64)
+        for cell_names, hashes in self.iter_hashes():
+            buckets = (hashes >> np.uint64(64 - c_BUCKET_BITS)).astype(np.int64)
+            np.add.at(counts, buckets, 1)
+            np.add.at(digests, buckets, hashes)
+        return(counts, digests)
+
+    def differing_buckets(self, other):
+        """
+        Buckets of name hashes whose counts or digests differ in the other sketch.
+        """
+        counts, digests = self.bucket_totals()
+        other_counts, other_digests = other.bucket_totals()
+        return(np.flatnonzero((counts != other_counts) | (digests != other_digests)).astype(np.uint64))
+
+    def names_in_buckets(self, buckets):
+        """
+        Returns the names whose hashes are in the given buckets.
+        """
+        names = set()
+        for cell_names, hashes in self.iter_hashes():
+            in_buckets = np.isin(hashes >> np.uint64(64 - c_BUCKET_BITS), buckets)
+            names.update(cell_names[index] for index in np.flatnonzero(in_buckets).tolist())
+        return(names)
+
+    def __iter__(self):
+        return(iter(self.source()))
+
+    def __len__(self):
+        return(self.count)
+
+    def __str__(self):
+        return("CellNameSketch(count=" + str(self.count) + ", digest=" + str(self.digest) + ")")
+
+class ParallelGzipWriter:
+
+    def __init__(self, file_name, compress_level=c_GZIP_LEVEL,
+                 threads=None, block_size=c_GZIP_BLOCK_SIZE):
+        """
+        Writable gzip file. What is written is cut into blocks that are
+        compressed as separate gzip members on a pool of threads, zlib
+        letting them run at the same time, and written in order. The
+        file is a standard multi-member gzip that gzip readers read as
+        one stream. Text is written as UTF-8, bytes as they are.
+        """
+        self.compress_level = compress_level
+        self.block_size = block_size
+        self.threads = threads or os.cpu_count() or 1
+        self.file_handle = open(file_name, "wb")
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        self.pending_blocks = collections.deque()
+        self.buffer = []
+        self.buffer_size = 0
+        self.members = 0
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= self.block_size:
+            self.compress_block()
+        return(len(data))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def compress_block(self):
+        """
+        Compress the buffered data as a gzip member on the thread pool,
+        writing the oldest members done so only a few blocks per
+        thread are held in memory.
+        """
+        block = b"".join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+        self.pending_blocks.append(self.executor.submit(gzip.compress, block,
+                                                        self.compress_level))
+        self.members += 1
+        while len(self.pending_blocks) > 2 * self.threads:
+            self.file_handle.write(self.pending_blocks.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            # An empty file is still written as one empty member
+            if self.buffer_size or not self.members:
+                self.compress_block()
+            while self.pending_blocks:
+                self.file_handle.write(self.pending_blocks.popleft().result())
+        finally:
+            self.executor.shutdown()
+            self.file_handle.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def open_stream(stream):
+    """
+    Text handle reading a binary stream that can only be read once,
+    decompressing it if it starts with the gzip magic bytes.
+    """
+    if not hasattr(stream, "peek"):
+        stream = io.BufferedReader(stream)
+    if stream.peek(len(c_GZIP_MAGIC))[:len(c_GZIP_MAGIC)] == c_GZIP_MAGIC:
+        stream = gzip.GzipFile(fileobj=stream, mode="rb")
+    return(io.TextIOWrapper(stream, encoding="utf-8"))
+
+def wilson_interval(successes, trials, z=c_WILSON_Z):
+    """
+    Wilson score confidence bounds of a proportion, which stay
+    within 0 and 1 for small samples and proportions near 0.
+    Returns None bounds without trials.
+    """
+    if not trials:
+        return([None, None])
+    proportion = successes / trials
+    denominator = 1 + z * z / trials
+    center = (proportion + z * z / (2 * trials)) / denominator
+    margin = z * math.sqrt(proportion * (1 - proportion) / trials
+                           + z * z / (4 * trials * trials)) / denominator
+    return([max(0.0, center - margin), min(1.0, center + margin)])
+
+def is_bgzf_block_header(block_header):
+    """
+    Whether the bytes start with a BGZF block header: a gzip member
+    header with an extra field holding the BC block size subfield.
+    """
+    return(len(block_header) >= 18 and
+           block_header[:4] == c_BGZF_MAGIC and
+           block_header[12:14] == b"BC")
+
+def read_bgzf_block(bgzf_handle, offset):
+    """
+    Find the first BGZF block starting at or after the offset and
+    decompress it. Returns the block offset and its data, or the
+    offset and None if no block is found before the end of the file.
+    """
+    bgzf_handle.seek(offset)
+    search_window = bgzf_handle.read(2 * c_BGZF_MAX_BLOCK_SIZE)
+    search_start = 0
+    while True:
+        block_start = search_window.find(c_BGZF_MAGIC, search_start)
+        if block_start < 0:
+            return(offset, None)
+        block_header = search_window[block_start:block_start + 18]
+        if is_bgzf_block_header(block_header):
+            extra_length = int.from_bytes(block_header[10:12], "little")
+            block_size = int.from_bytes(block_header[16:18], "little") + 1
+            bgzf_handle.seek(offset + block_start)
+            block = bgzf_handle.read(block_size)
+            try:
+                # Raw deflate data between the header and the CRC and size
+                return(offset + block_start,
+                       zlib.decompress(block[12 + extra_length:-8], -15))
+            except zlib.error:
+                # Bytes looking like a header inside compressed data
+                pass
+        search_start = block_start + 1
+
+@contextlib.contextmanager
+def timed_stage(stage_timings, stage):
+    """
+    Time the wall and CPU time of a stage, adding its timing to the
+    stage timings. The stage sets the rows and bytes it read on the
+    timing given to it, the rows per second are made from them.
+    """
+    stage_timing = {"stage": stage, "rows": 0, "bytes_read": 0}
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield stage_timing
+    finally:
+        stage_timing["wall_seconds"] = time.perf_counter() - wall_start
+        stage_timing["cpu_seconds"] = time.process_time() - cpu_start
+        stage_timing["rows_per_second"] = (stage_timing["rows"] / stage_timing["wall_seconds"]
+                                           if stage_timing["wall_seconds"] > 0 else None)
+        stage_timings.append(stage_timing)
+
+def file_content_hash(file_name):
+    """
+    Hash of the bytes of a file, the same for files with the same contents.
+    """
+    content_hash = hashlib.blake2b(digest_size=32)
+    with open(file_name, "rb") as hash_handle:
+        for block in iter(lambda: hash_handle.read(c_HASH_BLOCK_SIZE), b""):
+            content_hash.update(block)
+    return(content_hash.hexdigest())
+
+class ValidationReport:
+
+    def __init__(self, file_name, file_type, content_hash, file_has_error,
+                 output, cell_names=None, gene_names=None, results=None,
+                 validator_version=c_VALIDATOR_VERSION):
+        """
+        Outcome of checking a file: whether it had errors, what the
+        check printed and the cell names, gene names and summaries it
+        found, for the file contents and validator version checked.
+        """
+        self.file_name = file_name
+        self.file_type = file_type
+        self.content_hash = content_hash
+        self.file_has_error = file_has_error
+        self.output = output
+        self.cell_names = cell_names
+        self.gene_names = gene_names
+        self.results = results or {}
+        self.validator_version = validator_version
+
+    @classmethod
+    def from_portal_file(cls, portal_file, content_hash, output):
+        """
+        Report of a checked portal file.
+        """
+        return(cls(portal_file.file_name,
+                   type(portal_file).__name__,
+                   content_hash,
+                   portal_file.file_has_error,
+                   output,
+                   cell_names=list(portal_file.cell_names),
+                   gene_names=getattr(portal_file, "gene_names", None),
+                   results=dict((result, getattr(portal_file, result))
+                                for result in c_VALIDATION_RESULTS
+                                if getattr(portal_file, result, None) is not None)))
+
+    @classmethod
+    def from_dict(cls, report):
+        return(cls(**report))
+
+    def to_dict(self):
+        return({"file_name": self.file_name,
+                "file_type": self.file_type,
+                "content_hash": self.content_hash,
+                "file_has_error": self.file_has_error,
+                "output": self.output,
+                "cell_names": self.cell_names,
+                "gene_names": self.gene_names,
+                "results": self.results,
+                "validator_version": self.validator_version})
+
+    def restore(self, portal_file):
+        """
+        Give a portal file of the same contents what checking found,
+        without reading the file. Returns the portal file.
+        """
+        portal_file.file_has_error = self.file_has_error
+        if self.cell_names is not None:
+            portal_file.set_cell_names(lambda: iter(self.cell_names))
+        if self.gene_names is not None:
+            portal_file.gene_names = self.gene_names
+        for result, value in self.results.items():
+            if result == "duplicate_rows":
+                # Line numbers are kept as strings in the JSON cache
+                value = dict((int(line_number), first_line) for line_number, first_line in value.items())
+            setattr(portal_file, result, value)
+        return(portal_file)
+
+class ValidationCache:
+
+    def __init__(self, cache_dir=None):
+        """
+        Validation reports kept on disk by the content hash of the
+        checked file, the validator version and the check options.
+        """
+        self.cache_dir = cache_dir or c_VALIDATION_CACHE_DIR
+
+    def cache_file_name(self, content_hash, options):
+        """
+        Name of the file caching the report for the contents and options.
+        """
+        cache_key = json.dumps([content_hash, c_VALIDATOR_VERSION, options], sort_keys=True)
+        return(os.path.join(self.cache_dir,
+                            hashlib.blake2b(cache_key.encode("utf-8"),
+                                            digest_size=16).hexdigest() + c_SIDECAR_EXT))
+
+    def get(self, content_hash, options):
+        """
+        Returns the cached report or None if the contents were
+        not checked with these options by this validator version.
+        """
+        cache_file = self.cache_file_name(content_hash, options)
+        if not os.path.exists(cache_file):
+            return(None)
+        try:
+            with open(cache_file) as cache_handle:
+                report = ValidationReport.from_dict(json.load(cache_handle))
+        except (ValueError, TypeError):
+            print("Note: Ignoring unreadable validation cache file " + cache_file)
+            return(None)
+        if report.content_hash != content_hash or report.validator_version != c_VALIDATOR_VERSION:
+            return(None)
+        return(report)
+
+    def put(self, report, options):
+        """
+        Cache a report, returning the cache file name.
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        cache_file = self.cache_file_name(report.content_hash, options)
+        with open(cache_file, "w") as cache_handle:
+            json.dump(report.to_dict(), cache_handle)
+        return(cache_file)
+
 class GeneListFile(ParentPortalFile):
 
     def __init__(self, file_name,
                  file_delimiter=c_DEFAULT_DELIM,
-                 demo_file_link=c_GENELIST_DEMO_LINK):
+                 demo_file_link=c_GENELIST_DEMO_LINK,
+                 lazy=False):
         """
         Represents a gene list file used for visualization in the portal.
         Used in test
@@ -317,8 +1808,10 @@ class GeneListFile(ParentPortalFile):
                                   file_delimiter,
                                   has_type=False,
                                   expected_header=None,
-                                  demo_file_link=demo_file_link)
-        self.update_cell_names()
+                                  demo_file_link=demo_file_link,
+                                  lazy=lazy)
+        if not lazy:
+            self.update_cell_names()
 
     def check_header(self):
         """
@@ -376,7 +1869,7 @@ class GeneListFile(ParentPortalFile):
             print("None expression file was given so no checking could occur.")
 
         if expression_file:
-            exp_genes = expression_file.get_gene_names()
+            exp_genes = expression_file.get_gene_index()
             for gene in self.get_gene_names():
                 if gene not in exp_genes:
                     self.file_has_error = True
@@ -433,22 +1926,175 @@ class GeneListFile(ParentPortalFile):
         """
         return(list(set(self.header[1:])))
 
+class ConventionSchema:
+
+    def __init__(self, version, columns, required, dependencies):
+        """
+        Metadata convention compiled for checking files: per column the
+        value type, if values are arrays, the set of allowed values and
+        the compiled pattern of ontology ids, with the required columns
+        and the columns each column depends on.
+        """
+        self.version = version
+        self.columns = {}
+        for column_name, column_check in columns.items():
+            column_check = dict(column_check)
+            if column_check.get("enum") is not None:
+                column_check["enum"] = frozenset(column_check["enum"])
+            if column_check.get("pattern") is not None:
+                column_check["pattern"] = re.compile(column_check["pattern"])
+            self.columns[column_name] = column_check
+        self.required = required
+        self.dependencies = dependencies
+
+    @classmethod
+    def compile(cls, convention):
+        """
+        Compile a convention given as its JSON schema.
+        """
+        columns = {}
+        for column_name, column_schema in convention["properties"].items():
+            is_array = column_schema.get("type") == "array"
+            value_schema = column_schema.get("items", {}) if is_array else column_schema
+            columns[column_name] = {"type": value_schema.get("type", "string"),
+                                    "array": is_array,
+                                    "enum": value_schema.get("enum"),
+                                    "pattern": value_schema.get("pattern")}
+        # Versions are in the id, as in .../alexandria_convention/2.1.0/json
+        version = convention.get("$id", "").rstrip("/").split("/")[-2:-1]
+        return(cls(version[0] if version else "unknown", columns,
+                   convention.get("required", []), convention.get("dependencies", {})))
+
+    def to_dict(self):
+        """
+        Compiled convention in a form that can be saved as JSON.
+        """
+        columns = {}
+        for column_name, column_check in self.columns.items():
+            column_check = dict(column_check)
+            if column_check["enum"] is not None:
+                column_check["enum"] = sorted(column_check["enum"])
+            if column_check["pattern"] is not None:
+                column_check["pattern"] = column_check["pattern"].pattern
+            columns[column_name] = column_check
+        return({"version": self.version,
+                "columns": columns,
+                "required": self.required,
+                "dependencies": self.dependencies})
+
+    def check_columns(self, column_names, type_header):
+        """
+        Returns the issues of the columns of a file: missing required
+        columns, missing columns others depend on, and numeric
+        convention columns not typed as numeric.
+        """
+        issues = []
+        present = set(column_names)
+        missing = [column_name for column_name in self.required if column_name not in present]
+        if missing:
+            issues.append("missing required columns " + ", ".join(missing))
+        for column_name in column_names:
+            missing = [dependency for dependency in self.dependencies.get(column_name, [])
+                       if dependency not in present]
+            if missing:
+                issues.append(" ".join(["column", column_name, "needs the columns", ", ".join(missing)]))
+        for token, column_name in enumerate(column_names):
+            column_check = self.columns.get(column_name)
+            if (token and column_check and column_check["type"] in c_CONVENTION_NUMERIC_TYPES and
+                    token < len(type_header) and type_header[token] != c_TYPE_NUMERIC):
+                issues.append(" ".join(["column", column_name, "should have the type", c_TYPE_NUMERIC]))
+        return(issues)
+
+    def check_value(self, column_name, column_check, value):
+        """
+        Returns the kind of problem of a value of a column,
+        or an empty string if the value is valid.
+        """
+        if value == "" or value in c_NA_VALUES:
+            return("missing" if column_name in self.required else "")
+        values = value.split(c_CONVENTION_ARRAY_DELIM) if column_check["array"] else [value]
+        for item in values:
+            if column_check["type"] in c_CONVENTION_NUMERIC_TYPES:
+                try:
+                    number = float(item)
+                except ValueError:
+                    return("non numeric")
+                if column_check["type"] == "integer" and not number.is_integer():
+                    return("non integer")
+            elif column_check["type"] == "boolean":
+                if item.lower() not in c_CONVENTION_BOOLEANS:
+                    return("non boolean")
+            if column_check["enum"] is not None and item not in column_check["enum"]:
+                return("not allowed")
+            if column_check["pattern"] is not None and not column_check["pattern"].match(item):
+                return("malformed ontology id")
+        return("")
+
+def load_convention_schema(convention=None, content_hash=None, cache_dir=None):
+    """
+    Returns a compiled metadata convention, cached on disk by the hash of
+    its contents. Given the convention JSON schema, it is compiled and
+    cached if it is not cached yet. The content hash, by default a hash of
+    the schema, can be given instead as the file_content_hash of the schema
+    file; given only the content hash, the cached compiled convention is
+    loaded, or None is returned if not cached.
+    """
+    if cache_dir is None:
+        cache_dir = c_CONVENTION_CACHE_DIR
+    if content_hash is None:
+        if convention is None:
+            return(None)
+        content_hash = hashlib.blake2b(json.dumps(convention, sort_keys=True).encode("utf-8"),
+                                       digest_size=32).hexdigest()
+    cache_file = os.path.join(cache_dir, c_CONVENTION_CACHE_PREFIX + content_hash + c_SIDECAR_EXT)
+    if os.path.exists(cache_file):
+        with open(cache_file) as cache_handle:
+            cached = json.load(cache_handle)
+        return(ConventionSchema(cached["version"], cached["columns"],
+                                cached["required"], cached["dependencies"]))
+    if convention is None:
+        return(None)
+    convention_schema = ConventionSchema.compile(convention)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(cache_file, "w") as cache_handle:
+        json.dump(convention_schema.to_dict(), cache_handle)
+    return(convention_schema)
+
 class MetadataFile(ParentPortalFile):
 
     def __init__(self, file_name,
                  file_delimiter=c_DEFAULT_DELIM,
                  expected_header=None,
-                 demo_file_link=c_METADATA_DEMO_LINK):
+                 demo_file_link=c_METADATA_DEMO_LINK,
+                 cell_names_mode=c_CELL_NAMES_EXACT,
+                 cardinality_limit=c_EXACT_CARDINALITY_LIMIT,
+                 lazy=False):
         """
         Represents a metadata file used for visualization in the portal.
+        Label frequencies of group columns are profiled while checking
+        up to the cardinality limit of distinct labels per column.
         Tested
         """
         ParentPortalFile.__init__(self, file_name,
                                   file_delimiter,
                                   has_type=True,
                                   expected_header=expected_header,
-                                  demo_file_link=demo_file_link)
-        self.update_cell_names()
+                                  demo_file_link=demo_file_link,
+                                  cell_names_mode=cell_names_mode,
+                                  lazy=lazy)
+        if not lazy:
+            self.update_cell_names()
+        self.cardinality_limit = cardinality_limit
+        self.profile = None
+
+    def new_portal_file(self, file_name):
+        """
+        Lazy portal file of the same type and options for a new file.
+        """
+        new_file = ParentPortalFile.new_portal_file(self, file_name)
+        new_file.cardinality_limit = self.cardinality_limit
+        return(new_file)
 
     def check_header(self):
         """
@@ -480,41 +2126,30 @@ class MetadataFile(ParentPortalFile):
         self.check_type_row()
         return(self.file_has_error)
 
-    def check_body(self):
+    def check_body(self, rows=None):
         """
-        Check body of file.
+        Check body of file, or the given rows in its place.
         Tested
         """
-        check_handle = self.csv_handle
-        # Need to skip the 2 header rows
-        next(check_handle)
-        next(check_handle)
-        type_checks = [ float if type_value == c_TYPE_NUMERIC else str for type_value in self.type_header ]
-        for file_line in check_handle:
-            self.line_number += 1
-            if len(file_line) != self.header_length:
-                self.file_has_error = True
-                print(" ".join(["Error!\tLine:",
-                                str(self.line_number),
-                                "Expected", str(self.header_length),
-                                "columns but received",
-                                str(len(file_line)), "."]))
-            for token in range(len(file_line)):
-                if not file_line[token]:
-                    self.file_has_error = True
-                    print(" ".join(["Expected a value for entry: line",
-                                    str(self.line_number+1), ", element",
-                                    str(token+1)]))
-                elif file_line[token] not in ["NA","nA","Na","na"]:
-                    try:
-                        type_checks[token](file_line[token])
-                    except ValueError:
-                        self.file_has_error = True
-                        print(file_line[token])
-                        print(" ".join(["Error!\tUnexpected type. Line:",
-                                        str(self.line_number),
-                                        "Value:", file_line[token],
-                                        "Expected Type:", self.type_header[token]]))
+        if rows is None:
+            check_handle = self.csv_handle
+            # Need to skip the 2 header rows
+            next(check_handle)
+            next(check_handle)
+        else:
+            check_handle = iter(rows)
+        # Profile the metadata columns, the cell names are not profiled
+        column_profiles = [None] + [ColumnProfile(self.header[token], self.type_header[token],
+                                                  cardinality_limit=self.cardinality_limit)
+                                    if token < len(self.type_header) else None
+                                    for token in range(1, self.header_length)]
+        self.check_typed_body(check_handle,
+                              missing_values=c_NA_VALUES,
+                              column_profiles=column_profiles)
+        self.profile = {"rows": self.line_number - 1,
+                        "columns": [column_profile.to_dict()
+                                    for column_profile in column_profiles[1:]
+                                    if column_profile]}
 
     def deidentify_cell_names(self, cell_names_change=None):
         """
@@ -545,23 +2180,101 @@ class MetadataFile(ParentPortalFile):
         if new_mapping_file is None:
             return(None)
         # Write deidentified file
-        with open(new_deid_file, 'w') as deid_file:
+        with self.get_write_handle(new_deid_file) as deid_file:
             write_deid = self.csv_handle
             for file_line in write_deid:
                 new_file_lines.append(self.delimiter.join([update_names[file_line[0]]]+file_line[1:]))
             deid_file.write("\n".join(new_file_lines))
         # Write mapping file
-        with open(new_mapping_file, 'w') as map_file:
+        with self.get_write_handle(new_mapping_file) as map_file:
             map_file.write("\n".join(sorted([name_key+c_MAP_DELIM+name_value
                                       for name_key, name_value
                                       in update_names.items()])))
         return({"name": new_deid_file, "mapping": cell_names_change, "mapping_file": new_mapping_file})
 
+    def check_convention(self, convention_schema):
+        """
+        Check the file against a compiled metadata convention in one
+        streaming pass. Each distinct value of a column is checked once.
+        Sets the file in an error state and returns the issues found:
+        header level messages and, per column, the count and first
+        examples of each kind of invalid value.
+        """
+        # The cell name column is the convention's cell ids
+        column_names = [c_CONVENTION_CELL_ID] + self.header[1:]
+        header_issues = convention_schema.check_columns(column_names, self.type_header)
+        checked_columns = [(token, column_names[token], convention_schema.columns[column_names[token]])
+                           for token in range(self.header_length)
+                           if column_names[token] in convention_schema.columns]
+        verdicts = [{} for token in checked_columns]
+        column_issues = collections.defaultdict(dict)
+        check_handle = self.csv_handle
+        # Need to skip the 2 header rows
+        next(check_handle)
+        next(check_handle)
+        for line_number, file_line in enumerate(check_handle, 3):
+            for (token, column_name, column_check), column_verdicts in zip(checked_columns, verdicts):
+                value = file_line[token] if token < len(file_line) else ""
+                verdict = column_verdicts.get(value)
+                if verdict is None:
+                    verdict = convention_schema.check_value(column_name, column_check, value)
+                    column_verdicts[value] = verdict
+                if verdict:
+                    issue = column_issues[column_name].setdefault(verdict, {"count": 0, "examples": []})
+                    issue["count"] += 1
+                    if len(issue["examples"]) < c_CONVENTION_EXAMPLES:
+                        issue["examples"].append([line_number, value])
+        for header_issue in header_issues:
+            print("Error!\tConvention: " + header_issue)
+        for column_name in sorted(column_issues):
+            for verdict, issue in sorted(column_issues[column_name].items()):
+                print(" ".join(["Error!\tConvention: column", column_name, "has",
+                                str(issue["count"]), verdict, "values, such as"] +
+                               ["\"" + value + "\" (line " + str(line_number) + ")"
+                                for line_number, value in issue["examples"]]))
+        if header_issues or column_issues:
+            self.file_has_error = True
+        return({"version": convention_schema.version,
+                "header": header_issues,
+                "columns": dict(column_issues)})
+
+    def get_profile(self):
+        """
+        Returns the column profile made when checking the body of the file,
+        or the profile saved in the sidecar of the file if it is current.
+        """
+        if self.profile is None:
+            self.profile = self.read_sidecar(c_PROFILE_TAG)
+        return(self.profile)
+
+    def save_profile(self):
+        """
+        Save the column profile to a sidecar file so summaries
+        of the file can be made without reading it again.
+        Returns the sidecar file name or None if there is no profile.
+        """
+        if self.profile is None:
+            return(None)
+        return(self.write_sidecar(c_PROFILE_TAG, self.profile))
+
     def get_labels(self):
         """
-        Get all the labels for all the metadata returned as a unique values.
+        Get all the labels for all the metadata returned as a unique values,
+        including empty and NA labels. They are taken from the profile
+        unless a group column has more distinct labels than the cardinality
+        limit, then the file is read again.
         Tested
         """
+        # Use the label frequencies of the profile when they are complete
+        profile = self.get_profile()
+        if profile:
+            group_columns = [column for column in profile["columns"]
+                             if column["type"] == c_TYPE_GROUP]
+            if all(column["labels"] is not None and "missing_labels" in column
+                   for column in group_columns):
+                return(list(set(label for column in group_columns
+                                for label in itertools.chain(column["labels"],
+                                                             column["missing_labels"]))))
         labels = []
         check_handle = self.csv_handle
         # Need to skip the 2 header rows
@@ -583,7 +2296,7 @@ class MetadataFile(ParentPortalFile):
         if subset_file_name is None:
             return(None)
 
-        with open(subset_file_name,"w") as csvwriter:
+        with self.get_write_handle(subset_file_name) as csvwriter:
             file_writer = csv.writer(csvwriter, delimiter=self.delimiter)
             check_handle = self.csv_handle
             # Need to add the 2 header rows
@@ -638,7 +2351,9 @@ class CoordinatesFile(ParentPortalFile):
     def __init__(self, file_name,
                  file_delimiter=c_DEFAULT_DELIM,
                  expected_header=c_COORDINATES_HEADER,
-                 demo_file_link=c_COORDINATES_DEMO_LINK):
+                 demo_file_link=c_COORDINATES_DEMO_LINK,
+                 cell_names_mode=c_CELL_NAMES_EXACT,
+                 lazy=False):
         """
         Represents a coordinate file used for visualizations in the portal.
         Tested
@@ -647,8 +2362,12 @@ class CoordinatesFile(ParentPortalFile):
                                   file_delimiter,
                                   has_type=True,
                                   expected_header=expected_header,
-                                  demo_file_link=demo_file_link)
-        self.update_cell_names()
+                                  demo_file_link=demo_file_link,
+                                  cell_names_mode=cell_names_mode,
+                                  lazy=lazy)
+        if not lazy:
+            self.update_cell_names()
+        self.summary = None
 
     def check_header(self):
         """
@@ -691,35 +2410,63 @@ class CoordinatesFile(ParentPortalFile):
         self.check_type_row()
         return(self.file_has_error)
 
-    def check_body(self):
+    def check_body(self, rows=None):
         """
-        Check body of file.
+        Check body of file, or the given rows in its place.
         Tested
         """
-
-        check_handle = self.csv_handle
-        # Need to skip the 2 header rows
-        next(check_handle)
-        next(check_handle)
-        type_checks = [ float if type_value == c_TYPE_NUMERIC else str for type_value in self.type_header ]
-        for file_line in check_handle:
-            self.line_number += 1
-            if len(file_line) != self.header_length:
-                self.file_has_error = True
-                print(" ".join(["Error!\tLine:",
-                                str(self.line_number),
-                                "Expected", str(self.header_length),
-                                "columns but received",
-                                str(len(file_line)), "."]))
-            for token in range(0,len(file_line)):
-                try:
-                    type_checks[token](file_line[token])
-                except ValueError:
-                    self.file_has_error = True
-                    print(" ".join(["Error!\tUnexpected type. Line:",
-                                    str(self.line_number),
-                                    "Value:", file_line[token],
-                                    "Expected Type:", self.type_header[token]]))
+        if rows is None:
+            check_handle = self.csv_handle
+            # Need to skip the 2 header rows
+            next(check_handle)
+            next(check_handle)
+        else:
+            check_handle = iter(rows)
+        # Summarize the columns, the cell names are not profiled
+        column_profiles = [None] + [ColumnProfile(self.header[token], self.type_header[token])
+                                    if token < len(self.type_header) else None
+                                    for token in range(1, self.header_length)]
+        self.check_typed_body(check_handle, column_profiles=column_profiles)
+        columns = [column_profile.to_dict() for column_profile in column_profiles[1:]
+                   if column_profile]
+        self.summary = {"points": self.line_number - 1,
+                        "has_z": c_COORDINATES_OPTIONAL_Z in self.header,
+                        "bounds": dict((column["name"], [column["min"], column["max"]])
+                                       for column in columns
+                                       if column["name"] in self.get_axis_names()
+                                       and column["type"] == c_TYPE_NUMERIC),
+                        "labels": dict((column["name"], column["labels"])
+                                       for column in columns
+                                       if column["type"] == c_TYPE_GROUP),
+                        "columns": columns}
+
+    def get_axis_names(self):
+        """
+        Names of the coordinate axes in the file.
+        """
+        return([axis for axis in [c_COORDINATES_HEADER[1], c_COORDINATES_HEADER[2],
+                                  c_COORDINATES_OPTIONAL_Z]
+                if axis in self.header])
+
+    def get_summary(self):
+        """
+        Returns the summary made when checking the body of the file
+        (point count, axis bounds, group label counts and column profiles),
+        or the summary saved in the sidecar of the file if it is current.
+        """
+        if self.summary is None:
+            self.summary = self.read_sidecar(c_SUMMARY_TAG)
+        return(self.summary)
+
+    def save_summary(self):
+        """
+        Save the summary to a sidecar file so plotting and downsampling
+        can size themselves without reading the file again.
+        Returns the sidecar file name or None if there is no summary.
+        """
+        if self.summary is None:
+            return(None)
+        return(self.write_sidecar(c_SUMMARY_TAG, self.summary))
 
     def deidentify_cell_names(self, cell_names_change=None):
         """
@@ -749,13 +2496,13 @@ class CoordinatesFile(ParentPortalFile):
         if new_mapping_file is None:
             return(None)
         # Write deidentified file
-        with open(new_deid_file, 'w') as deid_file:
+        with self.get_write_handle(new_deid_file) as deid_file:
             write_deid = self.csv_handle
             for file_line in write_deid:
                 new_file_lines.append(self.delimiter.join([update_names[file_line[0]]]+file_line[1:]))
             deid_file.write("\n".join(new_file_lines))
         # Write mapping file
-        with open(new_mapping_file, 'w') as map_file:
+        with self.get_write_handle(new_mapping_file) as map_file:
             map_file.write("\n".join(sorted([name_key+c_MAP_DELIM+name_value
                                       for name_key, name_value
                                       in update_names.items()])))
@@ -771,7 +2518,7 @@ class CoordinatesFile(ParentPortalFile):
         if subset_file_name is None:
             return(None)
 
-        with open(subset_file_name,"w") as filewriter:
+        with self.get_write_handle(subset_file_name) as filewriter:
             csvwriter = csv.writer(filewriter, delimiter=self.delimiter)
             orig_handle = self.csv_handle
             # Need to add the 2 header rows
@@ -782,42 +2529,619 @@ class CoordinatesFile(ParentPortalFile):
                     csvwriter.writerow(file_line)
         return(subset_file_name)
 
+    def downsample(self, target_points, method="grid"):
+        """
+        Write a subset of about target_points cells of the file in one pass.
+        The grid method bins points into a 2D/3D grid, keeping point counts
+        and a bounded random reservoir of rows per cell along with a
+        uniform pool of rows, then samples cells in proportion to their
+        point counts, preserving the density of the plot. The grid starts
+        sized from the axis bounds of the file summary, or else from the
+        first rows read, and doubles its cell width whenever
+        more cells than target_points are occupied, so memory stays
+        proportional to the target. The random method samples rows
+        uniformly.
+        Returns the subset file name, the file listing the kept cells
+        and the kept cell names, or None on error.
+        """
+
+        if method not in c_DOWNSAMPLE_METHODS:
+            print(" ".join(["Error!\tUnknown downsampling method", str(method),
+                            "please use one of:", ",".join(c_DOWNSAMPLE_METHODS)]))
+            return(None)
+        if target_points < 1:
+            print("Error!\tPlease downsample to at least one point.")
+            return(None)
+        axis_names = self.get_axis_names()
+        axes = [self.header.index(axis) for axis in axis_names]
+        downsample_file_name = self.tag_file_name(c_DOWNSAMPLE_POSTFIX)
+        cells_file_name = self.tag_file_name(c_DOWNSAMPLE_CELLS_POSTFIX)
+        if downsample_file_name is None or cells_file_name is None:
+            return(None)
+
+        downsample_handle = self.csv_handle
+        header_rows = [next(downsample_handle), next(downsample_handle)]
+        grid = DownsampleGrid(target_points if method == "grid" else 1,
+                              c_DOWNSAMPLE_RESERVOIR,
+                              c_DOWNSAMPLE_POOL_FACTOR * target_points)
+        # Size the grid from the bounds in the summary when there is one
+        summary = self.get_summary()
+        if method == "grid" and summary and all(summary["bounds"].get(axis, [None])[0] is not None
+                                                for axis in axis_names):
+            grid.size_from_bounds([summary["bounds"][axis][0] for axis in axis_names],
+                                  [summary["bounds"][axis][1] for axis in axis_names])
+        staged_points = []
+        for line_number, file_line in enumerate(downsample_handle):
+            try:
+                point = tuple(float(file_line[axis]) for axis in axes)
+            except (ValueError, IndexError):
+                continue
+            if not all(math.isfinite(coordinate) for coordinate in point):
+                continue
+            if method == "grid" and grid.width is None:
+                # Stage the first rows to size the grid
+                staged_points.append((point, line_number, file_line))
+                if len(staged_points) >= target_points:
+                    grid.size_from_points([staged[0] for staged in staged_points])
+                    for staged in staged_points:
+                        grid.add(*staged)
+                    staged_points = []
+            else:
+                grid.add(point, line_number, file_line)
+        if staged_points:
+            grid.size_from_points([staged[0] for staged in staged_points])
+            for staged in staged_points:
+                grid.add(*staged)
+
+        kept_rows = grid.sample(target_points)
+        with self.get_write_handle(downsample_file_name) as downsample_writer:
+            csv_writer = csv.writer(downsample_writer, delimiter=self.delimiter,
+                                    lineterminator="\n")
+            csv_writer.writerows(header_rows)
+            csv_writer.writerows(kept_rows)
+        kept_cells = [file_line[0] for file_line in kept_rows]
+        with self.get_write_handle(cells_file_name) as cells_writer:
+            csv.writer(cells_writer, lineterminator="\n").writerows([[cell] for cell in kept_cells])
+        return({"name": downsample_file_name,
+                "cells_file": cells_file_name,
+                "cells": kept_cells})
+
+    def get_spatial_index(self, metadata_file=None):
+        """
+        Returns a spatial index of the cells of the file, loading the
+        index saved next to the file when it is current, otherwise
+        building it. If a metadata file is given the index can also
+        return the metadata rows of the cells.
+        """
+        index_file_name = self.sidecar_file_name(c_SPATIAL_INDEX_TAG, c_SPATIAL_INDEX_EXT)
+        if os.path.exists(index_file_name):
+            spatial_index = SpatialIndex.load(index_file_name, self, metadata_file)
+            if spatial_index:
+                return(spatial_index)
+        return(SpatialIndex.build(self, metadata_file))
+
+    def save_spatial_index(self, spatial_index):
+        """
+        Save a spatial index of the file next to it.
+        Returns the index file name.
+        """
+        index_file_name = self.sidecar_file_name(c_SPATIAL_INDEX_TAG, c_SPATIAL_INDEX_EXT)
+        spatial_index.save(index_file_name)
+        return(index_file_name)
+
+    def export_binary(self, binary_file_name=None):
+        """
+        Export the file to a packed little-endian binary file for plotting.
+        Numeric columns are stored as a float32 matrix, group columns as
+        integer codes into their labels, and cell names as a table of
+        offsets into the UTF-8 encoded names. Values that are not numbers
+        are stored as NaN. Load with load_binary_coordinates.
+        Returns the binary file name.
+        """
+
+        if binary_file_name is None:
+            binary_file_name = self.file_name + c_BINARY_COORDINATES_EXT
+        numeric_columns = [token for token in range(1, self.header_length)
+                           if token < len(self.type_header)
+                           and self.type_header[token] == c_TYPE_NUMERIC]
+        group_columns = [token for token in range(1, self.header_length)
+                         if token not in numeric_columns]
+        values = array.array("f")
+        group_codes = [array.array("I") for token in group_columns]
+        group_labels = [{} for token in group_columns]
+        cell_offsets = array.array("Q", [0])
+        cell_data = bytearray()
+
+        export_handle = self.csv_handle
+        # Need to skip the 2 header rows
+        next(export_handle)
+        next(export_handle)
+        for file_line in export_handle:
+            for token in numeric_columns:
+                try:
+                    values.append(float(file_line[token]))
+                except (ValueError, IndexError):
+                    values.append(float("nan"))
+            for codes, labels, token in zip(group_codes, group_labels, group_columns):
+                label = file_line[token] if token < len(file_line) else ""
+                codes.append(labels.setdefault(label, len(labels)))
+            cell_data.extend(file_line[0].encode("utf-8"))
+            cell_offsets.append(len(cell_data))
+
+        # Sections are aligned to 8 bytes from the start of the data
+        sections = [("values", np.frombuffer(values, dtype=np.float32).astype("<f4"))]
+        for codes, labels in zip(group_codes, group_labels):
+            code_type = "<u2" if len(labels) <= np.iinfo(np.uint16).max + 1 else "<u4"
+            sections.append(("codes", np.frombuffer(codes, dtype=np.uint32).astype(code_type)))
+        sections.append(("cell_offsets", np.frombuffer(cell_offsets, dtype=np.uint64).astype("<u8")))
+        sections.append(("cell_names", np.frombuffer(bytes(cell_data), dtype=np.uint8)))
+        layout = {"points": len(cell_offsets) - 1,
+                  "numeric_columns": [self.header[token] for token in numeric_columns],
+                  "group_columns": [self.header[token] for token in group_columns],
+                  "group_labels": [sorted(labels, key=labels.get) for labels in group_labels],
+                  "sections": []}
+        section_offset = 0
+        for section_name, section_data in sections:
+            layout["sections"].append({"name": section_name,
+                                       "dtype": section_data.dtype.str,
+                                       "offset": section_offset,
+                                       "count": len(section_data)})
+            section_offset += -(-section_data.nbytes // 8) * 8
+        layout_data = json.dumps(layout).encode("utf-8")
+        layout_data += b" " * (-(len(c_BINARY_COORDINATES_MAGIC) + 8 + len(layout_data)) % 8)
+        with open(binary_file_name, "wb") as binary_handle:
+            binary_handle.write(c_BINARY_COORDINATES_MAGIC)
+            binary_handle.write(np.array([c_BINARY_COORDINATES_VERSION, len(layout_data)],
+                                         dtype="<u4").tobytes())
+            binary_handle.write(layout_data)
+            for section_name, section_data in sections:
+                binary_handle.write(section_data.tobytes())
+                binary_handle.write(b"\0" * (-section_data.nbytes % 8))
+        return(binary_file_name)
+
+class DownsampleGrid:
+
+    def __init__(self, max_cells, reservoir_size, pool_size):
+        """
+        Grid of point counts and random row samples used to downsample
+        points. The cell width doubles when more than max_cells cells are
+        occupied. Each row gets a random priority; each cell keeps the
+        reservoir_size rows of smallest priority so sparse cells stay
+        represented, and a pool keeps the pool_size rows of smallest
+        priority overall, a uniform sample holding enough rows of dense
+        cells to sample them in proportion to their counts.
+        """
+        self.max_cells = max_cells
+        self.reservoir_size = reservoir_size
+        self.pool_size = pool_size
+        self.width = None
+        self.cells = {}
+        self.pool = []
+
+    def size_from_points(self, points):
+        """
+        Size the grid cells so the bounds of the given points
+        span about max_cells cells.
+        """
+        self.size_from_bounds([min(axis) for axis in zip(*points)],
+                              [max(axis) for axis in zip(*points)])
+
+    def size_from_bounds(self, minimums, maximums):
+        """
+        Size the grid cells so the given bounds span about max_cells cells.
+        """
+        extent = max([maximum - minimum for minimum, maximum in zip(minimums, maximums)] or [0.0])
+        cells_per_axis = max(1, int(math.ceil(self.max_cells ** (1.0 / max(1, len(minimums))))))
+        self.width = extent / cells_per_axis if extent > 0 else 1.0
+
+    def cell_key(self, point):
+        """
+        Grid cell holding a point.
+        """
+        if self.width is None:
+            return(())
+        return(tuple(int(math.floor(coordinate / self.width)) for coordinate in point))
+
+    def add(self, point, line_number, file_line):
+        """
+        Add a point and its row to the grid.
+        """
+        key = self.cell_key(point)
+        cell = self.cells.get(key)
+        if cell is None:
+            cell = self.cells[key] = [0, []]
+            if len(self.cells) > self.max_cells:
+                self.coarsen()
+                key = self.cell_key(point)
+                cell = self.cells[key]
+        cell[0] += 1
+        # Heaps on the negated priorities keep the smallest priorities
+        entry = (-random.random(), line_number, point, file_line)
+        self.add_to_heap(cell[1], entry, self.reservoir_size)
+        self.add_to_heap(self.pool, entry, self.pool_size)
+
+    def add_to_heap(self, heap, entry, heap_size):
+        """
+        Keep the heap_size entries with the smallest priorities.
+        """
+        if len(heap) < heap_size:
+            heapq.heappush(heap, entry)
+        elif entry[0] > heap[0][0]:
+            heapq.heapreplace(heap, entry)
+
+    def coarsen(self):
+        """
+        Double the cell width, merging the counts and reservoirs of cells
+        until no more than max_cells cells are occupied.
+        """
+        while len(self.cells) > self.max_cells:
+            self.width *= 2
+            merged_cells = {}
+            for key, cell in self.cells.items():
+                merged_key = tuple(index // 2 for index in key)
+                merged_cell = merged_cells.setdefault(merged_key, [0, []])
+                merged_cell[0] += cell[0]
+                for entry in cell[1]:
+                    self.add_to_heap(merged_cell[1], entry, self.reservoir_size)
+            self.cells = merged_cells
+
+    def sample(self, target_points):
+        """
+        Sample target_points rows across cells in proportion to their
+        point counts, as far as the sampled rows of each cell allow.
+        Returns the rows in their original order.
+        """
+        total_points = sum(cell[0] for cell in self.cells.values())
+        if not total_points:
+            return([])
+        target_points = min(target_points, total_points)
+        # Rows sampled in each cell, from the cell reservoir and the pool
+        available = dict((key, dict((entry[1], entry) for entry in cell[1]))
+                         for key, cell in self.cells.items())
+        for entry in self.pool:
+            available[self.cell_key(entry[2])][entry[1]] = entry
+        quotas = dict((key, cell[0] * target_points / total_points)
+                      for key, cell in self.cells.items())
+        taken = dict((key, min(int(quotas[key]), len(available[key])))
+                     for key in self.cells)
+        # Hand out the remaining points by largest unmet quota
+        remaining = target_points - sum(taken.values())
+        while remaining > 0:
+            open_cells = [key for key in self.cells
+                          if taken[key] < len(available[key])]
+            if not open_cells:
+                break
+            open_cells.sort(key=lambda key: quotas[key] - taken[key], reverse=True)
+            for key in open_cells[:remaining]:
+                taken[key] += 1
+                remaining -= 1
+        kept = []
+        for key, entries in available.items():
+            kept.extend(sorted(entries.values(), reverse=True)[:taken[key]])
+        return([entry[3] for entry in sorted(kept, key=lambda entry: entry[1])])
+
+class SpatialIndex:
+
+    def __init__(self, coordinates_file, points, cell_offsets, cell_data,
+                 row_offsets, metadata_file=None, metadata_offsets=None):
+        """
+        Uniform grid index over the points of a coordinates file answering
+        bounding box and radius queries. Points are ordered by grid cell
+        with the start of each cell kept, so a query only reads the cells
+        overlapping it. Rows are read back by their byte offsets.
+        Use SpatialIndex.build or CoordinatesFile.get_spatial_index.
+        """
+        self.coordinates_file = coordinates_file
+        self.metadata_file = metadata_file
+        self.points = points
+        self.cell_offsets = cell_offsets
+        self.cell_data = cell_data
+        self.row_offsets = row_offsets
+        self.metadata_offsets = metadata_offsets
+        dimensions = points.shape[1]
+        self.minimums = points.min(axis=0) if len(points) else np.zeros(dimensions)
+        extent = points.max(axis=0) - self.minimums if len(points) else np.zeros(dimensions)
+        self.cells_per_axis = max(1, int(math.ceil((len(points) / float(c_SPATIAL_INDEX_POINTS_PER_CELL))
+                                                   ** (1.0 / dimensions))))
+        self.widths = np.where(extent > 0, extent / self.cells_per_axis, 1.0)
+        grid_cells = self.grid_cells(points)
+        cell_ids = np.zeros(len(points), dtype=np.int64)
+        for axis in reversed(range(dimensions)):
+            cell_ids = cell_ids * self.cells_per_axis + grid_cells[:, axis]
+        self.order = np.argsort(cell_ids, kind="stable")
+        self.cell_starts = np.searchsorted(cell_ids[self.order],
+                                           np.arange(self.cells_per_axis ** dimensions + 1))
+
+    @classmethod
+    def build(cls, coordinates_file, metadata_file=None):
+        """
+        Build the index reading the coordinates file, and the
+        metadata file if given, once. Points with coordinates that
+        are not numbers are left out.
+        """
+        axes = [coordinates_file.header.index(axis)
+                for axis in coordinates_file.get_axis_names()]
+        values = array.array("d")
+        row_offsets = array.array("Q")
+        cell_offsets = array.array("Q", [0])
+        cell_data = bytearray()
+        cell_names = []
+        # Need to skip the 2 header rows
+        for row_offset, file_line in coordinates_file.iter_row_offsets(skip_rows=2):
+            try:
+                point = [float(file_line[axis]) for axis in axes]
+            except (ValueError, IndexError):
+                continue
+            if not all(math.isfinite(coordinate) for coordinate in point):
+                continue
+            values.extend(point)
+            row_offsets.append(row_offset)
+            cell_data.extend(file_line[0].encode("utf-8"))
+            cell_offsets.append(len(cell_data))
+            if metadata_file:
+                cell_names.append(file_line[0])
+        metadata_offsets = None
+        if metadata_file:
+            metadata_rows = dict((file_line[0], row_offset) for row_offset, file_line
+                                 in metadata_file.iter_row_offsets(skip_rows=2))
+            # Cells missing from the metadata file have no row
+            metadata_offsets = np.array([metadata_rows.get(cell_name, -1)
+                                         for cell_name in cell_names], dtype=np.int64)
+        return(cls(coordinates_file,
+                   np.frombuffer(values, dtype=np.float64).reshape(-1, len(axes)),
+                   np.frombuffer(cell_offsets, dtype=np.uint64),
+                   np.frombuffer(bytes(cell_data), dtype=np.uint8),
+                   np.frombuffer(row_offsets, dtype=np.uint64),
+                   metadata_file, metadata_offsets))
+
+    @classmethod
+    def load(cls, index_file_name, coordinates_file, metadata_file=None):
+        """
+        Load a saved index. Returns None if the index was saved
+        for other file contents, without the metadata file or for
+        another metadata file.
+        """
+        with np.load(index_file_name) as saved_index:
+            saved = dict(saved_index.items())
+        if saved["signature"].tolist() != file_signature_values(coordinates_file):
+            return(None)
+        metadata_offsets = None
+        if metadata_file:
+            if ("metadata_signature" not in saved or
+                    saved["metadata_file_name"].item() != metadata_file.file_name or
+                    saved["metadata_signature"].tolist() != file_signature_values(metadata_file)):
+                return(None)
+            metadata_offsets = saved["metadata_offsets"]
+        return(cls(coordinates_file, saved["points"], saved["cell_offsets"],
+                   saved["cell_data"], saved["row_offsets"],
+                   metadata_file, metadata_offsets))
+
+    def save(self, index_file_name):
+        """
+        Save the index so it does not need to be built again.
+        """
+        saved = {"signature": np.array(file_signature_values(self.coordinates_file)),
+                 "points": self.points,
+                 "cell_offsets": self.cell_offsets,
+                 "cell_data": self.cell_data,
+                 "row_offsets": self.row_offsets}
+        if self.metadata_file:
+            saved["metadata_file_name"] = np.array(self.metadata_file.file_name)
+            saved["metadata_signature"] = np.array(file_signature_values(self.metadata_file))
+            saved["metadata_offsets"] = self.metadata_offsets
+        # Write through a handle so numpy does not add its own extension
+        with open(index_file_name, "wb") as index_handle:
+            np.savez(index_handle, **saved)
+
+    def grid_cells(self, points):
+        """
+        Grid cell of each point along each axis.
+        """
+        return(np.clip(np.floor((points - self.minimums) / self.widths).astype(np.int64),
+                       0, self.cells_per_axis - 1))
+
+    def box_indices(self, minimums, maximums):
+        """
+        Indices of the points inside a bounding box.
+        """
+        minimums = np.asarray(minimums, dtype=np.float64)
+        maximums = np.asarray(maximums, dtype=np.float64)
+        if not len(self.points) or np.any(minimums > maximums):
+            return(np.array([], dtype=np.int64))
+        first_cells = self.grid_cells(minimums[np.newaxis, :])[0]
+        last_cells = self.grid_cells(maximums[np.newaxis, :])[0]
+        candidates = []
+        # Cells along the first axis are contiguous, so each combination
+        # of the other axes is one slice of the ordered points
+        for outer_cells in itertools.product(*[range(first_cells[axis], last_cells[axis] + 1)
+                                               for axis in reversed(range(1, len(first_cells)))]):
+            row_id = 0
+            for outer_cell in outer_cells:
+                row_id = row_id * self.cells_per_axis + outer_cell
+            first_id = row_id * self.cells_per_axis + first_cells[0]
+            last_id = row_id * self.cells_per_axis + last_cells[0]
+            candidates.append(self.order[self.cell_starts[first_id]:self.cell_starts[last_id + 1]])
+        if not candidates:
+            return(np.array([], dtype=np.int64))
+        candidates = np.sort(np.concatenate(candidates))
+        inside = np.all((self.points[candidates] >= minimums) &
+                        (self.points[candidates] <= maximums), axis=1)
+        return(candidates[inside])
+
+    def radius_indices(self, center, radius):
+        """
+        Indices of the points within a radius of a center.
+        """
+        center = np.asarray(center, dtype=np.float64)
+        candidates = self.box_indices(center - radius, center + radius)
+        distances = np.sum((self.points[candidates] - center) ** 2, axis=1)
+        return(candidates[distances <= radius ** 2])
+
+    def query_box(self, minimums, maximums, with_rows=False):
+        """
+        Cells with points inside a bounding box, given as the minimum
+        and maximum of each axis. See results for with_rows.
+        """
+        return(self.results(self.box_indices(minimums, maximums), with_rows))
+
+    def query_radius(self, center, radius, with_rows=False):
+        """
+        Cells with points within a radius of a center.
+        See results for with_rows.
+        """
+        return(self.results(self.radius_indices(center, radius), with_rows))
+
+    def results(self, indices, with_rows=False):
+        """
+        Cell names of the points at the indices, in file order.
+        With rows, a list of the cell name, its row in the coordinates
+        file and its metadata row (None without a metadata file or
+        if the cell is not in it) for each point.
+        """
+        cell_data = self.cell_data.tobytes()
+        cell_names = [cell_data[self.cell_offsets[index]:self.cell_offsets[index + 1]].decode("utf-8")
+                      for index in indices.tolist()]
+        if not with_rows:
+            return(cell_names)
+        rows = self.coordinates_file.read_rows_at(self.row_offsets[indices].tolist())
+        metadata_rows = [None] * len(indices)
+        if self.metadata_file:
+            metadata_offsets = self.metadata_offsets[indices]
+            found = metadata_offsets >= 0
+            found_rows = iter(self.metadata_file.read_rows_at(metadata_offsets[found].tolist()))
+            metadata_rows = [next(found_rows) if is_found else None for is_found in found.tolist()]
+        return([{"cell": cell_name, "row": row, "metadata": metadata_row}
+                for cell_name, row, metadata_row in zip(cell_names, rows, metadata_rows)])
+
+def file_signature_values(portal_file):
+    """
+    File signature of a portal file as a list of its size and modification time.
+    """
+    signature = portal_file.file_signature()
+    return([float(signature["size"]), float(signature["mtime"])])
+
+class BinaryCoordinates:
+
+    def __init__(self, binary_file_name):
+        """
+        Coordinates loaded from a file written by
+        CoordinatesFile.export_binary. The file is memory mapped and
+        its columns are read only NumPy views on it.
+        """
+        with open(binary_file_name, "rb") as binary_handle:
+            self.buffer = mmap.mmap(binary_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic_length = len(c_BINARY_COORDINATES_MAGIC)
+        if self.buffer[:magic_length] != c_BINARY_COORDINATES_MAGIC:
+            raise ValueError(binary_file_name + " is not a binary coordinates file.")
+        version, layout_length = np.frombuffer(self.buffer, dtype="<u4", count=2,
+                                               offset=magic_length)
+        if version != c_BINARY_COORDINATES_VERSION:
+            raise ValueError(" ".join([binary_file_name, "has the unsupported version",
+                                       str(version)]))
+        data_start = magic_length + 8 + int(layout_length)
+        layout = json.loads(self.buffer[magic_length + 8:data_start].decode("utf-8"))
+        sections = [np.frombuffer(self.buffer, dtype=section["dtype"],
+                                  count=section["count"],
+                                  offset=data_start + section["offset"])
+                    for section in layout["sections"]]
+        self.points = layout["points"]
+        self.numeric_columns = layout["numeric_columns"]
+        self.group_columns = layout["group_columns"]
+        self.group_labels = dict(zip(self.group_columns, layout["group_labels"]))
+        self.values = sections[0].reshape(self.points, len(self.numeric_columns))
+        self.group_codes = dict(zip(self.group_columns, sections[1:-2]))
+        self.cell_offsets = sections[-2]
+        self.cell_data = sections[-1]
+
+    def column(self, name):
+        """
+        Values of a numeric column.
+        """
+        return(self.values[:, self.numeric_columns.index(name)])
+
+    def cell_name(self, index):
+        """
+        Name of the cell at a row index.
+        """
+        return(self.cell_data[self.cell_offsets[index]:self.cell_offsets[index + 1]].tobytes().decode("utf-8"))
+
+    def cell_names(self):
+        """
+        Names of all cells, in file order.
+        """
+        cell_data = self.cell_data.tobytes()
+        return([cell_data[start:end].decode("utf-8")
+                for start, end in zip(self.cell_offsets[:-1].tolist(),
+                                      self.cell_offsets[1:].tolist())])
+
+def load_binary_coordinates(binary_file_name):
+    """
+    Load a file written by CoordinatesFile.export_binary.
+    """
+    return(BinaryCoordinates(binary_file_name))
+
 class ExpressionFile(ParentPortalFile):
 
     def __init__(self, file_name,
                  file_delimiter=c_DEFAULT_DELIM,
-                 demo_file_link=c_EXPRESSION_DEMO_LINK):
+                 demo_file_link=c_EXPRESSION_DEMO_LINK,
+                 cell_names_mode=c_CELL_NAMES_EXACT,
+                 check_duplicate_rows=False,
+                 profile_sparsity=False,
+                 lazy=False):
         """
         Represents an expression file holding measurements.
+        Checking duplicate rows fingerprints each row while checking the body.
+        Profiling sparsity counts the zeros while checking the body to
+        recommend the smallest format.
         Tested
         """
         ParentPortalFile.__init__(self, file_name,
                                   file_delimiter,
                                   has_type=False,
                                   expected_header=None,
-                                  demo_file_link=demo_file_link)
-        self.update_cell_names()
+                                  demo_file_link=demo_file_link,
+                                  cell_names_mode=cell_names_mode,
+                                  lazy=lazy)
+        if not lazy:
+            self.update_cell_names()
+        self.gene_names = None
+        self.gene_index = None
+        self.check_duplicate_rows = check_duplicate_rows
+        self.profile_sparsity = profile_sparsity
+        self.duplicate_genes = None
+        self.duplicate_rows = None
+        self.value_profile = None
 
     def add_expression_header_keyword(self):
         """
-        If the matrix is lacking a 0,0 element, add it.
+        If the matrix is lacking a 0,0 element, add it. Only the header
+        is rewritten, the rest of the file is copied as bytes in blocks,
+        so memory use stays the same for any size of matrix.
+        Returns the updated file name or None if no file was written.
         """
 
-        if self.header[0] != c_EXPRESSION_00_ELEMENT:
-            this_hndl = self.csv_handle
-            header = this_hndl.next()
-            row_1 = this_hndl.next()
-            if len(header) + 1 == len(row_1):
-                updated_file = self.create_safe_file_name(self.file_name)
-                print("Updating file to have the expression 0,0 element.")
-                print("Writing new file"+updated_file+", did not affect input files.")
-                self.header = [c_EXPRESSION_00_ELEMENT]+self.header
-                self.header_length = len(self.header)
-                with self.get_write_handle(updated_file) as hnld_correct:
-                    csv_correct = csv.writer(hnld_correct,delimiter=self.delimiter)
-                    csv_correct.writerow(self.header)
-                    csv_correct.writerow(row_1)
-                    csv_correct.writerows([row for row in this_hndl])
+        if self.header[0] == c_EXPRESSION_00_ELEMENT:
+            return(None)
+        with self.open_file("rb") as read_handle:
+            header_line = read_handle.readline()
+            row_1_line = read_handle.readline()
+            row_1 = next(csv.reader([row_1_line.decode("utf-8")], delimiter=self.delimiter))
+            if len(self.header) + 1 != len(row_1):
+                return(None)
+            updated_file = self.create_safe_file_name(self.file_name)
+            if updated_file is None:
+                return(None)
+            print("Updating file to have the expression 0,0 element.")
+            print("Writing new file"+updated_file+", did not affect input files.")
+            # Keep the line ending of the file
+            line_end = header_line[len(header_line.rstrip(b"\r\n")):]
+            updated_header = self.delimiter.join([c_EXPRESSION_00_ELEMENT] + self.header)
+            with self.get_write_handle(updated_file, "wb") as updated_handle:
+                updated_handle.write(updated_header.encode("utf-8") + line_end)
+                updated_handle.write(row_1_line)
+                shutil.copyfileobj(read_handle, updated_handle, c_GZIP_BLOCK_SIZE)
+        return(updated_file)
 
     def check_header(self):
         """
@@ -832,17 +3156,44 @@ class ExpressionFile(ParentPortalFile):
                             c_EXPRESSION_00_ELEMENT,
                             "but is was", self.header[0], "."]))
 
-    def check_body(self):
+    def check_body(self, rows=None):
         """
-        Check body of the file. If an error occurs set the object
+        Check body of the file, or the given rows in its place.
+        If an error occurs set the object
         indicate an error occured. (file_has_error attribute).
         Tested
         """
-        check_handle = self.csv_handle
-        # Need to skip the header
-        next(check_handle)
-        for file_line in check_handle:
+        if rows is None:
+            check_handle = self.csv_handle
+            # Need to skip the header
+            next(check_handle)
+        else:
+            check_handle = iter(rows)
+        # Keep the gene names so comparisons do not reread the file
+        gene_names = []
+        # Line of each gene and, if checking rows, of each row fingerprint
+        gene_lines = {}
+        row_lines = {}
+        duplicate_genes = collections.defaultdict(list)
+        duplicate_rows = {}
+        # Whether all values are integers, and their range
+        all_integer = True
+        minimum = math.inf
+        maximum = -math.inf
+        sparsity = SparsityProfile(self.header, self.delimiter) if self.profile_sparsity else None
+        # Rows start on the second line of the file
+        for row_line_number, file_line in enumerate(check_handle, 2):
             self.line_number += 1
+            gene_names.append(file_line[0])
+            first_line = gene_lines.setdefault(file_line[0], row_line_number)
+            if first_line != row_line_number:
+                duplicate_genes[file_line[0]].append(row_line_number)
+            if self.check_duplicate_rows:
+                row_hash = hashlib.blake2b(self.delimiter.join(file_line).encode("utf-8"),
+                                           digest_size=16).digest()
+                first_line = row_lines.setdefault(row_hash, row_line_number)
+                if first_line != row_line_number:
+                    duplicate_rows[row_line_number] = first_line
             if len(file_line) != self.header_length:
                 self.file_has_error = True
                 print(" ".join(["Error!\tLine: ",
@@ -851,25 +3202,293 @@ class ExpressionFile(ParentPortalFile):
                                 "columns but received",
                                 str(len(file_line)), "."]))
 
-            for token in file_line[1:]:
-                try:
-                    float(token)
-                except ValueError:
-                    self.file_has_error = True
-                    print(" ".join(["Error!\tLine: ",
-                                    str(self.line_number),
-                                    ". Unexpected value: ",
-                                    token, "."]))
+            try:
+                values = np.array(file_line[1:], dtype=np.float64)
+            except ValueError:
+                # Find the values that are not numbers to report them
+                for token in file_line[1:]:
+                    try:
+                        float(token)
+                    except ValueError:
+                        self.file_has_error = True
+                        print(" ".join(["Error!\tLine: ",
+                                        str(self.line_number),
+                                        ". Unexpected value: ",
+                                        token, "."]))
+            else:
+                if len(values):
+                    all_integer = all_integer and bool(np.all(values == np.floor(values)))
+                    minimum = min(minimum, float(np.min(values)))
+                    maximum = max(maximum, float(np.max(values)))
+                if sparsity and len(values) == sparsity.cell_count:
+                    sparsity.add_row(file_line, values)
             if self.line_number % c_REPORT_LINE_NUMBER_BLOCK == 0:
                 print("    Process update: Line " + str(self.line_number))
+        self.gene_names = gene_names
+        self.value_profile = self.make_value_profile(all_integer, minimum, maximum)
+        if sparsity:
+            gzip_size = os.path.getsize(self.file_name) if self.is_gzipped() else None
+            self.value_profile["sparsity"] = sparsity.to_dict(gzip_size)
+        if sparsity and not self.file_has_error:
+            sizes = self.value_profile["sparsity"]["projected_sizes"]
+            print(" ".join(["   ", self.file_name, "density",
+                            "{:.2%}".format(self.value_profile["sparsity"]["density"]) + ",",
+                            "projected sizes"] +
+                           [file_format + " " + str(sizes[file_format]) for file_format in c_FORMATS] +
+                           ["bytes, recommended format",
+                            self.value_profile["sparsity"]["recommended_format"]]))
+        self.duplicate_genes = {gene: [gene_lines[gene]] + lines
+                                for gene, lines in duplicate_genes.items()}
+        self.duplicate_rows = duplicate_rows if self.check_duplicate_rows else None
+        if self.duplicate_genes:
+            self.file_has_error = True
+            print(" ".join(["Error!\t",
+                            self.file_name,
+                            "file has duplicate gene names:"] + sorted(self.duplicate_genes)))
+        if self.duplicate_rows:
+            print(" ".join(["Warning!\t",
+                            self.file_name,
+                            "file has", str(len(self.duplicate_rows)),
+                            "rows identical to an earlier row."]))
+
+    def make_value_profile(self, all_integer, minimum, maximum):
+        """
+        Profile of the values of the matrix with the smallest dtype
+        holding them exactly: an unsigned integer type for non negative
+        integer counts, otherwise float64.
+        """
+        if maximum < minimum:
+            minimum = maximum = None
+        non_negative = minimum is None or minimum >= 0
+        dtype = "float64"
+        if all_integer and non_negative:
+            for integer_dtype in c_COUNT_DTYPES:
+                if maximum is None or maximum <= np.iinfo(integer_dtype).max:
+                    dtype = integer_dtype
+                    break
+        return({"integer": all_integer,
+                "non_negative": non_negative,
+                "minimum": minimum,
+                "maximum": maximum,
+                "dtype": dtype})
+
+    def get_value_profile(self):
+        """
+        Returns the value profile made when checking the body of the file,
+        or the profile saved in the sidecar of the file if it is current.
+        """
+        if self.value_profile is None:
+            self.value_profile = self.read_sidecar(c_VALUES_TAG)
+        return(self.value_profile)
+
+    def save_value_profile(self):
+        """
+        Save the value profile to a sidecar file so loaders can choose
+        a storage type without reading the file again.
+        Returns the sidecar file name or None if there is no profile.
+        """
+        if self.value_profile is None:
+            return(None)
+        return(self.write_sidecar(c_VALUES_TAG, self.value_profile))
+
+    def load_matrix(self):
+        """
+        Returns the gene names and the matrix of values, genes by cells.
+        The matrix is loaded from the matrix cache of the file if it is
+        current. Otherwise it is read from the file, stored with the dtype
+        of the value profile if there is one (such as uint16 for counts).
+        """
+        matrix_file_name = self.sidecar_file_name(c_MATRIX_TAG, c_MATRIX_CACHE_EXT)
+        if os.path.exists(matrix_file_name):
+            with np.load(matrix_file_name) as saved_matrix:
+                if saved_matrix["signature"].tolist() == file_signature_values(self):
+                    return(saved_matrix["genes"].tolist(), saved_matrix["matrix"])
+        value_profile = self.get_value_profile()
+        dtype = value_profile["dtype"] if value_profile else "float64"
+        matrix_handle = self.csv_handle
+        # Need to skip the header
+        next(matrix_handle)
+        gene_names = []
+        rows = []
+        for file_line in matrix_handle:
+            gene_names.append(file_line[0])
+            rows.append(np.array(file_line[1:], dtype=np.float64).astype(dtype))
+        matrix = np.vstack(rows) if rows else np.zeros((0, len(self.header) - 1), dtype=dtype)
+        return(gene_names, matrix)
+
+    def save_matrix_cache(self):
+        """
+        Save the matrix next to the file with the dtype of the value
+        profile so later loads neither parse text nor hold float64.
+        Returns the cache file name.
+        """
+        gene_names, matrix = self.load_matrix()
+        matrix_file_name = self.sidecar_file_name(c_MATRIX_TAG, c_MATRIX_CACHE_EXT)
+        # Write through a handle so numpy does not add its own extension
+        with open(matrix_file_name, "wb") as matrix_handle:
+            np.savez(matrix_handle,
+                     signature=np.array(file_signature_values(self)),
+                     genes=np.array(gene_names, dtype=str),
+                     matrix=matrix)
+        return(matrix_file_name)
+
+    def write_mtx(self):
+        """
+        Write the matrix as gzipped MTX entries, gene by cell, with gene
+        and barcode files. Returns the names of the files written.
+        """
+        value_profile = self.get_value_profile()
+        if value_profile and "sparsity" in value_profile:
+            nonzero_count = value_profile["sparsity"]["nonzero"]
+            gene_count = value_profile["sparsity"]["genes"]
+        else:
+            matrix_handle = self.csv_handle
+            # Need to skip the header
+            next(matrix_handle)
+            nonzero_count = 0
+            gene_count = 0
+            for file_line in matrix_handle:
+                nonzero_count += int(np.count_nonzero(np.array(file_line[1:], dtype=np.float64)))
+                gene_count += 1
+        file_base = split_file_name(self.file_name)[0]
+        mtx_files = {}
+        for file_tag in [c_MTX_MATRIX_POSTFIX, c_MTX_GENES_POSTFIX, c_MTX_BARCODES_POSTFIX]:
+            mtx_files[file_tag] = self.create_safe_file_name(file_base + file_tag)
+            if mtx_files[file_tag] is None:
+                return(None)
+        with self.get_write_handle(mtx_files[c_MTX_BARCODES_POSTFIX], gzipped=True) as barcodes_handle:
+            barcodes_handle.write("".join([cell_name + "\n" for cell_name in self.header[1:]]))
+        matrix_handle = self.csv_handle
+        # Need to skip the header
+        next(matrix_handle)
+        with self.get_write_handle(mtx_files[c_MTX_MATRIX_POSTFIX], gzipped=True) as mtx_handle, \
+                self.get_write_handle(mtx_files[c_MTX_GENES_POSTFIX], gzipped=True) as genes_handle:
+            mtx_handle.write(c_MTX_HEADER + "\n")
+            mtx_handle.write(" ".join([str(gene_count), str(len(self.header) - 1),
+                                       str(nonzero_count)]) + "\n")
+            for gene_number, file_line in enumerate(matrix_handle, 1):
+                genes_handle.write(file_line[0] + "\t" + file_line[0] + "\n")
+                values = np.array(file_line[1:], dtype=np.float64)
+                mtx_handle.write("".join([" ".join([str(gene_number), str(cell + 1), file_line[cell + 1]]) + "\n"
+                                          for cell in np.flatnonzero(values).tolist()]))
+        return([mtx_files[file_tag] for file_tag in [c_MTX_MATRIX_POSTFIX, c_MTX_GENES_POSTFIX,
+                                                      c_MTX_BARCODES_POSTFIX]])
+
+    def write_recommended_format(self):
+        """
+        Write the matrix in the format recommended by the sparsity profile
+        made when checking the body with sparsity profiled. Returns the names
+        of the files written, an empty list if the file is already in that
+        format, or None if there is no profile.
+        """
+        value_profile = self.get_value_profile()
+        if not value_profile or "sparsity" not in value_profile:
+            return(None)
+        recommended_format = value_profile["sparsity"]["recommended_format"]
+        if recommended_format == c_FORMAT_MTX_GZIP:
+            return(self.write_mtx())
+        if (recommended_format == c_FORMAT_DENSE_GZIP) == self.is_gzipped():
+            return([])
+        converted_file = self.create_safe_file_name(split_file_name(self.file_name)[0] +
+                                                    (c_GZIP_EXT if recommended_format == c_FORMAT_DENSE_GZIP
+                                                     else c_DENSE_EXT))
+        if converted_file is None:
+            return(None)
+        with self.open_file("rb") as file_handle, \
+                self.get_write_handle(converted_file, "wb",
+                                      gzipped=recommended_format == c_FORMAT_DENSE_GZIP) as converted_handle:
+            shutil.copyfileobj(file_handle, converted_handle)
+        return([converted_file])
+
+    def get_duplicate_report(self):
+        """
+        Returns the duplicates found while checking the body: the lines of
+        each duplicated gene, and if rows were fingerprinted the lines
+        identical to an earlier line with the line they repeat.
+        Duplicated genes whose rows are not all identical are conflicting.
+        """
+        if self.duplicate_genes is None:
+            return(None)
+        report = {"genes": self.duplicate_genes,
+                  "gene_count": len(self.duplicate_genes)}
+        if self.duplicate_rows is not None:
+            report["rows"] = self.duplicate_rows
+            report["row_count"] = len(self.duplicate_rows)
+            report["conflicting_genes"] = sorted(gene for gene, lines in self.duplicate_genes.items()
+                                                 if any(line not in self.duplicate_rows
+                                                        for line in lines[1:]))
+        return(report)
+
+    def write_deduplicated(self):
+        """
+        Write a copy of the file without the rows identical to an earlier
+        row, using the rows fingerprinted while checking the body.
+        Conflicting duplicate genes are kept. Returns the new file name.
+        """
+        if self.duplicate_rows is None:
+            print(" ".join(["Error!\tCheck the body of", self.file_name,
+                            "with duplicate rows checked before deduplicating."]))
+            return(None)
+        deduplicated_file = self.tag_file_name(c_DEDUPLICATED_POSTFIX)
+        if deduplicated_file is None:
+            return(None)
+        with self.open_file() as file_handle, self.get_write_handle(deduplicated_file) as deduplicated_handle:
+            for line_number, file_line in enumerate(file_handle, 1):
+                if line_number not in self.duplicate_rows:
+                    deduplicated_handle.write(file_line)
+        return(deduplicated_file)
 
     def update_cell_names(self):
         """
         Update cell names from file.
         Tested
         """
-        if not self.cell_names:
-            self.cell_names = self.header[1:self.header_length+1]
+        if not self._cell_names:
+            self.set_cell_names(self.iter_cell_names)
+
+    def iter_cell_names(self):
+        """
+        Stream the cell names of the file, given in the header.
+        """
+        return(iter(self.header[1:self.header_length+1]))
+
+    def new_portal_file(self, file_name):
+        """
+        Lazy portal file of the same type and options for a new file.
+        """
+        return(ExpressionFile(file_name,
+                              file_delimiter=self.delimiter,
+                              demo_file_link=self.demo_file,
+                              cell_names_mode=self.cell_names_mode,
+                              check_duplicate_rows=self.check_duplicate_rows,
+                              profile_sparsity=self.profile_sparsity,
+                              lazy=True))
+
+    def transform_rows(self, keep_cells=None, cell_names_change=None, transform_handle=None):
+        """
+        Stream the rows of the file, keeping only the columns of the
+        kept cells and renaming them through the cell names change.
+        Rows are read from the transform handle if given.
+        Returns the header row, the rows and the list of cell names.
+        """
+        if transform_handle is None:
+            transform_handle = self.csv_handle
+        header = next(transform_handle)
+        kept_columns = [column for column in range(1, len(header))
+                        if keep_cells is None or header[column] in keep_cells]
+        cell_names = [header[column] for column in kept_columns]
+        if cell_names_change is not None:
+            cell_names = [deidentified_cell_name(cell_name, cell_names_change)
+                          for cell_name in cell_names]
+        if keep_cells is None:
+            rows = transform_handle
+        else:
+            # Short rows are kept short for the check to report them
+            kept_columns = [0] + kept_columns
+            rows = ([file_line[column] for column in kept_columns
+                     if column < len(file_line)]
+                    for file_line in transform_handle)
+        return([[header[0]] + cell_names], rows, cell_names)
 
     def deidentify_cell_names(self, cell_names_change=None):
         """
@@ -890,11 +3509,9 @@ class ExpressionFile(ParentPortalFile):
                                                        str(len(cell_names_change))]))
         update_names.update(cell_names_change)
 
-        deid_file_pieces = self.file_name.split(".")
-        deid_file_name = deid_file_pieces[0]
-        deid_file_ext = ".".join(deid_file_pieces[1:])
+        deid_file_name, deid_file_ext = split_file_name(self.file_name)
         # New deidentified file, check to make sure it does not exist
-        new_deid_file = deid_file_name + c_DEID_POSTFIX + "." + deid_file_ext
+        new_deid_file = deid_file_name + c_DEID_POSTFIX + deid_file_ext
         new_deid_file = self.create_safe_file_name(new_deid_file)
 
         if new_deid_file is None:
@@ -915,7 +3532,7 @@ class ExpressionFile(ParentPortalFile):
             deid_file.write("\n".join(new_file_lines))
 
         # Write mapping file
-        with open(new_mapping_file, 'w') as map_file:
+        with self.get_write_handle(new_mapping_file) as map_file:
             map_file.write("\n".join(sorted([name_key+c_MAP_DELIM+name_value
                                       for name_key, name_value
                                       in update_names.items()])))
@@ -924,12 +3541,62 @@ class ExpressionFile(ParentPortalFile):
     def get_gene_names(self):
         """
         Returns the gene names in the file.
+        The file is read once, later calls reuse the names.
         Tested
         """
-        check_handle = self.csv_handle
-        # Need to skip the 2 header rows
-        next(check_handle)
-        return([file_line[0] for file_line in check_handle])
+        if self.gene_names is None:
+            check_handle = self.csv_handle
+            # Need to skip the header
+            next(check_handle)
+            self.gene_names = [file_line[0] for file_line in check_handle]
+        return(self.gene_names)
+
+    def get_gene_index(self):
+        """
+        Returns the set of gene names in the file for membership checks.
+        Uses the gene names already read, then the gene names sidecar
+        of the file if it is current and its genes match their digest,
+        and only then reads the file.
+        """
+        if self.gene_index is None:
+            if self.gene_names is None:
+                sidecar = self.read_sidecar(c_GENE_NAMES_TAG)
+                if sidecar and sidecar.get("digest") == gene_names_digest(sidecar["genes"]):
+                    self.gene_index = frozenset(sidecar["genes"])
+                elif sidecar:
+                    print("Note: Ignoring the gene names sidecar of " + self.file_name +
+                          " as its genes do not match their digest")
+            if self.gene_index is None:
+                self.gene_index = frozenset(self.get_gene_names())
+        return(self.gene_index)
+
+    def get_gene_digest(self):
+        """
+        Hash of the sorted unique gene names, matrices with
+        the same digest hold the same genes.
+        """
+        return(gene_names_digest(self.get_gene_index()))
+
+    def save_gene_names(self):
+        """
+        Save the sorted unique gene names and their digest to a sidecar
+        file so later comparisons do not need to read the matrix.
+        Returns the sidecar file name.
+        """
+        return(self.write_sidecar(c_GENE_NAMES_TAG,
+                                  {"genes": sorted(self.get_gene_index()),
+                                   "digest": self.get_gene_digest()}))
+
+    def get_gene_offsets(self):
+        """
+        Returns the byte offsets of the rows of each gene in the file
+        so rows can be read in any order without loading the matrix.
+        """
+        gene_offsets = {}
+        # Need to skip the header
+        for row_offset, file_line in self.iter_row_offsets(skip_rows=1):
+            gene_offsets.setdefault(file_line[0], []).append(row_offset)
+        return(gene_offsets)
 
     def subset_cells(self, keep_cells):
         """
@@ -956,3 +3623,177 @@ class ExpressionFile(ParentPortalFile):
             for file_line in check_handle:
                 csv_writer.writerow(list(itertools.compress(file_line,header_index)))
         return(subset_file_name)
+
+
+def deidentified_cell_name(cell_name, cell_names_change):
+    """
+    Deidentified name of a cell, giving cells not yet in the
+    cell names change the next cell id.
+    """
+    return(cell_names_change.setdefault(cell_name,
+                                        "_".join([c_CELL_ID,
+                                                  str(len(cell_names_change))])))
+
+class UnsortedGenesError(Exception):
+    """
+    Raised when an expression file expected to be sorted by gene is not.
+    """
+
+def merge_expression_files(expression_files, merged_file_name=None):
+    """
+    Merge expression files by cell columns, joining rows on gene name.
+    Files sorted by gene are combined with a streaming sorted merge,
+    otherwise rows are read through a gene index of each file.
+    Genes missing from a file are filled with zeros.
+    Return the merged file name or None if the files can not be merged.
+    """
+
+    if not expression_files:
+        return(None)
+
+    # Cell names are interned so the index holds one copy of each name
+    cell_index = {}
+    collisions = []
+    for file_number, expression_file in enumerate(expression_files):
+        expression_file.update_cell_names()
+        for cell_name in expression_file.cell_names:
+            cell_name = sys.intern(cell_name)
+            if cell_name in cell_index:
+                collisions.append(cell_name)
+            else:
+                cell_index[cell_name] = file_number
+    if collisions:
+        print(" ".join(["Error!\tCan not merge expression files,",
+                        "the following cell names are found in more",
+                        "than one file:"] + collisions))
+        return(None)
+
+    if merged_file_name is None:
+        merged_file_name = expression_files[0].tag_file_name(c_MERGE_POSTFIX)
+    elif os.path.exists(merged_file_name):
+        print(" ".join(["ERROR!\tThe merged file already exists.",
+                        "Please move or rename the file:",
+                        os.path.abspath(merged_file_name)]))
+        return(None)
+    if merged_file_name is None:
+        return(None)
+
+    try:
+        try:
+            write_merged_expression(expression_files, merged_file_name,
+                                    iter_sorted_gene_rows(expression_files))
+        except UnsortedGenesError as unsorted_error:
+            print(" ".join(["Note: The file", str(unsorted_error),
+                            "is not sorted by gene name,",
+                            "merging through a gene index instead."]))
+            write_merged_expression(expression_files, merged_file_name,
+                                    iter_indexed_gene_rows(expression_files))
+    except ValueError as merge_error:
+        print("Error!\t" + str(merge_error))
+        if os.path.exists(merged_file_name):
+            os.remove(merged_file_name)
+        return(None)
+    return(merged_file_name)
+
+def iter_sorted_gene_rows(expression_files):
+    """
+    Stream the rows of expression files sorted by gene, grouped by gene.
+    Yields the gene and a list of the value rows found in each file.
+    Raises UnsortedGenesError when a file is found to be out of order.
+    """
+
+    def gene_rows(expression_file, file_number):
+        gene_handle = expression_file.csv_handle
+        # Need to skip the header
+        next(gene_handle)
+        previous_gene = None
+        for file_line in gene_handle:
+            if previous_gene is not None and file_line[0] < previous_gene:
+                raise UnsortedGenesError(expression_file.file_name)
+            previous_gene = file_line[0]
+            yield (file_line[0], file_number, file_line[1:])
+
+    merged_rows = heapq.merge(*[gene_rows(expression_file, file_number)
+                                for file_number, expression_file
+                                in enumerate(expression_files)],
+                              key=lambda gene_row: gene_row[0])
+    for gene, gene_group in itertools.groupby(merged_rows,
+                                              key=lambda gene_row: gene_row[0]):
+        rows_by_file = [[] for expression_file in expression_files]
+        for gene_row in gene_group:
+            rows_by_file[gene_row[1]].append(gene_row[2])
+        yield (gene, rows_by_file)
+
+def iter_indexed_gene_rows(expression_files):
+    """
+    Read the rows of unsorted expression files in gene order through
+    a gene index of each file, grouped by gene.
+    Gzipped files are decompressed to a temporary file first, since
+    each seek in a gzipped file decompresses it again from the start.
+    Yields the gene and a list of the value rows found in each file.
+    """
+
+    gene_offsets = [expression_file.get_gene_offsets()
+                    for expression_file in expression_files]
+    read_handles = []
+    try:
+        for expression_file in expression_files:
+            if expression_file.is_gzipped():
+                read_handle = tempfile.TemporaryFile()
+                read_handles.append(read_handle)
+                with expression_file.open_file("rb") as gzip_handle:
+                    shutil.copyfileobj(gzip_handle, read_handle, c_GZIP_BLOCK_SIZE)
+            else:
+                read_handles.append(expression_file.open_file("rb"))
+        for gene in sorted(set().union(*gene_offsets)):
+            rows_by_file = []
+            for expression_file, read_handle, offsets in zip(expression_files,
+                                                             read_handles,
+                                                             gene_offsets):
+                gene_rows = []
+                for row_offset in offsets.get(gene, []):
+                    read_handle.seek(row_offset)
+                    file_line = read_handle.readline().decode("utf-8")
+                    gene_rows.append(next(csv.reader([file_line],
+                                     delimiter=expression_file.delimiter))[1:])
+                rows_by_file.append(gene_rows)
+            yield (gene, rows_by_file)
+    finally:
+        for read_handle in read_handles:
+            read_handle.close()
+
+def write_merged_expression(expression_files, merged_file_name, gene_rows):
+    """
+    Write merged expression rows, filling genes missing in a file with zeros.
+    The merged file is gzipped if its name ends in .gz.
+    Genes repeated within a file are written as repeated rows.
+    Raises ValueError when a row does not match its file's cell count.
+    """
+
+    cell_counts = [len(expression_file.cell_names)
+                   for expression_file in expression_files]
+    with expression_files[0].get_write_handle(merged_file_name,
+                                              gzipped=merged_file_name.endswith(".gz")) as merged_handle:
+        csv_writer = csv.writer(merged_handle,
+                                delimiter=expression_files[0].delimiter,
+                                lineterminator="\n")
+        csv_writer.writerow([c_EXPRESSION_00_ELEMENT] +
+                            [cell_name for expression_file in expression_files
+                             for cell_name in expression_file.cell_names])
+        for gene, rows_by_file in gene_rows:
+            for row_number in range(max(len(rows) for rows in rows_by_file)):
+                merged_row = [gene]
+                for expression_file, rows, cell_count in zip(expression_files,
+                                                             rows_by_file,
+                                                             cell_counts):
+                    if row_number < len(rows):
+                        if len(rows[row_number]) != cell_count:
+                            raise ValueError(" ".join(["Gene", gene, "in",
+                                             expression_file.file_name,
+                                             "has", str(len(rows[row_number])),
+                                             "values but the file has",
+                                             str(cell_count), "cells."]))
+                        merged_row.extend(rows[row_number])
+                    else:
+                        merged_row.extend([c_EXPRESSION_ZERO] * cell_count)
+                csv_writer.writerow(merged_row)
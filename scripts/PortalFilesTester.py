@@ -5,10 +5,16 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import gzip
+import io
+import json
 import os
 import PortalFiles
 import SortSparseMatrix
+import shutil
+import struct
 import unittest
+import zlib
 
 __author__ = "Timothy Tickle"
 __copyright__ = "Copyright 2016"
@@ -350,6 +356,56 @@ class CoordinatesFileTester(unittest.TestCase):
         self.assertTrue(compare_error,
                         "Should have reached an error state.")
 
+    def test_check_duplicate_cell_names_compact_with_duplicates(self):
+        """
+        Check duplicates cell names in file held as compact cell names.
+        """
+        test_file_name = os.path.join("test_files",
+                                      "coordinates_duplicates.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name,
+                                                cell_names_mode=PortalFiles.c_CELL_NAMES_COMPACT)
+        self.assertEqual(test_file.get_duplicates(list(test_file.cell_names)),
+                         test_file.cell_names.duplicates())
+        test_file.check_duplicate_cell_names()
+        self.assertTrue(test_file.file_has_error,
+                        " ".join(["There are 2 duplicates,",
+                                  "error detected."]))
+
+    def test_compare_cell_names_compact_for_incorrect_files(self):
+        """
+        Check comparing compact cell names to exact cell names,
+        this one with duplicate names.
+        """
+        test_file_name = os.path.join("test_files",
+                                      "coordinates_duplicates.txt")
+        test_file_name_2 = os.path.join("test_files", "metadata.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name,
+                                                cell_names_mode=PortalFiles.c_CELL_NAMES_COMPACT)
+        test_file_2 = PortalFiles.MetadataFile(test_file_name_2)
+        self.assertTrue(not test_file.compare_cell_names(test_file),
+                        "Should not have reached an error state.")
+        self.assertTrue(test_file.compare_cell_names(test_file_2),
+                        "Should have reached an error state.")
+
+    def test_compare_cell_names_bloom(self):
+        """
+        Check comparing cell names with Bloom filters,
+        for identical and duplicate names.
+        """
+        test_file = PortalFiles.CoordinatesFile(os.path.join("test_files", "coordinates.txt"),
+                                                cell_names_mode=PortalFiles.c_CELL_NAMES_BLOOM)
+        test_file_2 = PortalFiles.MetadataFile(os.path.join("test_files", "metadata.txt"),
+                                               cell_names_mode=PortalFiles.c_CELL_NAMES_BLOOM)
+        test_file_3 = PortalFiles.CoordinatesFile(os.path.join("test_files", "coordinates_duplicates.txt"),
+                                                  cell_names_mode=PortalFiles.c_CELL_NAMES_BLOOM)
+        self.assertTrue(not test_file.compare_cell_names(test_file_2),
+                        "Should not have reached an error state.")
+        self.assertTrue(test_file_3.compare_cell_names(test_file_2),
+                        "Should have reached an error state.")
+        self.assertEqual(test_file_3.get_duplicates(test_file_3.cell_names),
+                         test_file_3.cell_names.duplicates())
+        self.assertEqual(set(), test_file.cell_names.duplicates())
+
     def test_compare_cell_names_for_incorrect_compare_files(self):
         """
         Check comparing cell names for two files,
@@ -384,6 +440,58 @@ class CoordinatesFileTester(unittest.TestCase):
         self.assertTrue(names == names_after,
                         "Updated cell names are correct.")
 
+    def test_lazy_init(self):
+        """
+        Lazy files read the header and cell names when first needed.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name, lazy=True)
+        eager_file = PortalFiles.CoordinatesFile(test_file_name)
+        self.assertTrue(test_file._header is None and test_file._cell_names is None)
+        self.assertEqual(eager_file.header, test_file.header)
+        self.assertEqual(eager_file.type_header, test_file.type_header)
+        self.assertTrue(test_file._cell_names is None)
+        self.assertEqual(eager_file.cell_names, test_file.cell_names)
+        self.assertEqual(str(eager_file), str(test_file))
+
+    def test_peek(self):
+        """
+        Peeking reads the header rows and the first complete rows.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name, lazy=True)
+        file_peek = test_file.peek(peek_size=120)
+        self.assertTrue(not file_peek["complete"])
+        self.assertEqual(["NAME", "X", "Y", "Z", "Category", "Intensity"], file_peek["header"])
+        self.assertEqual(["CELL_0001", "34.472", "32.211", "60.035", "C", "0.719"], file_peek["rows"][0])
+        self.assertEqual(file_peek["header"], test_file._header)
+        self.assertEqual(file_peek["type_header"], test_file.type_header)
+        file_peek = test_file.peek()
+        self.assertTrue(file_peek["complete"])
+        self.assertEqual(15, len(file_peek["rows"]))
+
+    def test_peek_long_header(self):
+        """
+        Peeking reads on until the header is complete, up to the max peek size.
+        """
+        test_file_name = os.path.join("test_files", "expression_peek_test.txt")
+        cell_names = ["CELL_" + str(index) for index in range(5000)]
+        with open(test_file_name, "w") as test_handle:
+            test_handle.write("\t".join(["GENE"] + cell_names) + "\n")
+            test_handle.write("\t".join(["Itm2a"] + ["0"] * len(cell_names)) + "\n")
+        try:
+            file_peek = PortalFiles.ExpressionFile(test_file_name, lazy=True).peek()
+            cut_peek = PortalFiles.ExpressionFile(test_file_name, lazy=True).peek(max_peek_size=16384)
+        finally:
+            # Remove the test files
+            if(os.path.exists(test_file_name)):
+                os.remove(test_file_name)
+        self.assertFalse(file_peek["header_cut"])
+        self.assertEqual(len(cell_names) + 1, file_peek["header_length"])
+        self.assertTrue(cut_peek["header_cut"])
+        self.assertEqual(16384, cut_peek["peeked_size"])
+        self.assertIsNone(cut_peek["header"])
+
     def test_update_cell_names_from_init(self):
         """
         Update cell names from an init value.
@@ -402,6 +510,28 @@ class CoordinatesFileTester(unittest.TestCase):
         self.assertTrue(names == names_after,
                         "Updated cell names are correct.")
 
+    def test_transform_cells_subset(self):
+        """
+        Test subsetting cells in one pass writes the subset file
+        and checks it as it is written.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        correct_file = os.path.join("test_files",
+                                    "coordinates_subset_3_correct.txt")
+        keep_cells = ["CELL_0002","CELL_0005","CELL_0009"]
+        test_file = PortalFiles.CoordinatesFile(test_file_name)
+        transformed_file = test_file.transform_cells(keep_cells)
+        # Test files
+        pass_test = files_are_equivalent(file_path_1=transformed_file.file_name,
+                                         file_path_2=correct_file)
+        # Remove the test files
+        if(os.path.exists(transformed_file.file_name)):
+            os.remove(transformed_file.file_name)
+        self.assertTrue(pass_test, "Can not subset file.")
+        self.assertFalse(transformed_file.file_has_error)
+        self.assertEqual(transformed_file.cell_names, keep_cells)
+        self.assertEqual(transformed_file.summary["points"], 3)
+
     def test_subset_cells_one(self):
         """
         Test subset cells to 1 cell.
@@ -519,6 +649,208 @@ class CoordinatesFileTester(unittest.TestCase):
             os.remove(map_file_name)
         self.assertTrue(pass_test, "Can not deidentify file.")
 
+    def test_check_body_summary(self):
+        """
+        Check the summary made while checking the body.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name)
+        test_file.check_body()
+        summary = test_file.get_summary()
+        self.assertEqual(summary["points"], 15)
+        self.assertTrue(summary["has_z"])
+        self.assertEqual(summary["bounds"], {"X": [-52.966, 40.039],
+                                             "Y": [-53.645, 33.092],
+                                             "Z": [-60.369, 63.654]})
+        self.assertEqual(summary["labels"], {"Category": {"A": 5, "B": 6, "C": 4}})
+
+    def test_downsample_from_summary_sidecar(self):
+        """
+        Downsampling sizes its grid from a saved summary.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name)
+        test_file.check_body()
+        sidecar_file = test_file.save_summary()
+        sidecar_test_file = PortalFiles.CoordinatesFile(test_file_name)
+        downsample_return = sidecar_test_file.downsample(5)
+        summary = sidecar_test_file.summary
+        # Remove the test files
+        for file_name in [sidecar_file, downsample_return["name"],
+                          downsample_return["cells_file"]]:
+            if(os.path.exists(file_name)):
+                os.remove(file_name)
+        self.assertEqual(summary, test_file.summary)
+        self.assertEqual(len(downsample_return["cells"]), 5)
+
+    def test_downsample_grid(self):
+        """
+        Downsample to a subset of the rows and a matching cell list.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name)
+        downsample_return = test_file.downsample(5)
+        downsample_file = PortalFiles.CoordinatesFile(downsample_return["name"])
+        with open(downsample_return["cells_file"]) as cells_handle:
+            listed_cells = [line.strip() for line in cells_handle]
+        with open(downsample_return["name"], "rb") as downsample_handle:
+            downsample_bytes = downsample_handle.read()
+        original_rows = dict((row[0], row) for row in test_file.csv_handle)
+        downsample_rows = list(downsample_file.csv_handle)
+        # Remove the test files
+        for file_name in [downsample_return["name"], downsample_return["cells_file"]]:
+            if(os.path.exists(file_name)):
+                os.remove(file_name)
+        self.assertEqual(len(downsample_return["cells"]), 5)
+        self.assertEqual(listed_cells, downsample_return["cells"])
+        self.assertNotIn(b"\r", downsample_bytes)
+        self.assertEqual(downsample_file.cell_names, downsample_return["cells"])
+        self.assertEqual(downsample_rows[:2], [test_file.header, test_file.type_header])
+        for row in downsample_rows[2:]:
+            self.assertEqual(row, original_rows[row[0]])
+
+    def test_downsample_gzipped(self):
+        """
+        Downsampling a gzipped file writes gzipped files.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        gzip_file_name = os.path.join("test_files", "coordinates_gzip_test.txt.gz")
+        with open(test_file_name, "rb") as test_handle, gzip.open(gzip_file_name, "wb") as gzip_handle:
+            gzip_handle.write(test_handle.read())
+        test_file = PortalFiles.CoordinatesFile(gzip_file_name)
+        downsample_return = test_file.downsample(5)
+        with gzip.open(downsample_return["name"], "rt") as downsample_handle:
+            downsample_rows = list(PortalFiles.csv.reader(downsample_handle, delimiter="\t"))
+        with gzip.open(downsample_return["cells_file"], "rt") as cells_handle:
+            listed_cells = [line.strip() for line in cells_handle]
+        # Remove the test files
+        for file_name in [gzip_file_name, downsample_return["name"], downsample_return["cells_file"]]:
+            if(os.path.exists(file_name)):
+                os.remove(file_name)
+        self.assertEqual(downsample_rows[:2], [test_file.header, test_file.type_header])
+        self.assertEqual([row[0] for row in downsample_rows[2:]], downsample_return["cells"])
+        self.assertEqual(listed_cells, downsample_return["cells"])
+
+    def test_downsample_more_than_file(self):
+        """
+        Downsampling to more points than the file has keeps every row.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name)
+        downsample_return = test_file.downsample(100, method="random")
+        # Remove the test files
+        for file_name in [downsample_return["name"], downsample_return["cells_file"]]:
+            if(os.path.exists(file_name)):
+                os.remove(file_name)
+        self.assertEqual(downsample_return["cells"], test_file.cell_names)
+
+    def test_downsample_unknown_method(self):
+        """
+        Downsampling with an unknown method does not write files.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name)
+        self.assertTrue(test_file.downsample(5, method="kmeans") is None)
+
+    def test_export_binary(self):
+        """
+        Export to binary and load the same coordinates, labels and cells.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name)
+        binary_file_name = test_file.export_binary()
+        binary_coordinates = PortalFiles.load_binary_coordinates(binary_file_name)
+        rows = list(test_file.csv_handle)[2:]
+        try:
+            self.assertEqual(binary_coordinates.points, 15)
+            self.assertEqual(binary_coordinates.numeric_columns, ["X", "Y", "Z", "Intensity"])
+            self.assertEqual(binary_coordinates.cell_names(), test_file.cell_names)
+            self.assertEqual(binary_coordinates.cell_name(9), "CELL_00010")
+            self.assertEqual(binary_coordinates.column("Y").tolist(),
+                             PortalFiles.np.array([row[2] for row in rows],
+                                                  dtype=PortalFiles.np.float32).tolist())
+            labels = binary_coordinates.group_labels["Category"]
+            self.assertEqual([labels[code] for code in binary_coordinates.group_codes["Category"]],
+                             [row[4] for row in rows])
+        finally:
+            # Remove the test files
+            del binary_coordinates
+            if(os.path.exists(binary_file_name)):
+                os.remove(binary_file_name)
+
+    def test_spatial_index_box_query(self):
+        """
+        Box queries return the cells inside the box with their rows.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        test_metadata_file_name = os.path.join("test_files", "metadata.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name)
+        metadata_file = PortalFiles.MetadataFile(test_metadata_file_name)
+        spatial_index = test_file.get_spatial_index(metadata_file)
+        rows = list(test_file.csv_handle)[2:]
+        metadata_rows = dict((row[0], row) for row in metadata_file.csv_handle)
+        truth = [row[0] for row in rows
+                 if 10 <= float(row[1]) <= 40 and 10 <= float(row[2]) <= 35]
+        self.assertEqual(spatial_index.query_box([10, 10, -100], [40, 35, 100]), truth)
+        results = spatial_index.query_box([10, 10, -100], [40, 35, 100], with_rows=True)
+        self.assertEqual([result["row"] for result in results],
+                         [row for row in rows if row[0] in truth])
+        self.assertEqual([result["metadata"] for result in results],
+                         [metadata_rows[cell] for cell in truth])
+
+    def test_spatial_index_radius_query(self):
+        """
+        Radius queries return the cells within the radius.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name)
+        spatial_index = test_file.get_spatial_index()
+        rows = list(test_file.csv_handle)[2:]
+        center = [20.0, 30.0, 40.0]
+        truth = [row[0] for row in rows
+                 if sum((float(value) - axis) ** 2
+                        for value, axis in zip(row[1:4], center)) <= 20.0 ** 2]
+        self.assertEqual(spatial_index.query_radius(center, 20.0), truth)
+        self.assertEqual(spatial_index.query_radius(center, 0.1), [])
+
+    def test_spatial_index_saved(self):
+        """
+        A saved spatial index is loaded instead of built.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name)
+        index_file_name = test_file.save_spatial_index(test_file.get_spatial_index())
+        loaded_index = PortalFiles.CoordinatesFile(test_file_name).get_spatial_index()
+        box_cells = loaded_index.query_box([-60, -60, -70], [0, 0, 0])
+        # Remove the test files
+        if(os.path.exists(index_file_name)):
+            os.remove(index_file_name)
+        self.assertEqual(box_cells, ["CELL_0003", "CELL_0006", "CELL_0009",
+                                     "CELL_00012", "CELL_00013"])
+
+    def test_spatial_index_saved_other_metadata(self):
+        """
+        A saved spatial index is built again for a metadata file
+        it was not saved with.
+        """
+        test_file_name = os.path.join("test_files", "coordinates.txt")
+        test_file = PortalFiles.CoordinatesFile(test_file_name)
+        metadata_file = PortalFiles.MetadataFile(os.path.join("test_files", "metadata.txt"))
+        other_metadata_file = PortalFiles.MetadataFile(os.path.join("test_files", "metadata_duplicates.txt"))
+        index_file_name = test_file.save_spatial_index(test_file.get_spatial_index())
+        try:
+            without_metadata = PortalFiles.SpatialIndex.load(index_file_name, test_file, metadata_file)
+            test_file.save_spatial_index(test_file.get_spatial_index(metadata_file))
+            with_metadata = PortalFiles.SpatialIndex.load(index_file_name, test_file, metadata_file)
+            other_metadata = PortalFiles.SpatialIndex.load(index_file_name, test_file, other_metadata_file)
+        finally:
+            # Remove the test files
+            if(os.path.exists(index_file_name)):
+                os.remove(index_file_name)
+        self.assertIsNone(without_metadata)
+        self.assertIsNotNone(with_metadata)
+        self.assertIsNone(other_metadata)
+
 class ExpressionFileTester(unittest.TestCase):
     """
     Tests the expression file object.
@@ -740,6 +1072,140 @@ class ExpressionFileTester(unittest.TestCase):
         self.assertTrue(str_truth == str_received,
                         "Did not receive the expected gene names.")
 
+    def test_get_gene_names_read_once(self):
+        """
+        Gene names are kept after the first read and after checking the body.
+        """
+        test_file_name = os.path.join("test_files", "expression.txt")
+        test_file = PortalFiles.ExpressionFile(test_file_name)
+        gene_names = test_file.get_gene_names()
+        self.assertTrue(gene_names is test_file.get_gene_names(),
+                        "Gene names were read again.")
+        checked_file = PortalFiles.ExpressionFile(test_file_name)
+        checked_file.check_body()
+        self.assertEqual(checked_file.gene_names, gene_names)
+
+    def test_get_gene_index_from_sidecar(self):
+        """
+        The gene index is read from a saved gene names sidecar.
+        """
+        test_file_name = os.path.join("test_files", "expression.txt")
+        test_file = PortalFiles.ExpressionFile(test_file_name)
+        sidecar_file = test_file.save_gene_names()
+        sidecar_test_file = PortalFiles.ExpressionFile(test_file_name)
+        gene_index = sidecar_test_file.get_gene_index()
+        gene_names = sidecar_test_file.gene_names
+        # Remove the test files
+        if(os.path.exists(sidecar_file)):
+            os.remove(sidecar_file)
+        self.assertTrue(gene_names is None, "Matrix was read instead of the sidecar.")
+        self.assertEqual(gene_index, frozenset(test_file.get_gene_names()))
+
+    def test_get_gene_index_sidecar_digest(self):
+        """
+        A gene names sidecar whose genes do not match their digest is not used.
+        """
+        test_file_name = os.path.join("test_files", "expression.txt")
+        test_file = PortalFiles.ExpressionFile(test_file_name)
+        sidecar_file = test_file.write_sidecar(PortalFiles.c_GENE_NAMES_TAG,
+                                               {"genes": ["Gene_0"],
+                                                "digest": test_file.get_gene_digest()})
+        sidecar_test_file = PortalFiles.ExpressionFile(test_file_name)
+        gene_index = sidecar_test_file.get_gene_index()
+        gene_names = sidecar_test_file.gene_names
+        # Remove the test files
+        if(os.path.exists(sidecar_file)):
+            os.remove(sidecar_file)
+        self.assertFalse(gene_names is None, "The sidecar was used instead of reading the matrix.")
+        self.assertEqual(gene_index, frozenset(test_file.get_gene_names()))
+
+    def test_check_stream_gzipped(self):
+        """
+        Test checking a gzipped matrix read once from a stream.
+        """
+        test_file_name = os.path.join("test_files", "expression.txt")
+        with open(test_file_name, "rb") as test_handle:
+            stream = io.BytesIO(gzip.compress(test_handle.read()))
+        checked_file = PortalFiles.ExpressionFile(test_file_name)
+        checked_file.check()
+        stream_file = PortalFiles.ExpressionFile(PortalFiles.c_STREAM_FILE_NAME, lazy=True)
+        stream_file.check_stream(stream)
+        self.assertTrue(stream_file.is_stream())
+        self.assertFalse(stream_file.file_has_error)
+        self.assertEqual(stream_file.cell_names, checked_file.cell_names)
+        self.assertEqual(stream_file.gene_names, checked_file.gene_names)
+
+    def test_add_expression_header_keyword(self):
+        """
+        Test the 0,0 element is added to the header, copying the rest.
+        """
+        test_file_name = os.path.join("test_files", "expression_keyword_test.txt")
+        with open(test_file_name, "w") as test_handle:
+            test_handle.write("CELL_1\tCELL_2\nItm2a\t0\t1\nSergef\t7.092\t0\n")
+        test_file = PortalFiles.ExpressionFile(test_file_name, lazy=True)
+        updated_file_name = test_file.add_expression_header_keyword()
+        with open(updated_file_name) as updated_handle:
+            updated = updated_handle.read()
+        # Remove the test files
+        for test_output in [test_file_name, updated_file_name]:
+            if(os.path.exists(test_output)):
+                os.remove(test_output)
+        self.assertEqual(updated, "GENE\tCELL_1\tCELL_2\nItm2a\t0\t1\nSergef\t7.092\t0\n")
+
+    def test_add_expression_header_keyword_gzipped(self):
+        """
+        Test the 0,0 element is added to the header of a gzipped file.
+        """
+        test_file_name = os.path.join("test_files", "expression_keyword_test.txt.gz")
+        with gzip.open(test_file_name, "wt") as test_handle:
+            test_handle.write("CELL_1\tCELL_2\nItm2a\t0\t1\n")
+        test_file = PortalFiles.ExpressionFile(test_file_name, lazy=True)
+        updated_file_name = test_file.add_expression_header_keyword()
+        with gzip.open(updated_file_name, "rt") as updated_handle:
+            updated = updated_handle.read()
+        # Remove the test files
+        for test_output in [test_file_name, updated_file_name]:
+            if(os.path.exists(test_output)):
+                os.remove(test_output)
+        self.assertEqual(updated, "GENE\tCELL_1\tCELL_2\nItm2a\t0\t1\n")
+        self.assertIsNone(PortalFiles.ExpressionFile(os.path.join("test_files", "expression.txt"),
+                                                     lazy=True).add_expression_header_keyword())
+
+    def test_transform_cells_subset_deidentify(self):
+        """
+        Test subsetting and deidentifying cells in one pass,
+        sharing the cell names mapping with another file.
+        """
+        test_file_name = os.path.join("test_files", "expression.txt")
+        metadata_file_name = os.path.join("test_files", "metadata.txt")
+        keep_cells = ["CELL_0002","CELL_0004","CELL_0006","CELL_0008"]
+        cell_names_change = {}
+        test_file = PortalFiles.ExpressionFile(test_file_name)
+        transformed_file = test_file.transform_cells(keep_cells, cell_names_change)
+        metadata_file = PortalFiles.MetadataFile(metadata_file_name)
+        transformed_metadata = metadata_file.transform_cells(keep_cells, cell_names_change)
+        map_file_name = transformed_file.write_cell_names_mapping(cell_names_change)
+        with open(transformed_file.file_name) as transformed_handle:
+            header = transformed_handle.readline().strip().split("\t")
+            row_1 = transformed_handle.readline().strip().split("\t")
+        with open(map_file_name) as map_handle:
+            mappings = map_handle.read().split("\n")
+        # Remove the test files
+        for test_output in [transformed_file.file_name,
+                            transformed_metadata.file_name,
+                            map_file_name]:
+            if(os.path.exists(test_output)):
+                os.remove(test_output)
+        self.assertTrue(PortalFiles.c_SUBSET_POSTFIX + PortalFiles.c_DEID_POSTFIX
+                        in transformed_file.file_name)
+        self.assertEqual(header, ["GENE", "cell_0", "cell_1", "cell_2", "cell_3"])
+        self.assertEqual(row_1, ["Itm2a", "0", "0", "0", "0"])
+        self.assertFalse(transformed_file.file_has_error)
+        self.assertEqual(list(transformed_file.cell_names), header[1:])
+        self.assertEqual(sorted(transformed_metadata.cell_names),
+                         sorted(transformed_file.cell_names))
+        self.assertEqual(mappings[0], "CELL_0002" + PortalFiles.c_MAP_DELIM + "cell_0")
+
     def test_subset_cells_one(self):
         """
         Test subset cells to 1 cell.
@@ -776,6 +1242,154 @@ class ExpressionFileTester(unittest.TestCase):
             os.remove(subset_file_name)
         self.assertTrue(pass_test, "Can not subset file.")
 
+    def test_check_body_duplicate_genes(self):
+        """
+        Duplicate genes are an error, rows are only fingerprinted if asked.
+        """
+        test_file_name = os.path.join("test_files", "expression_duplicates.txt")
+        test_file = PortalFiles.ExpressionFile(test_file_name)
+        test_file.check_body()
+        self.assertTrue(test_file.file_has_error, "Should have reached an error state.")
+        self.assertEqual({"Sergef": [3, 5], "Itm2a": [2, 8]}, test_file.duplicate_genes)
+        self.assertTrue("rows" not in test_file.get_duplicate_report())
+        self.assertTrue(test_file.write_deduplicated() is None)
+        test_file = PortalFiles.ExpressionFile(os.path.join("test_files", "expression.txt"))
+        test_file.check_body()
+        self.assertTrue(not test_file.file_has_error, "Should not have reached an error state.")
+        self.assertEqual({}, test_file.duplicate_genes)
+
+    def test_value_profile_counts(self):
+        """
+        Integer counts are loaded and cached as unsigned integers.
+        """
+        test_file_name = os.path.join("test_files", "expression_merge_sorted_1.txt")
+        test_file = PortalFiles.ExpressionFile(test_file_name)
+        test_file.check_body()
+        value_profile = test_file.get_value_profile()
+        self.assertTrue(value_profile["integer"])
+        self.assertEqual("uint16", value_profile["dtype"])
+        sidecar_file = test_file.save_value_profile()
+        matrix_file = test_file.save_matrix_cache()
+        gene_names, matrix = PortalFiles.ExpressionFile(test_file_name).load_matrix()
+        cached_value_profile = PortalFiles.ExpressionFile(test_file_name).get_value_profile()
+        # Remove the test files
+        for generated_file in [sidecar_file, matrix_file]:
+            if os.path.exists(generated_file):
+                os.remove(generated_file)
+        self.assertEqual(value_profile, cached_value_profile)
+        self.assertEqual(test_file.get_gene_names(), gene_names)
+        self.assertEqual(PortalFiles.np.uint16, matrix.dtype)
+        self.assertEqual(value_profile["maximum"], matrix.max())
+
+    def test_value_profile_measurements(self):
+        """
+        Matrices with fractional values keep float64.
+        """
+        test_file = PortalFiles.ExpressionFile(os.path.join("test_files", "expression.txt"))
+        test_file.check_body()
+        value_profile = test_file.get_value_profile()
+        self.assertTrue(not value_profile["integer"])
+        self.assertEqual("float64", value_profile["dtype"])
+        gene_names, matrix = test_file.load_matrix()
+        self.assertEqual(PortalFiles.np.float64, matrix.dtype)
+        self.assertEqual((len(gene_names), 15), matrix.shape)
+        self.assertEqual(value_profile["maximum"], matrix.max())
+
+    def test_sparsity_profile(self):
+        """
+        Zeros are counted per gene and the smallest format is recommended.
+        """
+        test_file = PortalFiles.ExpressionFile(os.path.join("test_files", "expression.txt"),
+                                               profile_sparsity=True)
+        test_file.check_body()
+        gene_names, matrix = test_file.load_matrix()
+        sparsity = test_file.get_value_profile()["sparsity"]
+        self.assertEqual(PortalFiles.np.count_nonzero(matrix, axis=1).tolist(),
+                         sparsity["gene_nonzeros"])
+        self.assertEqual([matrix.size - PortalFiles.np.count_nonzero(matrix)], sparsity["block_zeros"])
+        self.assertEqual(PortalFiles.np.count_nonzero(matrix) / matrix.size, sparsity["density"])
+        sizes = sparsity["projected_sizes"]
+        # The projection ends the last line with a new line, the file does not
+        self.assertEqual(os.path.getsize(test_file.file_name) + 1, sizes[PortalFiles.c_FORMAT_DENSE_TSV])
+        self.assertEqual(min(sizes, key=sizes.get), sparsity["recommended_format"])
+
+    def test_sparsity_not_profiled_by_default(self):
+        """
+        Sparsity is only profiled when asked.
+        """
+        test_file = PortalFiles.ExpressionFile(os.path.join("test_files", "expression.txt"))
+        check_output = io.StringIO()
+        with PortalFiles.contextlib.redirect_stdout(check_output):
+            test_file.check_body()
+        self.assertNotIn("sparsity", test_file.get_value_profile())
+        self.assertNotIn("density", check_output.getvalue())
+        self.assertIsNone(test_file.write_recommended_format())
+
+    def test_write_mtx_dotted_directory(self):
+        """
+        MTX files are named after the file, not cut at dots in directory names.
+        """
+        test_dir = os.path.join("test_files", "v1.2")
+        os.makedirs(test_dir)
+        test_file_name = os.path.join(test_dir, "expression.txt")
+        shutil.copy(os.path.join("test_files", "expression.txt"), test_file_name)
+        try:
+            mtx_files = PortalFiles.ExpressionFile(test_file_name).write_mtx()
+        finally:
+            shutil.rmtree(test_dir)
+        self.assertEqual([os.path.dirname(mtx_file) for mtx_file in mtx_files],
+                         [os.path.abspath(test_dir)] * 3)
+        self.assertTrue(all(os.path.basename(mtx_file).startswith("expression_")
+                            for mtx_file in mtx_files))
+
+    def test_write_mtx(self):
+        """
+        MTX entries hold the nonzero values by gene and cell.
+        """
+        test_file = PortalFiles.ExpressionFile(os.path.join("test_files", "expression.txt"))
+        test_file.check_body()
+        gene_names, matrix = test_file.load_matrix()
+        mtx_files = test_file.write_mtx()
+        with PortalFiles.gzip.open(mtx_files[0], "rt") as mtx_handle:
+            mtx_lines = mtx_handle.read().splitlines()
+        with PortalFiles.gzip.open(mtx_files[1], "rt") as genes_handle:
+            mtx_genes = [gene_line.split("\t")[0] for gene_line in genes_handle.read().splitlines()]
+        with PortalFiles.gzip.open(mtx_files[2], "rt") as barcodes_handle:
+            mtx_barcodes = barcodes_handle.read().splitlines()
+        # Remove the test files
+        for mtx_file in mtx_files:
+            if os.path.exists(mtx_file):
+                os.remove(mtx_file)
+        self.assertEqual(PortalFiles.c_MTX_HEADER, mtx_lines[0])
+        self.assertEqual([len(gene_names), 15, PortalFiles.np.count_nonzero(matrix)],
+                         [int(size) for size in mtx_lines[1].split(" ")])
+        mtx_matrix = PortalFiles.np.zeros(matrix.shape)
+        for entry in mtx_lines[2:]:
+            gene, cell, value = entry.split(" ")
+            mtx_matrix[int(gene) - 1, int(cell) - 1] = float(value)
+        self.assertTrue(PortalFiles.np.array_equal(matrix, mtx_matrix))
+        self.assertEqual(gene_names, mtx_genes)
+        self.assertEqual(list(test_file.cell_names), mtx_barcodes)
+
+    def test_write_deduplicated(self):
+        """
+        Rows identical to an earlier row are dropped, conflicting genes kept.
+        """
+        test_file_name = os.path.join("test_files", "expression_duplicates.txt")
+        correct_file = os.path.join("test_files", "expression_deduplicated_correct.txt")
+        test_file = PortalFiles.ExpressionFile(test_file_name, check_duplicate_rows=True)
+        test_file.check_body()
+        report = test_file.get_duplicate_report()
+        self.assertEqual({5: 3}, report["rows"])
+        self.assertEqual(["Itm2a"], report["conflicting_genes"])
+        deduplicated_file_name = test_file.write_deduplicated()
+        pass_test = files_are_equivalent(file_path_1=deduplicated_file_name,
+                                         file_path_2=correct_file)
+        # Remove the test files
+        if(os.path.exists(deduplicated_file_name)):
+            os.remove(deduplicated_file_name)
+        self.assertTrue(pass_test, "Can not deduplicate file.")
+
 class MetadataFileTester(unittest.TestCase):
     """
     Tests the Metadata File object.
@@ -1070,6 +1684,23 @@ class MetadataFileTester(unittest.TestCase):
         self.assertTrue(truth_str == received_str,
                         "Did not receive the expected labels.")
 
+    def test_check_stream(self):
+        """
+        Test checking a file read once from a stream, finding
+        its cell names and errors in the one pass.
+        """
+        test_file_name = os.path.join("test_files", "metadata_duplicates.txt")
+        with open(test_file_name, "rb") as test_handle:
+            stream = io.BytesIO(test_handle.read())
+        checked_file = PortalFiles.MetadataFile(test_file_name)
+        checked_file.check()
+        stream_file = PortalFiles.MetadataFile(PortalFiles.c_STREAM_FILE_NAME, lazy=True)
+        stream_file.check_stream(stream)
+        self.assertEqual(stream_file.file_name, PortalFiles.c_STREAM_FILE_NAME)
+        self.assertTrue(stream_file.file_has_error)
+        self.assertEqual(stream_file.cell_names, checked_file.cell_names)
+        self.assertEqual(stream_file.profile, checked_file.profile)
+
     def test_subset_cells_one(self):
         """
         Test subset cells to 1 cell.
@@ -1106,6 +1737,250 @@ class MetadataFileTester(unittest.TestCase):
             os.remove(subset_file_name)
         self.assertTrue(pass_test, "Can not subset file.")
 
+    def test_check_body_profile(self):
+        """
+        Check the column profile made while checking the body.
+        """
+        test_file_name = os.path.join("test_files", "metadata.txt")
+        test_file = PortalFiles.MetadataFile(test_file_name)
+        test_file.check_body()
+        profile = test_file.get_profile()
+        columns = dict((column["name"], column) for column in profile["columns"])
+        self.assertEqual(profile["rows"], 15)
+        self.assertEqual(columns["Cluster"]["labels"],
+                         {"CLST_A": 5, "CLST_B": 5, "CLST_C": 5})
+        self.assertEqual(columns["Sub-Cluster"]["cardinality"], 6)
+        self.assertEqual(columns["Average Intensity"]["min"], -13.745)
+        self.assertEqual(columns["Average Intensity"]["max"], 9.652)
+        self.assertEqual(columns["Average Intensity"]["nan"], 0)
+
+    def test_get_labels_from_profile_sidecar(self):
+        """
+        Labels are read from a saved profile without rereading the file.
+        """
+        test_file_name = os.path.join("test_files", "metadata.txt")
+        truth = ["CLST_A", "CLST_B", "CLST_C",
+                 "CLST_A_1", "CLST_A_2", "CLST_B_1",
+                 "CLST_B_2", "CLST_C_1", "CLST_C_2"]
+        test_file = PortalFiles.MetadataFile(test_file_name)
+        test_file.check_body()
+        sidecar_file = test_file.save_profile()
+        sidecar_test_file = PortalFiles.MetadataFile(test_file_name)
+        profile = sidecar_test_file.get_profile()
+        received_labels = sidecar_test_file.get_labels()
+        # Remove the test files
+        if(os.path.exists(sidecar_file)):
+            os.remove(sidecar_file)
+        self.assertEqual(profile, test_file.profile)
+        self.assertEqual(sorted(truth), sorted(received_labels))
+
+    def test_get_labels_missing_values(self):
+        """
+        Labels from the profile keep NA and empty labels as read from
+        the file, and the file is read again above the cardinality limit.
+        """
+        test_file_name = os.path.join("test_files", "metadata_labels_test.txt")
+        with open(test_file_name, "w") as test_handle:
+            test_handle.write("\n".join(["NAME\tCluster\tSub-Cluster",
+                                         "TYPE\tgroup\tgroup",
+                                         "CELL_0001\tCLST_A\tNA",
+                                         "CELL_0002\t\tCLST_B_1",
+                                         "CELL_0003\tCLST_B\tCLST_B_2"]) + "\n")
+        try:
+            file_labels = PortalFiles.MetadataFile(test_file_name).get_labels()
+            test_file = PortalFiles.MetadataFile(test_file_name)
+            test_file.check_body()
+            profile_labels = test_file.get_labels()
+            limited_file = PortalFiles.MetadataFile(test_file_name, cardinality_limit=1)
+            limited_file.check_body()
+            limited_labels = limited_file.get_labels()
+        finally:
+            # Remove the test files
+            if(os.path.exists(test_file_name)):
+                os.remove(test_file_name)
+        self.assertEqual(sorted(["CLST_A", "CLST_B", "", "NA", "CLST_B_1", "CLST_B_2"]),
+                         sorted(file_labels))
+        self.assertEqual(sorted(file_labels), sorted(profile_labels))
+        self.assertIsNone(limited_file.profile["columns"][0]["labels"])
+        self.assertEqual(sorted(file_labels), sorted(limited_labels))
+
+    def test_check_convention(self):
+        """
+        Check files against the compiled convention, cached by its contents.
+        """
+        convention_file_name = os.path.join("tests", "data", "alexandria_convention_schema_2.1.0.json")
+        cache_dir = os.path.join("test_files", "convention_cache")
+        content_hash = PortalFiles.file_content_hash(convention_file_name)
+        with open(convention_file_name) as convention_handle:
+            convention_schema = PortalFiles.load_convention_schema(json.load(convention_handle),
+                                                                   content_hash=content_hash,
+                                                                   cache_dir=cache_dir)
+        cached_schema = PortalFiles.load_convention_schema(content_hash=content_hash, cache_dir=cache_dir)
+        missing_schema = PortalFiles.load_convention_schema(content_hash="0" * 64, cache_dir=cache_dir)
+        # Remove the test files
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        self.assertEqual("2.1.0", convention_schema.version)
+        self.assertEqual(convention_schema.to_dict(), cached_schema.to_dict())
+        self.assertTrue(missing_schema is None)
+        test_file = PortalFiles.MetadataFile(os.path.join("tests", "data", "valid_array_v2.1.2.txt"))
+        issues = test_file.check_convention(cached_schema)
+        self.assertTrue(not test_file.file_has_error, "Should not have reached an error state.")
+        self.assertEqual({"version": "2.1.0", "header": [], "columns": {}}, issues)
+        test_file = PortalFiles.MetadataFile(os.path.join("tests", "data", "invalid_array_v1.1.3.tsv"))
+        issues = test_file.check_convention(cached_schema)
+        self.assertTrue(test_file.file_has_error, "Should have reached an error state.")
+        self.assertEqual(["missing required columns biosample_type",
+                          "column organism_age should have the type numeric"], issues["header"])
+        self.assertEqual({"non boolean": {"count": 2, "examples": [[4, "F"], [5, "T|F"]]}},
+                         issues["columns"]["disease__treated"])
+        self.assertEqual(2, issues["columns"]["disease__time_since_onset"]["non numeric"]["count"])
+
+    def test_convention_cache_edited_schema(self):
+        """
+        An edited convention with the same id is compiled again,
+        and integer columns only take whole numbers.
+        """
+        cache_dir = os.path.join("test_files", "convention_cache")
+        convention = {"$id": "https://example.org/alexandria_convention/2.1.0/json",
+                      "properties": {"organism_age": {"type": "number"}}}
+        edited_convention = {"$id": convention["$id"],
+                             "properties": {"organism_age": {"type": "integer"}}}
+        try:
+            convention_schema = PortalFiles.load_convention_schema(convention, cache_dir=cache_dir)
+            edited_schema = PortalFiles.load_convention_schema(edited_convention, cache_dir=cache_dir)
+            unknown_schema = PortalFiles.load_convention_schema({"properties": {}}, cache_dir=cache_dir)
+            cached_files = os.listdir(cache_dir)
+        finally:
+            # Remove the test files
+            if os.path.exists(cache_dir):
+                shutil.rmtree(cache_dir)
+        self.assertEqual(len(cached_files), 3)
+        self.assertEqual("unknown", unknown_schema.version)
+        self.assertEqual("number", convention_schema.columns["organism_age"]["type"])
+        column_check = edited_schema.columns["organism_age"]
+        self.assertEqual("integer", column_check["type"])
+        self.assertEqual("", edited_schema.check_value("organism_age", column_check, "12"))
+        self.assertEqual("non integer", edited_schema.check_value("organism_age", column_check, "12.5"))
+        self.assertEqual("non numeric", edited_schema.check_value("organism_age", column_check, "twelve"))
+
+class ColumnProfileTester(unittest.TestCase):
+    """
+    Tests profiling columns.
+    """
+
+    def test_cardinality_estimate(self):
+        """
+        Cardinality is estimated once the exact limit is passed.
+        """
+        column_profile = PortalFiles.ColumnProfile("Barcode", PortalFiles.c_TYPE_GROUP,
+                                                   cardinality_limit=100)
+        for block in range(4):
+            column_profile.add_labels(["CELL_" + str(value) for value in range(block * 2500, 10000)])
+        summary = column_profile.to_dict()
+        self.assertTrue(summary["cardinality_is_estimate"])
+        self.assertTrue(summary["labels"] is None)
+        self.assertTrue(abs(summary["cardinality"] - 10000) < 500,
+                        "Cardinality estimate too far off: " + str(summary["cardinality"]))
+
+    def test_numeric_cardinality_estimate(self):
+        """
+        Numeric cardinality is estimated from arrays once the exact limit is passed.
+        """
+        column_profile = PortalFiles.ColumnProfile("Intensity", PortalFiles.c_TYPE_NUMERIC,
+                                                   cardinality_limit=100)
+        for block in range(4):
+            column_profile.add_numbers(PortalFiles.np.arange(block * 2500, 10000) / 7.0)
+        column_profile.add_numbers(PortalFiles.np.array([float("nan")]))
+        summary = column_profile.to_dict()
+        self.assertTrue(summary["cardinality_is_estimate"])
+        self.assertEqual(summary["nan"], 1)
+        self.assertEqual(summary["max"], 9999 / 7.0)
+        self.assertTrue(abs(summary["cardinality"] - 10000) < 500,
+                        "Cardinality estimate too far off: " + str(summary["cardinality"]))
+
+class CompactCellNamesTester(unittest.TestCase):
+    """
+    Tests cell names held as 64 bit codes.
+    """
+
+    def test_round_trip(self):
+        """
+        Barcodes and other names come back in order.
+        """
+        cell_names = ["AAACCTGAGAAGGCCT-1", "TTTGTCATCTTGCATT-12", "A", "ACGT",
+                      "AAACCTGAGAAGGCCT", "CELL_0001", "acgt-1", "ACGT-01"]
+        compact_names = PortalFiles.CompactCellNames(cell_names)
+        self.assertEqual(cell_names, list(compact_names))
+        self.assertEqual(len(cell_names), len(compact_names))
+        self.assertEqual(["CELL_0001", "acgt-1", "ACGT-01"], compact_names.fallback_names)
+        self.assertTrue("TTTGTCATCTTGCATT-12" in compact_names)
+        self.assertTrue("CELL_0001" in compact_names)
+        self.assertTrue("TTTGTCATCTTGCATT-2" not in compact_names)
+        self.assertTrue("CELL_0002" not in compact_names)
+
+    def test_duplicates_and_difference(self):
+        """
+        Duplicates and differences match those of the exact names.
+        """
+        cell_names = ["AAAC-1", "AAAC-2", "CELL_1", "AAAC-1", "CELL_1", "GGGG"]
+        other_names = ["AAAC-2", "CELL_2", "GGGG", "TTTT-1"]
+        compact_names = PortalFiles.CompactCellNames(cell_names)
+        compact_other_names = PortalFiles.CompactCellNames(other_names)
+        self.assertEqual(set(["AAAC-1", "CELL_1"]), compact_names.duplicates())
+        self.assertEqual(set(cell_names) - set(other_names),
+                         compact_names - compact_other_names)
+        self.assertEqual(set(other_names) - set(cell_names),
+                         compact_other_names - cell_names)
+
+class CellNameSketchTester(unittest.TestCase):
+    """
+    Tests cell names summarized by Bloom filters.
+    """
+
+    def test_differences(self):
+        """
+        Differences and duplicates match those of the exact names.
+        """
+        cell_names = ["CELL_" + str(index) for index in range(25000)]
+        other_names = cell_names[:20000] + ["OTHER_1", "CELL_5"] + cell_names[20001:]
+        sketch = PortalFiles.CellNameSketch.from_names(cell_names)
+        other_sketch = PortalFiles.CellNameSketch.from_names(other_names)
+        self.assertEqual(len(cell_names), len(sketch))
+        self.assertEqual(cell_names, list(sketch))
+        self.assertEqual(set(), sketch.duplicates())
+        self.assertEqual(set(["CELL_5"]), other_sketch.duplicates())
+        self.assertEqual((set(["CELL_20000"]), set(["OTHER_1"])),
+                         sketch.differences(other_sketch))
+        reordered_sketch = PortalFiles.CellNameSketch.from_names(list(reversed(cell_names)))
+        self.assertEqual(sketch.digest, reordered_sketch.digest)
+        self.assertEqual((set(), set()), sketch.differences(reordered_sketch))
+
+    def test_differences_with_false_positives(self):
+        """
+        Differences hidden by a full filter are found exactly.
+        """
+        cell_names = ["CELL_" + str(index) for index in range(2000)]
+        sketch = PortalFiles.CellNameSketch(lambda: iter(cell_names), bloom_bits=64)
+        other_sketch = PortalFiles.CellNameSketch(lambda: iter(cell_names[1:] + ["OTHER_1"]), bloom_bits=64)
+        self.assertEqual(1.0, sketch.false_positive_rate())
+        self.assertEqual((set(["CELL_0"]), set(["OTHER_1"])),
+                         sketch.differences(other_sketch))
+
+    def test_differences_checks_only_candidates(self):
+        """
+        Only the names of buckets that differ are compared exactly,
+        and names only repeated are not differences.
+        """
+        cell_names = ["CELL_" + str(index) for index in range(2000)]
+        sketch = PortalFiles.CellNameSketch(lambda: iter(cell_names), bloom_bits=64)
+        other_sketch = PortalFiles.CellNameSketch(lambda: iter(cell_names[1:] + ["OTHER_1"]), bloom_bits=64)
+        repeated_sketch = PortalFiles.CellNameSketch(lambda: iter(cell_names + ["CELL_5"]), bloom_bits=64)
+        candidate_names = sketch.names_in_buckets(sketch.differing_buckets(other_sketch))
+        self.assertIn("CELL_0", candidate_names)
+        self.assertLess(len(candidate_names), 10)
+        self.assertEqual((set(), set()), sketch.differences(repeated_sketch))
+
 class GeneListFileTester(unittest.TestCase):
     """
     Tests the Gene list file object.
@@ -1320,6 +2195,232 @@ class GeneListFileTester(unittest.TestCase):
         self.assertTrue(truth_str == received_str,
                         "Did not receive the expected labels.")
 
+class MergeExpressionFilesTester(unittest.TestCase):
+    """
+    Tests merging expression files.
+    """
+
+    def test_merge_sorted_files(self):
+        """
+        Merge files sorted by gene, filling missing genes with zeros.
+        """
+        correct_file = os.path.join("test_files", "expression_merged_correct.txt")
+        expression_files = [PortalFiles.ExpressionFile(os.path.join("test_files", file_name))
+                            for file_name in ["expression_merge_sorted_1.txt",
+                                              "expression_merge_sorted_2.txt"]]
+        merged_file_name = PortalFiles.merge_expression_files(expression_files)
+        # Test files
+        pass_test = files_are_equivalent(file_path_1=merged_file_name,
+                                         file_path_2=correct_file)
+        with open(merged_file_name, "rb") as merged_handle:
+            merged_bytes = merged_handle.read()
+        # Remove the test files
+        if(os.path.exists(merged_file_name)):
+            os.remove(merged_file_name)
+        self.assertTrue(pass_test, "Can not merge sorted files.")
+        # Rows end the way the merged files end theirs
+        self.assertNotIn(b"\r", merged_bytes)
+        with open(correct_file, "rb") as correct_handle:
+            self.assertEqual(merged_bytes, correct_handle.read())
+
+    def test_merge_unsorted_files(self):
+        """
+        Merge files through the gene index when a file is not sorted by gene.
+        """
+        correct_file = os.path.join("test_files", "expression_merged_correct.txt")
+        expression_files = [PortalFiles.ExpressionFile(os.path.join("test_files", file_name))
+                            for file_name in ["expression_merge_sorted_1.txt",
+                                              "expression_merge_unsorted.txt"]]
+        merged_file_name = PortalFiles.merge_expression_files(expression_files)
+        # Test files
+        pass_test = files_are_equivalent(file_path_1=merged_file_name,
+                                         file_path_2=correct_file)
+        # Remove the test files
+        if(os.path.exists(merged_file_name)):
+            os.remove(merged_file_name)
+        self.assertTrue(pass_test, "Can not merge unsorted files.")
+
+    def test_merge_unsorted_gzipped_files(self):
+        """
+        Merge gzipped unsorted files, gzipping the merged file by its name.
+        """
+        correct_file = os.path.join("test_files", "expression_merged_correct.txt")
+        gzip_file_name = os.path.join("test_files", "expression_merge_unsorted_test.txt.gz")
+        merged_file_name = os.path.join("test_files", "expression_merged_test.txt.gz")
+        with open(os.path.join("test_files", "expression_merge_unsorted.txt"), "rb") as test_handle, \
+                gzip.open(gzip_file_name, "wb") as gzip_handle:
+            gzip_handle.write(test_handle.read())
+        expression_files = [PortalFiles.ExpressionFile(os.path.join("test_files", "expression_merge_sorted_1.txt")),
+                            PortalFiles.ExpressionFile(gzip_file_name)]
+        try:
+            merged_file_name = PortalFiles.merge_expression_files(expression_files, merged_file_name)
+            with gzip.open(merged_file_name, "rt") as merged_handle:
+                merged_lines = merged_handle.read().splitlines()
+        finally:
+            # Remove the test files
+            for test_output in [gzip_file_name, merged_file_name]:
+                if(os.path.exists(test_output)):
+                    os.remove(test_output)
+        with open(correct_file) as correct_handle:
+            correct_lines = correct_handle.read().splitlines()
+        self.assertEqual(merged_lines, correct_lines)
+
+    def test_merge_cell_name_collision(self):
+        """
+        Files sharing cell names should not be merged.
+        """
+        test_file_name = os.path.join("test_files", "expression.txt")
+        expression_files = [PortalFiles.ExpressionFile(test_file_name),
+                            PortalFiles.ExpressionFile(test_file_name)]
+        merged_file_name = PortalFiles.merge_expression_files(expression_files)
+        self.assertTrue(merged_file_name is None,
+                        "Should not have merged files with the same cells.")
+
+def write_bgzf(file_path, contents, block_size=100):
+    """
+    Write contents in BGZF blocks of the given uncompressed size,
+    ending with the empty BGZF end of file block.
+    """
+    with open(file_path, "wb") as bgzf_file:
+        for block_start in list(range(0, len(contents), block_size)) + [len(contents)]:
+            block_data = contents[block_start:block_start + block_size]
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+            compressed = compressor.compress(block_data) + compressor.flush()
+            bgzf_file.write(struct.pack("<4BIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6,
+                                        66, 67, 2, len(compressed) + 25))
+            bgzf_file.write(compressed)
+            bgzf_file.write(struct.pack("<II", zlib.crc32(block_data) & 0xffffffff,
+                                        len(block_data)))
+
+class QuickCheckTester(unittest.TestCase):
+
+    def test_quick_check_byte_seek(self):
+        """
+        Test sampling rows of an uncompressed file by byte seeks.
+        """
+        test_file = PortalFiles.ExpressionFile(os.path.join("test_files", "expression.txt"),
+                                               lazy=True)
+        quick_check = test_file.quick_check(sample_size=100, seed=1)
+        self.assertEqual(quick_check["method"], PortalFiles.c_QUICK_BYTES)
+        self.assertTrue(0 < quick_check["sampled_rows"] <= 19)
+        self.assertEqual(quick_check["error_rows"], 0)
+        self.assertFalse(test_file.file_has_error)
+
+    def test_quick_check_errors(self):
+        """
+        Test rows with errors are counted in the sample.
+        """
+        test_file = PortalFiles.ExpressionFile(os.path.join("test_files", "expression_bad_body_1.txt"),
+                                               lazy=True)
+        quick_check = test_file.quick_check(sample_size=1000, seed=1)
+        self.assertTrue(quick_check["error_rows"] > 0)
+        self.assertTrue(test_file.file_has_error)
+        low_bound, high_bound = quick_check["error_rate_bounds"]
+        self.assertTrue(low_bound <= quick_check["error_rate"] <= high_bound)
+
+    def test_sample_rows_bgzf(self):
+        """
+        Test sampling rows of a BGZF file by block seeks.
+        """
+        test_file_name = os.path.join("test_files", "expression.txt")
+        bgzf_file_name = os.path.join("test_files", "expression_quick_test.txt.gz")
+        with open(test_file_name, "rb") as test_handle:
+            contents = test_handle.read()
+        write_bgzf(bgzf_file_name, contents)
+        test_file = PortalFiles.ExpressionFile(bgzf_file_name, lazy=True)
+        sampling_method, sample = test_file.sample_rows(sample_size=100, seed=1)
+        # Remove the test files
+        if(os.path.exists(bgzf_file_name)):
+            os.remove(bgzf_file_name)
+        body_rows = [line.split("\t") for line in contents.decode("utf-8").splitlines()[1:]]
+        self.assertEqual(sampling_method, PortalFiles.c_QUICK_BGZF)
+        self.assertTrue(sample)
+        for row_location, file_line in sample:
+            self.assertIn(file_line, body_rows)
+
+    def test_sample_rows_gzip(self):
+        """
+        Test gzipped files that can not be seeked give their first rows.
+        """
+        test_file_name = os.path.join("test_files", "expression.txt")
+        gzip_file_name = os.path.join("test_files", "expression_quick_test.txt.gz")
+        with open(test_file_name, "rb") as test_handle, gzip.open(gzip_file_name, "wb") as gzip_handle:
+            gzip_handle.write(test_handle.read())
+        test_file = PortalFiles.ExpressionFile(gzip_file_name, lazy=True)
+        sampling_method, sample = test_file.sample_rows(sample_size=3)
+        # Remove the test files
+        if(os.path.exists(gzip_file_name)):
+            os.remove(gzip_file_name)
+        self.assertEqual(sampling_method, PortalFiles.c_QUICK_FIRST_ROWS)
+        self.assertEqual([row_location for row_location, file_line in sample],
+                         ["line 2", "line 3", "line 4"])
+
+    def test_wilson_interval(self):
+        """
+        Test the confidence bounds of error rates.
+        """
+        self.assertEqual(PortalFiles.wilson_interval(0, 10)[0], 0.0)
+        self.assertAlmostEqual(PortalFiles.wilson_interval(0, 10)[1], 0.2775, places=4)
+        low_bound, high_bound = PortalFiles.wilson_interval(5, 10)
+        self.assertAlmostEqual(low_bound + high_bound, 1.0)
+        self.assertEqual(PortalFiles.wilson_interval(0, 0), [None, None])
+
+class ParallelGzipWriterTester(unittest.TestCase):
+
+    def test_write_members(self):
+        """
+        Test blocks compressed on threads read back as one gzip stream.
+        """
+        gzip_file_name = os.path.join("test_files", "parallel_gzip_test.txt.gz")
+        lines = ["\t".join(["GENE_" + str(line), str(line * 7)]) + "\n"
+                 for line in range(2000)]
+        with PortalFiles.ParallelGzipWriter(gzip_file_name, compress_level=1,
+                                            threads=3, block_size=1000) as gzip_writer:
+            gzip_writer.writelines(lines)
+        with gzip.open(gzip_file_name, "rt") as gzip_handle:
+            written = gzip_handle.read()
+        # Remove the test files
+        if(os.path.exists(gzip_file_name)):
+            os.remove(gzip_file_name)
+        self.assertEqual(written, "".join(lines))
+        self.assertTrue(gzip_writer.members > 1)
+
+    def test_write_empty(self):
+        """
+        Test an empty file is still a gzip file.
+        """
+        gzip_file_name = os.path.join("test_files", "parallel_gzip_test.txt.gz")
+        with PortalFiles.ParallelGzipWriter(gzip_file_name):
+            pass
+        with gzip.open(gzip_file_name, "rb") as gzip_handle:
+            written = gzip_handle.read()
+        # Remove the test files
+        if(os.path.exists(gzip_file_name)):
+            os.remove(gzip_file_name)
+        self.assertEqual(written, b"")
+
+    def test_subset_cells_gzipped(self):
+        """
+        Test subsets of gzipped files are written gzipped.
+        """
+        test_file_name = os.path.join("test_files", "metadata.txt")
+        gzip_file_name = os.path.join("test_files", "metadata_gzip_test.txt.gz")
+        correct_file = os.path.join("test_files",
+                                    "metadata_subset_1_correct.txt")
+        with open(test_file_name, "rb") as test_handle, gzip.open(gzip_file_name, "wb") as gzip_handle:
+            gzip_handle.write(test_handle.read())
+        test_file = PortalFiles.MetadataFile(gzip_file_name)
+        subset_file_name = test_file.subset_cells(["CELL_0001"])
+        with gzip.open(subset_file_name, "rt") as subset_handle:
+            subset_lines = subset_handle.read().splitlines()
+        with open(correct_file) as correct_handle:
+            correct_lines = correct_handle.read().splitlines()
+        # Remove the test files
+        for test_output in [gzip_file_name, subset_file_name]:
+            if(os.path.exists(test_output)):
+                os.remove(test_output)
+        self.assertEqual(subset_lines, correct_lines)
+
 class SortSparseMatrixTester(unittest.TestCase):
     """
     Tests the Sparse Matrix Sorting function.
@@ -1341,5 +2442,11 @@ def suite():
     tests.addTests(loader.loadTestsFromTestCase(ExpressionFileTester))
     tests.addTests(loader.loadTestsFromTestCase(MetadataFileTester))
     tests.addTests(loader.loadTestsFromTestCase(GeneListFileTester))
+    tests.addTests(loader.loadTestsFromTestCase(MergeExpressionFilesTester))
+    tests.addTests(loader.loadTestsFromTestCase(ColumnProfileTester))
+    tests.addTests(loader.loadTestsFromTestCase(CompactCellNamesTester))
+    tests.addTests(loader.loadTestsFromTestCase(CellNameSketchTester))
+    tests.addTests(loader.loadTestsFromTestCase(QuickCheckTester))
+    tests.addTests(loader.loadTestsFromTestCase(ParallelGzipWriterTester))
     tests.addTests(loader.loadTestsFromTestCase(SortSparseMatrixTester))
     return(tests)
@@ -351,6 +351,11 @@ def create_parser():
         help="Validates against standard vocabularies prior to upload",
         action="store_true",
     )
+    parser_upload_metadata.add_argument(
+        "--validate-locally",
+        help="Validates against the metadata convention with the local compiled checks (allowed values, ontology id formats, types and required columns) instead of the ingest pipeline",
+        action="store_true",
+    )
     parser_upload_metadata.add_argument(
         "--study-name",
         required=True,
@@ -87,11 +87,13 @@ from ingest.validation.validate_metadata import (
 try:
     # Used when importing internally and in tests
     import Commandline
+    import PortalFiles
     import scp_api
     from cli_parser import *
 except ImportError:
     # Used when importing as external package
     from . import Commandline
+    from . import PortalFiles
     from . import scp_api
     from .cli_parser import *
 
@@ -190,7 +192,32 @@ def download_from_bucket(file_path):
     return destination
 
 
+def validate_metadata_file_locally(parsed_args, connection):
+    """Validates a metadata file against the latest metadata convention
+    with the compiled convention checks of PortalFiles, in one pass over
+    the file and without the ingest pipeline. Compiled conventions are
+    cached on disk by the hash of the convention.
+    """
+    convention_res = connection.do_get(
+        command=get_api_base(parsed_args)
+        + "metadata_schemas/alexandria_convention/latest/json",
+        dry_run=parsed_args.dry_run,
+    )
+    if not succeeded(convention_res):
+        return False
+    convention_schema = PortalFiles.load_convention_schema(
+        convention_res["response"].json()
+    )
+    if parsed_args.verbose:
+        print(f"Compiled metadata convention {convention_schema.version}")
+    metadata = PortalFiles.MetadataFile(parsed_args.metadata_file)
+    metadata.check_convention(convention_schema)
+    return not metadata.file_has_error
+
+
 def validate_metadata_file(parsed_args, connection):
+    if getattr(parsed_args, "validate_locally", False):
+        return validate_metadata_file_locally(parsed_args, connection)
     metadata_path = parsed_args.metadata_file
     study_name = parsed_args.study_name
     dry_run = parsed_args.dry_run
@@ -4,6 +4,7 @@ import sys
 import pytest
 import json
 import requests
+import tempfile
 from ingest.cell_metadata import CellMetadata
 from ingest.validation.validate_metadata import (
     report_issues,
@@ -116,6 +117,36 @@ class ManageStudyTestCase(unittest.TestCase):
             "Conventional metadata file should pass validation",
         )
 
+    @patch("manage_study.succeeded", return_value=True)
+    @patch("manage_study.get_api_base", side_effect=mock_get_api_base)
+    def test_validate_metadata_file_locally(
+        self,
+        mock_get_api_base,
+        mock_succeeded,
+    ):
+        """Local compiled convention checks agree with the ingest pipeline
+        """
+        with tempfile.TemporaryDirectory() as cache_dir, patch(
+            "manage_study.PortalFiles.c_CONVENTION_CACHE_DIR", cache_dir
+        ):
+            for metadata_path, conforms in [
+                ("tests/data/valid_array_v2.1.2.txt", True),
+                ("tests/data/invalid_array_v1.1.3.tsv", False),
+            ]:
+                parsed_args = self.set_up_manage_study(
+                    "upload-metadata",
+                    "--study-name",
+                    "CLI test",
+                    "--file",
+                    metadata_path,
+                    "--use-convention",
+                    "--validate-locally",
+                )
+                self.assertEqual(
+                    validate_metadata_file(parsed_args, mock_get_connection()),
+                    conforms,
+                )
+
 
 if __name__ == "__main__":
     unittest.main()
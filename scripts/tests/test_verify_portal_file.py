@@ -0,0 +1,236 @@
+"""Unit tests for verify_portal_file.py
+
+To run, set up scripts per README, then:
+
+cd scripts
+python3 tests/test_verify_portal_file.py
+
+"""
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import sys
+sys.path.append('.')
+
+import PortalFiles
+from verify_portal_file import *
+
+class VerifyPortalFileTestCase(unittest.TestCase):
+
+    def test_check_files_concurrently(self):
+        """Files checked in a process pool match files checked one by one
+        """
+        file_tasks = [
+            (check_coordinates_file, 'test_files/coordinates.txt'),
+            (check_coordinates_file, 'test_files/coordinates_duplicates.txt'),
+            (check_metadata_file, 'test_files/metadata.txt'),
+            (check_expression_file, 'test_files/expression.txt'),
+            (check_gene_list_file, 'test_files/gene_list.txt'),
+        ]
+        args = ['--jobs', '1']
+        sequential_files = check_files_concurrently(file_tasks, prsr_arguments.parse_args(args))
+        args = ['--jobs', '3']
+        concurrent_files = check_files_concurrently(file_tasks, prsr_arguments.parse_args(args))
+
+        self.assertEqual(
+            [(portal_file.file_name, portal_file.header, list(portal_file.cell_names))
+             for portal_file in sequential_files],
+            [(portal_file.file_name, portal_file.header, list(portal_file.cell_names))
+             for portal_file in concurrent_files]
+        )
+        self.assertEqual(
+            [portal_file.file_has_error for portal_file in concurrent_files],
+            [False, True, False, False, False]
+        )
+        self.assertIsInstance(concurrent_files[2], PortalFiles.MetadataFile)
+
+    def test_run_file_task_compression_settings(self):
+        """Gzip settings of a file check do not carry over to the next check
+        """
+        compress_settings = (PortalFiles.ParentPortalFile.compress_level,
+                             PortalFiles.ParentPortalFile.compress_threads)
+        args = prsr_arguments.parse_args(['--gzip-level', '1', '--gzip-threads', '2'])
+        run_file_task((check_coordinates_file, 'test_files/coordinates.txt'), args)
+        self.assertEqual((PortalFiles.ParentPortalFile.compress_level,
+                          PortalFiles.ParentPortalFile.compress_threads), compress_settings)
+
+    def test_validation_cache(self):
+        """Unchanged files are restored from the validation cache, not checked again
+        """
+        cache_dir = tempfile.mkdtemp()
+        args = prsr_arguments.parse_args(['--validation-cache', cache_dir])
+        try:
+            checked_file = check_expression_file('test_files/expression.txt', args)
+            cache_files = os.listdir(cache_dir)
+            cached_file = check_expression_file('test_files/expression.txt', args)
+            bad_file = check_coordinates_file('test_files/coordinates_duplicates.txt', args)
+            cached_bad_file = check_coordinates_file('test_files/coordinates_duplicates.txt', args)
+        finally:
+            shutil.rmtree(cache_dir)
+
+        self.assertEqual(len(cache_files), 1)
+        # The cached file was not read, only restored
+        self.assertEqual(cached_file.line_number, 1)
+        self.assertEqual(list(cached_file.cell_names), list(checked_file.cell_names))
+        self.assertEqual(cached_file.get_gene_names(), checked_file.get_gene_names())
+        self.assertEqual(cached_file.value_profile["dtype"], checked_file.value_profile["dtype"])
+        self.assertTrue(bad_file.file_has_error)
+        self.assertTrue(cached_bad_file.file_has_error)
+        self.assertEqual(cached_bad_file.line_number, 1)
+
+    def test_validation_cache_duplicates(self):
+        """Duplicate genes and rows found by a check are restored from the validation cache
+        """
+        cache_dir = tempfile.mkdtemp()
+        args = prsr_arguments.parse_args(['--validation-cache', cache_dir, '--check-duplicate-rows'])
+        try:
+            checked_file = check_expression_file('test_files/expression_duplicates.txt', args)
+            cached_file = check_expression_file('test_files/expression_duplicates.txt', args)
+        finally:
+            shutil.rmtree(cache_dir)
+
+        self.assertEqual(cached_file.line_number, 1)
+        self.assertTrue(checked_file.get_duplicate_report()['rows'])
+        self.assertEqual(cached_file.get_duplicate_report(), checked_file.get_duplicate_report())
+
+    def test_get_file_report(self):
+        """File reports hold the errors, counts and stage timings of each check
+        """
+        file_tasks = [
+            (check_coordinates_file, 'test_files/coordinates_duplicates.txt'),
+            (check_expression_file, 'test_files/expression.txt'),
+        ]
+        check_outputs = []
+        portal_files = check_files_concurrently(file_tasks, prsr_arguments.parse_args(['--jobs', '1']),
+                                                check_outputs)
+        file_reports = [get_file_report(portal_file, check_output)
+                        for portal_file, check_output in zip(portal_files, check_outputs)]
+
+        self.assertTrue(file_reports[0]['file_has_error'])
+        self.assertTrue(file_reports[0]['errors'])
+        self.assertEqual(file_reports[1]['errors'], [])
+        self.assertEqual((file_reports[1]['cells'], file_reports[1]['genes']), (15, 19))
+        self.assertEqual([stage['stage'] for stage in file_reports[1]['stages']],
+                         ['header_check', 'body_check', 'duplicate_check'])
+        self.assertEqual(file_reports[1]['stages'][0]['rows'], 1)
+        self.assertEqual(file_reports[0]['stages'][0]['rows'], 2)
+        self.assertEqual(file_reports[1]['stages'][1]['rows'], 19)
+        self.assertEqual(file_reports[1]['stages'][1]['bytes_read'],
+                         os.path.getsize('test_files/expression.txt'))
+
+    def test_verify_study(self):
+        """Studies can be verified without starting a new interpreter
+        """
+        self.assertEqual(verify_study(['--cluster-file', 'test_files/coordinates.txt',
+                                       '--metadata-file', 'test_files/metadata.txt']), 0)
+        self.assertEqual(verify_study(['--merge-expression-files', 'merged.txt']), 54)
+
+    def test_verify_study_compression_settings(self):
+        """Gzip settings of a study do not carry over to the next study
+        """
+        compress_settings = (PortalFiles.ParentPortalFile.compress_level,
+                             PortalFiles.ParentPortalFile.compress_threads)
+        self.assertEqual(verify_study(['--cluster-file', 'test_files/coordinates.txt',
+                                       '--gzip-level', '1', '--gzip-threads', '2']), 0)
+        self.assertEqual((PortalFiles.ParentPortalFile.compress_level,
+                          PortalFiles.ParentPortalFile.compress_threads), compress_settings)
+
+    def test_verify_manifest(self):
+        """Studies listed in a manifest are verified in order in one shared pool
+        """
+        manifest_handle, manifest_file = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(manifest_handle, 'w') as manifest:
+            manifest.write('\n'.join([
+                '# study, then a study missing its expression files',
+                '--cluster-file test_files/coordinates.txt --metadata-file test_files/metadata.txt',
+                '',
+                '--merge-expression-files merged.txt',
+                '--unknown-argument',
+            ]))
+        try:
+            exit_codes = verify_manifest(manifest_file, jobs=2)
+        finally:
+            os.remove(manifest_file)
+
+        self.assertEqual(exit_codes, [0, 54, 2])
+
+    def test_verify_manifest_study_error(self):
+        """A study failing with an unexpected error does not stop the studies after it
+        """
+        manifest_handle, manifest_file = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(manifest_handle, 'w') as manifest:
+            manifest.write('\n'.join([
+                '--cluster-file test_files/no_such_file.txt',
+                '--cluster-file test_files/coordinates.txt --metadata-file test_files/metadata.txt',
+            ]))
+        manifest_output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(manifest_output):
+                exit_codes = verify_manifest(manifest_file, jobs=2)
+        finally:
+            os.remove(manifest_file)
+
+        self.assertEqual(exit_codes, [59, 0])
+        self.assertIn('Error!\tStudy 1 could not be verified.', manifest_output.getvalue())
+        self.assertIn('FileNotFoundError', manifest_output.getvalue())
+
+    def test_get_stream_conflicts(self):
+        """Files read from stdin can not be used by options reading files again
+        """
+        args = ['--expression-files', '-', '--metadata-file', 'test_files/metadata.txt']
+        self.assertEqual(get_stream_conflicts(prsr_arguments.parse_args(args)), [])
+        conflicts = get_stream_conflicts(prsr_arguments.parse_args(args + ['--deid-cells',
+                                                                          '--cluster-file', '-']))
+        self.assertEqual(len(conflicts), 2)
+        self.assertEqual(verify_study(args + ['--write-sidecars']), 56)
+
+    def test_precheck_cell_names(self):
+        """Cell names are compared before checking the files, stopping if asked when they differ
+        """
+        args = ['--cluster-file', 'test_files/coordinates.txt',
+                '--expression-files', 'test_files/expression.txt']
+        stage_timings = []
+        self.assertFalse(precheck_cell_names(prsr_arguments.parse_args(args), stage_timings))
+        self.assertEqual([stage['stage'] for stage in stage_timings], ['cell_names_precheck'])
+        self.assertEqual(stage_timings[0]['rows'], 30)
+        self.assertGreater(stage_timings[0]['bytes_read'], os.path.getsize('test_files/coordinates.txt'))
+        self.assertIsNone(precheck_cell_names(prsr_arguments.parse_args(args[:2]), []))
+        args += ['--metadata-file', 'test_files/metadata_duplicates.txt']
+        self.assertTrue(precheck_cell_names(prsr_arguments.parse_args(args), []))
+        self.assertEqual(verify_study(args + ['--stop-on-cell-names']), 57)
+
+    def test_cell_names_checked_after_precheck(self):
+        """Cell names are compared again after the files are checked, even if the precheck found no difference
+        """
+        args = ['--cluster-file', 'test_files/coordinates.txt',
+                '--metadata-file', 'test_files/metadata_duplicates.txt']
+        study_output = io.StringIO()
+        # The files as read by the precheck matched
+        with patch('verify_portal_file.precheck_cell_names', return_value=False) as precheck, \
+             contextlib.redirect_stdout(study_output):
+            exit_code = verify_study(args + ['--stop-on-cell-names'])
+        self.assertEqual(exit_code, 0)
+        self.assertTrue(precheck.called)
+        self.assertIn('Error!\tExpected the same number of cells', study_output.getvalue())
+
+    def test_precheck_cell_names_by_default(self):
+        """Cell names are compared before checking the files unless turned off
+        """
+        args = ['--cluster-file', 'test_files/coordinates.txt',
+                '--metadata-file', 'test_files/metadata.txt']
+        with patch('verify_portal_file.precheck_cell_names', return_value=False) as precheck:
+            self.assertEqual(verify_study(args), 0)
+        self.assertTrue(precheck.called)
+        with patch('verify_portal_file.precheck_cell_names', return_value=False) as precheck:
+            self.assertEqual(verify_study(args + ['--no-precheck-cell-names']), 0)
+        self.assertFalse(precheck.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
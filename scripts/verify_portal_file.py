@@ -7,8 +7,16 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import concurrent.futures
+import contextlib
 import csv
+import io
+import json
 import os
+import shlex
+import sys
+import time
+import traceback
 import PortalFiles
 
 
@@ -17,19 +25,68 @@ def check_cell_names(expression_files=None,
                      metadata_file=None):
     """
     Check files among themselves.
+    Returns whether the cell names of any files differ.
     """
+    compare_error = False
     if metadata_file:
         if coordinates_file_group:
             for coordinates_file in coordinates_file_group:
-                metadata_file.compare_cell_names(coordinates_file)
+                compare_error = metadata_file.compare_cell_names(coordinates_file) or compare_error
         if expression_files:
             for exp_file in expression_files:
-                metadata_file.compare_cell_names(exp_file)
+                compare_error = metadata_file.compare_cell_names(exp_file) or compare_error
     if coordinates_file_group:
         if expression_files:
             for coordinates_file in coordinates_file_group:
                 for exp_file in expression_files:
-                    coordinates_file.compare_cell_names(exp_file)
+                    compare_error = coordinates_file.compare_cell_names(exp_file) or compare_error
+    return(compare_error)
+
+def precheck_cell_names(prs_args, stage_timings):
+    """
+    Check cell names among files before the files are checked, reading
+    only the header of expression files and the first column of metadata
+    and cluster files, timed as a stage. Returns whether the cell names of
+    any files differ, or None if there are not files to compare or one is
+    read from stdin.
+    """
+    coordinates_file_names = prs_args.coordinates_file_group or []
+    expression_file_names = prs_args.expression_file or []
+    file_groups = [coordinates_file_names, prs_args.metadata_file, expression_file_names]
+    if sum(1 for file_group in file_groups if file_group) < 2:
+        return(None)
+    if PortalFiles.c_STREAM_FILE_NAME in coordinates_file_names + [prs_args.metadata_file] + expression_file_names:
+        return(None)
+    print("Checking cell names among files before checking the files.")
+    metadata_file = None
+    if prs_args.metadata_file:
+        metadata_file = PortalFiles.MetadataFile(prs_args.metadata_file,
+                                                 file_delimiter=prs_args.file_delimiter,
+                                                 cell_names_mode=prs_args.cell_names_mode,
+                                                 lazy=True)
+    expression_files = [PortalFiles.ExpressionFile(expression_file,
+                                                   file_delimiter=prs_args.file_delimiter,
+                                                   cell_names_mode=prs_args.cell_names_mode,
+                                                   lazy=True)
+                        for expression_file in expression_file_names]
+    coordinates_files = [PortalFiles.CoordinatesFile(coordinates_file,
+                                                     file_delimiter=prs_args.file_delimiter,
+                                                     cell_names_mode=prs_args.cell_names_mode,
+                                                     lazy=True)
+                         for coordinates_file in coordinates_file_names]
+    with PortalFiles.timed_stage(stage_timings, "cell_names_precheck") as stage_timing:
+        compare_error = check_cell_names(expression_files=expression_files,
+                                         coordinates_file_group=coordinates_files,
+                                         metadata_file=metadata_file)
+        prechecked_files = [portal_file for portal_file in expression_files + coordinates_files + [metadata_file]
+                            if portal_file]
+        stage_timing["rows"] = sum(len(portal_file.cell_names) for portal_file in prechecked_files)
+        # Expression files are read for their header, the other files for their first column
+        stage_timing["bytes_read"] = sum(len(portal_file.delimiter.join(portal_file.header)) + 1
+                                         if isinstance(portal_file, PortalFiles.ExpressionFile)
+                                         else os.path.getsize(portal_file.file_name)
+                                         for portal_file in prechecked_files)
+    return(compare_error)
 
 def check_gene_names(expression_files=None,
                      gene_files=None):
@@ -47,6 +104,306 @@ def check_gene_names(expression_files=None,
                                     exp_file.file_name]))
                     gene_list.compare_gene_names(exp_file)
 
+def get_validation_options(portal_file, prs_args):
+    """
+    Options changing what checking a file finds, to key cached checks by.
+    """
+    convention = None
+    if prs_args.convention_file and isinstance(portal_file, PortalFiles.MetadataFile):
+        convention = PortalFiles.file_content_hash(prs_args.convention_file)
+    return({"file_type": type(portal_file).__name__,
+            "delimiter": prs_args.file_delimiter,
+            "cell_names_mode": prs_args.cell_names_mode,
+            "check_duplicate_rows": prs_args.check_duplicate_rows,
+            "profile_sparsity": profile_sparsity(prs_args),
+            "convention": convention})
+
+def profile_sparsity(prs_args):
+    """
+    Whether the sparsity of expression files is profiled while checking,
+    for the JSON report or to convert them to their recommended format.
+    """
+    return(bool(prs_args.report_json or prs_args.convert_expression))
+
+def open_lazily(file_name, prs_args):
+    """
+    Whether a portal file is not read when made, because its check may
+    be restored from the validation cache or it is read once from stdin.
+    """
+    return(bool(prs_args.validation_cache) or file_name == PortalFiles.c_STREAM_FILE_NAME)
+
+def get_check(portal_file):
+    """
+    The check of a portal file, reading the file from stdin if it is named -.
+    """
+    if portal_file.is_stream():
+        return(lambda: portal_file.check_stream(sys.stdin.buffer))
+    return(portal_file.check)
+
+def get_stream_conflicts(prs_args):
+    """
+    Returns why the files can not be checked as asked when one is read
+    from stdin, which can only be read once, or an empty list.
+    """
+    stream_name = PortalFiles.c_STREAM_FILE_NAME
+    stream_files = [file_name for file_name in ((prs_args.coordinates_file_group or []) +
+                                                [prs_args.metadata_file] +
+                                                (prs_args.expression_file or []))
+                    if file_name == stream_name]
+    if not stream_files and stream_name not in (prs_args.gene_list_group or []):
+        return([])
+    conflicts = []
+    if stream_name in (prs_args.gene_list_group or []):
+        conflicts.append("gene lists can not be read from stdin")
+    if len(stream_files) > 1:
+        conflicts.append("only one file can be read from stdin")
+    rereading_options = [("--subsample", prs_args.subsample or prs_args.subsample_list),
+                         ("--deid-cells", prs_args.do_deidentify_cell),
+                         ("--index-clusters", prs_args.index_clusters),
+                         ("--export-binary-clusters", prs_args.export_binary_clusters),
+                         ("--downsample-clusters", prs_args.downsample_clusters),
+                         ("--convention-file", prs_args.convention_file),
+                         ("--write-sidecars", prs_args.write_sidecars),
+                         ("--deduplicate-expression", prs_args.deduplicate_expression),
+                         ("--convert-expression", prs_args.convert_expression),
+                         ("--cache-expression", prs_args.cache_expression),
+                         ("--merge-expression-files", prs_args.merged_expression_file),
+                         ("--add-gene-keyword", prs_args.add_expression_header_keyword),
+                         ("--peek", prs_args.peek),
+                         ("--quick", prs_args.quick),
+                         ("--no-checking", not prs_args.check_files)]
+    conflicts.extend([option + " reads files again so can not be used with stdin"
+                      for option, is_used in rereading_options if is_used])
+    return(conflicts)
+
+def check_with_cache(portal_file, check_steps, prs_args):
+    """
+    Run the check steps of a portal file. With a validation cache, a file
+    with the same contents checked before with the same options is not
+    checked again, instead what the check found is restored and what it
+    printed is printed again. Returns the portal file.
+    """
+    if not prs_args.validation_cache or prs_args.deduplicate_expression or portal_file.is_stream():
+        check_steps()
+        return(portal_file)
+    validation_cache = PortalFiles.ValidationCache(prs_args.validation_cache)
+    content_hash = PortalFiles.file_content_hash(portal_file.file_name)
+    options = get_validation_options(portal_file, prs_args)
+    report = validation_cache.get(content_hash, options)
+    if report:
+        print("Using the cached check of the unchanged file " + portal_file.file_name)
+        print(report.output, end="")
+        return(report.restore(portal_file))
+    check_output = io.StringIO()
+    with contextlib.redirect_stdout(check_output):
+        check_steps()
+    print(check_output.getvalue(), end="")
+    validation_cache.put(PortalFiles.ValidationReport.from_portal_file(portal_file,
+                                                                        content_hash,
+                                                                        check_output.getvalue()),
+                         options)
+    return(portal_file)
+
+def check_coordinates_file(coordinates_file, prs_args):
+    """
+    Check a coordinates file, returning its portal file.
+    """
+    coordinates_portal_file = PortalFiles.CoordinatesFile(coordinates_file,
+                                          file_delimiter=prs_args.file_delimiter,
+                                          expected_header=PortalFiles.c_COORDINATES_HEADER,
+                                          cell_names_mode=prs_args.cell_names_mode,
+                                          lazy=open_lazily(coordinates_file, prs_args))
+    if prs_args.check_files:
+        check_with_cache(coordinates_portal_file, get_check(coordinates_portal_file), prs_args)
+        if prs_args.write_sidecars:
+            coordinates_portal_file.save_summary()
+    return(coordinates_portal_file)
+
+def check_metadata_file(metadata_file, prs_args):
+    """
+    Check a metadata file, returning its portal file.
+    """
+    metadata_portal_file = PortalFiles.MetadataFile(metadata_file,
+                                      file_delimiter=prs_args.file_delimiter,
+                                      cell_names_mode=prs_args.cell_names_mode,
+                                      lazy=open_lazily(metadata_file, prs_args))
+
+    def check_steps():
+        get_check(metadata_portal_file)()
+        if prs_args.convention_file:
+            # The schema file is only read when its compiled convention is not cached
+            content_hash = PortalFiles.file_content_hash(prs_args.convention_file)
+            convention_schema = PortalFiles.load_convention_schema(content_hash=content_hash)
+            if convention_schema is None:
+                with open(prs_args.convention_file) as convention_handle:
+                    convention_schema = PortalFiles.load_convention_schema(json.load(convention_handle),
+                                                                           content_hash=content_hash)
+            metadata_portal_file.check_convention(convention_schema)
+
+    if prs_args.check_files:
+        check_with_cache(metadata_portal_file, check_steps, prs_args)
+        if prs_args.write_sidecars:
+            metadata_portal_file.save_profile()
+    return(metadata_portal_file)
+
+def check_expression_file(expression_file, prs_args):
+    """
+    Check an expression file, returning its portal file.
+    """
+    expression_portal_file = PortalFiles.ExpressionFile(expression_file,
+                                        file_delimiter=prs_args.file_delimiter,
+                                        cell_names_mode=prs_args.cell_names_mode,
+                                        check_duplicate_rows=prs_args.check_duplicate_rows or prs_args.deduplicate_expression,
+                                        profile_sparsity=profile_sparsity(prs_args),
+                                        lazy=open_lazily(expression_file, prs_args))
+    if prs_args.check_files:
+        check_with_cache(expression_portal_file, get_check(expression_portal_file), prs_args)
+        if prs_args.deduplicate_expression and expression_portal_file.duplicate_rows:
+            deduplicated_file = expression_portal_file.write_deduplicated()
+            if deduplicated_file:
+                print("Wrote deduplicated expression file " + deduplicated_file)
+    if prs_args.write_sidecars:
+        expression_portal_file.save_gene_names()
+        expression_portal_file.save_value_profile()
+    if prs_args.convert_expression and not expression_portal_file.file_has_error:
+        converted_files = expression_portal_file.write_recommended_format()
+        if converted_files:
+            print("Wrote expression matrix in its recommended format to " + ", ".join(converted_files))
+    if prs_args.cache_expression and not expression_portal_file.file_has_error:
+        print("Wrote expression matrix cache " + expression_portal_file.save_matrix_cache())
+    return(expression_portal_file)
+
+def check_gene_list_file(gene_list, prs_args):
+    """
+    Check a gene list file, returning its portal file.
+    """
+    gene_list_file = PortalFiles.GeneListFile(gene_list,
+                                              file_delimiter=prs_args.file_delimiter,
+                                              lazy=open_lazily(gene_list, prs_args))
+    if prs_args.check_files:
+        check_with_cache(gene_list_file, gene_list_file.check, prs_args)
+    return(gene_list_file)
+
+class TeeOutput(io.StringIO):
+    """
+    Keeps what is printed while still printing it to the given stream.
+    """
+
+    def __init__(self, stream):
+        io.StringIO.__init__(self)
+        self.stream = stream
+
+    def write(self, text):
+        self.stream.write(text)
+        return(io.StringIO.write(self, text))
+
+def get_errors(check_output):
+    """
+    Error lines printed by a check.
+    """
+    return([line for line in check_output.splitlines()
+            if line.upper().startswith("ERROR!")])
+
+def get_file_report(portal_file, check_output=""):
+    """
+    Structured results of checking a portal file for the JSON report.
+    """
+    cells = None
+    genes = None
+    if isinstance(portal_file, PortalFiles.GeneListFile):
+        genes = len(portal_file.get_gene_names())
+    else:
+        cells = len(portal_file.cell_names)
+        if getattr(portal_file, "gene_names", None) is not None:
+            genes = len(portal_file.gene_names)
+    return({"file_name": portal_file.file_name,
+            "file_type": type(portal_file).__name__,
+            "file_has_error": portal_file.file_has_error,
+            "errors": get_errors(check_output),
+            "cells": cells,
+            "genes": genes,
+            "stages": portal_file.stage_timings})
+
+def transform_file(portal_file, keep_cells, cell_names_change, stage_timings):
+    """
+    Subsample and / or deidentify the cells of a portal file, timed as a
+    stage. Returns the checked new portal file, or None, and what
+    transforming the file printed.
+    """
+    stage = "_".join(([] if keep_cells is None else ["subsample"]) +
+                     ([] if cell_names_change is None else ["deidentify"]))
+    transform_output = TeeOutput(sys.stdout)
+    with PortalFiles.timed_stage(stage_timings, stage) as stage_timing, \
+         contextlib.redirect_stdout(transform_output):
+        stage_timing["file_name"] = portal_file.file_name
+        # Both are made in the one pass over the file so are timed together
+        stage_timing["subsample"] = keep_cells is not None
+        stage_timing["deidentify"] = cell_names_change is not None
+        stage_timing["bytes_read"] = os.path.getsize(portal_file.file_name)
+        transformed_file = portal_file.transform_cells(keep_cells, cell_names_change)
+        if transformed_file:
+            stage_timing["rows"] = transformed_file.line_number - 1
+    return(transformed_file, transform_output.getvalue())
+
+def set_compression(compress_level, compress_threads):
+    """
+    Set how gzipped files written by portal files are compressed.
+    Returns the previous level and threads so they can be restored.
+    """
+    previous_settings = (PortalFiles.ParentPortalFile.compress_level,
+                         PortalFiles.ParentPortalFile.compress_threads)
+    PortalFiles.ParentPortalFile.compress_level = compress_level
+    PortalFiles.ParentPortalFile.compress_threads = compress_threads
+    return(previous_settings)
+
+def run_file_task(file_task, prs_args):
+    """
+    Run a file check, returning the portal file and what the check printed.
+    """
+    check_function, file_name = file_task
+    # Workers of a shared pool may have started before the study was set up
+    previous_settings = set_compression(prs_args.gzip_level, prs_args.gzip_threads)
+    check_output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(check_output):
+            portal_file = check_function(file_name, prs_args)
+    finally:
+        set_compression(*previous_settings)
+    return(portal_file, check_output.getvalue())
+
+def check_files_concurrently(file_tasks, prs_args, check_outputs=None, executor=None):
+    """
+    Run file checks in a pool of processes sized by the number of files
+    and CPU cores, unless the number of jobs is given. Returns the portal
+    files in the order of the tasks, printing the output of each check
+    in that order so it reads as if the files were checked one by one.
+    If a list is given for check outputs, what each check printed is
+    added to it. If a process pool executor is given it is used instead,
+    so checks of many studies can share one pool.
+    """
+    if check_outputs is None:
+        check_outputs = []
+    jobs = prs_args.jobs or min(len(file_tasks), os.cpu_count() or 1)
+    portal_files = []
+    # Stdin can only be read by this process
+    is_streamed = any(file_name == PortalFiles.c_STREAM_FILE_NAME for check_function, file_name in file_tasks)
+    if is_streamed or (executor is None and (jobs <= 1 or len(file_tasks) <= 1)):
+        for check_function, file_name in file_tasks:
+            check_output = TeeOutput(sys.stdout)
+            with contextlib.redirect_stdout(check_output):
+                portal_files.append(check_function(file_name, prs_args))
+            check_outputs.append(check_output.getvalue())
+        return(portal_files)
+    with contextlib.ExitStack() as pool_stack:
+        if executor is None:
+            executor = pool_stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=jobs))
+        for portal_file, check_output in executor.map(run_file_task, file_tasks,
+                                                      [prs_args] * len(file_tasks)):
+            print(check_output, end="")
+            portal_files.append(portal_file)
+            check_outputs.append(check_output)
+    return(portal_files)
+
 prsr_arguments = argparse.ArgumentParser(
     prog="verify_portal_file.py",
     description="Verify files for the single cell portal",
@@ -84,6 +441,17 @@ prsr_arguments.add_argument("--deid-cells",
                                           "random name, keeping cell names ",
                                           "consistent between files"]))
 
+prsr_arguments.add_argument("--cell-names",
+                            default=PortalFiles.c_CELL_NAMES_EXACT,
+                            dest="cell_names_mode",
+                            choices=PortalFiles.c_CELL_NAMES_MODES,
+                            help="".join(["How cell names are held when comparing ",
+                                          "files. Compact packs barcode cell names ",
+                                          "into 64 bit codes to save memory on ",
+                                          "studies with millions of cells. Bloom keeps ",
+                                          "a fixed size Bloom filter per file and only ",
+                                          "checks candidate mismatches exactly."]))
+
 prsr_arguments.add_argument("--gene-list",
                             default=None,
                             dest="gene_list_group",
@@ -99,6 +467,12 @@ prsr_arguments.add_argument("--metadata-file",
                             help="".join(["The file that holds the ",
                                           "metadata_file data."]))
 
+prsr_arguments.add_argument("--convention-file",
+                            default=None,
+                            dest="convention_file",
+                            type=str,
+                            help="The metadata convention JSON schema to check the metadata file against.")
+
 prsr_arguments.add_argument("--subsample",
                             default=None,
                             dest="subsample",
@@ -117,6 +491,114 @@ prsr_arguments.add_argument("--subsample-cells-list",
                             type=str,
                             help="A list of cell names to keep when subsampling. Allows one to specifically indicate which cells to subsample to. This take precident over random sampling; if this is specified no random sampling can occur.")
 
+prsr_arguments.add_argument("--downsample-clusters",
+                            default=None,
+                            dest="downsample_clusters",
+                            type=int,
+                            help="Writes a density preserving subset of each cluster file with about this many points, along with a list of the kept cells.")
+
+prsr_arguments.add_argument("--export-binary-clusters",
+                            default=False,
+                            dest="export_binary_clusters",
+                            action="store_true",
+                            help="Writes a packed binary copy of each cluster file (float32 coordinates, group label codes and cell names) for fast plotting.")
+
+prsr_arguments.add_argument("--index-clusters",
+                            default=False,
+                            dest="index_clusters",
+                            action="store_true",
+                            help="Builds and saves a spatial index next to each cluster file for region queries, including the metadata file rows if a metadata file is given.")
+
+prsr_arguments.add_argument("--check-duplicate-rows",
+                            default=False,
+                            dest="check_duplicate_rows",
+                            action="store_true",
+                            help="Fingerprints each expression row while checking to find rows identical to an earlier row, along with duplicate genes.")
+
+prsr_arguments.add_argument("--deduplicate-expression",
+                            default=False,
+                            dest="deduplicate_expression",
+                            action="store_true",
+                            help="Writes a copy of each checked expression matrix without the rows identical to an earlier row. Implies --check-duplicate-rows.")
+
+prsr_arguments.add_argument("--cache-expression",
+                            default=False,
+                            dest="cache_expression",
+                            action="store_true",
+                            help="Saves each valid expression matrix next to it as a NumPy cache, stored as uint16 or uint32 when the file holds integer counts.")
+
+prsr_arguments.add_argument("--convert-expression",
+                            default=False,
+                            dest="convert_expression",
+                            action="store_true",
+                            help="Writes each valid expression matrix in the format with the smallest projected size (dense text, gzipped dense text or gzipped MTX) if it is not already in that format.")
+
+prsr_arguments.add_argument("--peek",
+                            default=False,
+                            dest="peek",
+                            action="store_true",
+                            help="Only reads the first few KB of each file and prints its size, compression, column count and first rows, to triage many files before validating them. Then exits.")
+
+prsr_arguments.add_argument("--quick",
+                            default=None,
+                            dest="quick",
+                            nargs="?",
+                            const=PortalFiles.c_QUICK_SAMPLE_SIZE,
+                            type=int,
+                            help="Checks the headers fully but only a random sample of rows (by default 1000) of each file, read through seeks into uncompressed or BGZF files, and prints the estimated rate of rows with errors with its 95%% confidence bounds. Then exits. Full checking stays the default.")
+
+prsr_arguments.add_argument("--jobs",
+                            default=None,
+                            dest="jobs",
+                            type=int,
+                            help="Number of files to check at the same time, each in its own process. Defaults to the number of files, up to the number of CPU cores.")
+
+prsr_arguments.add_argument("--validation-cache",
+                            default=None,
+                            dest="validation_cache",
+                            nargs="?",
+                            const=PortalFiles.c_VALIDATION_CACHE_DIR,
+                            type=str,
+                            help="Keeps what checking each file found in a local cache (by default in ~/.scp_validation), keyed by the file contents, the validator version and the check options. Unchanged files are not checked again, only the checks among files are rerun.")
+
+prsr_arguments.add_argument("--manifest",
+                            default=None,
+                            dest="manifest",
+                            type=str,
+                            help="Checks many studies in one process sharing one pool of --jobs workers. Each line of the manifest file holds the command line arguments of one study; blank lines and lines starting with # are skipped. Studies that fail with an unexpected error exit with 59 without stopping the others. Exits with the first nonzero exit code of the studies.")
+
+prsr_arguments.add_argument("--report-json",
+                            default=None,
+                            dest="report_json",
+                            type=str,
+                            help="Writes the results to the given JSON file: per file the errors, cell and gene counts, and for each stage (header, body and duplicate checks, checks among files, subsampling and deidentifying) the wall and CPU time, bytes read and rows per second.")
+
+prsr_arguments.add_argument("--gzip-level",
+                            default=PortalFiles.c_GZIP_LEVEL,
+                            dest="gzip_level",
+                            type=int,
+                            choices=range(1, 10),
+                            metavar="{1-9}",
+                            help="Compression level of gzipped files written, lower is faster.")
+
+prsr_arguments.add_argument("--gzip-threads",
+                            default=None,
+                            dest="gzip_threads",
+                            type=int,
+                            help="Number of threads compressing each gzipped file written, in blocks written as gzip members. Defaults to the number of CPU cores.")
+
+prsr_arguments.add_argument("--no-precheck-cell-names",
+                            default=True,
+                            dest="precheck_cell_names",
+                            action="store_false",
+                            help="Does not compare the cell names of the files before checking the files. By default they are compared first, from the headers of expression files and the first column of metadata and cluster files, so mismatched files are reported before the bodies of the files are checked. Cell names are still compared after the files are checked.")
+
+prsr_arguments.add_argument("--stop-on-cell-names",
+                            default=False,
+                            dest="stop_on_cell_names",
+                            action="store_true",
+                            help="Exits before checking the bodies of the files if the cell names of the files differ. Cell names are then compared first even with --no-precheck-cell-names.")
+
 prsr_arguments.add_argument("--no-checking",
                             default=True,
                             dest="check_files",
@@ -129,170 +611,326 @@ prsr_arguments.add_argument("--add-gene-keyword",
                             action="store_true",
                             help="Adds the keyword in the 0,0 element of expression matrices to a copy of the expression matrices and then exists.")
 
-prs_args = prsr_arguments.parse_args()
-
-
-# Holds the file objects a opposed to the file names
-coordinates_files = []
-metadata_portal_file = None
-expression_portal_files = []
-gene_list_files = []
-
-if prs_args.coordinates_file_group:
-    for coordinates_file in prs_args.coordinates_file_group:
-        coordinates_portal_file = PortalFiles.CoordinatesFile(coordinates_file,
-                                              file_delimiter=prs_args.file_delimiter,
-                                              expected_header=PortalFiles.c_COORDINATES_HEADER)
-        if prs_args.check_files:
-            coordinates_portal_file.check()
-        coordinates_files.append(coordinates_portal_file)
-
-if prs_args.metadata_file:
-    metadata_portal_file = PortalFiles.MetadataFile(prs_args.metadata_file,
-                                      file_delimiter=prs_args.file_delimiter)
-    if prs_args.check_files:
-        metadata_portal_file.check()
-
-if prs_args.expression_file:
-    for expression_file in prs_args.expression_file:
-        expression_portal_file = PortalFiles.ExpressionFile(expression_file,
-                                            file_delimiter=prs_args.file_delimiter)
+prsr_arguments.add_argument("--merge-expression-files",
+                            default=None,
+                            dest="merged_expression_file",
+                            type=str,
+                            help="Merges the expression matrices by cell columns, joining rows on gene name, into the given file and then exits.")
 
-        if prs_args.add_expression_header_keyword:
-            expression_portal_file.add_expression_header_keyword()
-        else:
-            if prs_args.check_files:
-                expression_portal_file.check()
-            expression_portal_files.append(expression_portal_file)
-    if prs_args.add_expression_header_keyword:
-        exit(0)
+prsr_arguments.add_argument("--write-sidecars",
+                            default=False,
+                            dest="write_sidecars",
+                            action="store_true",
+                            help="Saves summaries made while checking files (cluster summaries, metadata column profiles, expression gene names and value profiles) next to the files so they do not need to be read again.")
 
-if prs_args.gene_list_group:
-    for gene_list in prs_args.gene_list_group:
-        gene_list_file = PortalFiles.GeneListFile(gene_list,
-                                                  file_delimiter=prs_args.file_delimiter)
-        if prs_args.check_files:
-            gene_list_file.check()
-        gene_list_files.append(gene_list_file)
-
-if prs_args.check_files:
-    check_cell_names(expression_files=expression_portal_files,
-                     coordinates_file_group=coordinates_files,
-                     metadata_file=metadata_portal_file)
-
-    check_gene_names(expression_files=expression_portal_files,
-                     gene_files=gene_list_files)
-
-# Subsample based on metadatum
-if not prs_args.subsample is None or not prs_args.subsample_metadata is None or not prs_args.subsample_list is None:
-    if (prs_args.subsample is None or prs_args.subsample_metadata is None) and prs_args.subsample_list is None:
-        print("".join(["In order to subsample please provide both an amount",
-                       "to subsample and a metadata to use in subsampling"]))
+def verify_study(study_args=None, executor=None):
+    """
+    Check the files of a study and subsample, deidentify, index, export
+    or downsample them as asked. Study arguments are the command line
+    arguments of the study, as a list or as parsed. Files are checked in
+    the given process pool executor if any, so studies can share one.
+    Returns the exit code the command line would exit with.
+    """
+    if isinstance(study_args, argparse.Namespace):
+        prs_args = study_args
     else:
-        print("Starting subsampling.")
-        sampled_expression_files = []
-        sampled_coordinates_files = []
-
-        print("Sampling cells.")
-        sampled_cells = []
-        if not prs_args.subsample_list is None:
-            with open(prs_args.subsample_list,'r') as gene_name_reader:
-                for line in csv.reader(gene_name_reader,delimiter=prs_args.file_delimiter):
-                    sampled_cells.extend(line)
-        else:
-            sampled_cells = metadata_portal_file.select_subsample_cells(prs_args.subsample,prs_args.subsample_metadata)
-            with open(metadata_portal_file.create_safe_file_name("sampled_cells.txt"),'wb') as write_sampled_cells:
-                csv.writer(write_sampled_cells).writerows([[cell] for cell in sampled_cells])
-        if len(sampled_cells) < 1:
-            print("No sampling occured.")
-        else:
-            print("Subsampling metadata file.")
-            if prs_args.metadata_file:
-                metadata_portal_file_name = metadata_portal_file.subset_cells(sampled_cells)
-                metadata_portal_file = PortalFiles.MetadataFile(metadata_portal_file_name,
-                                              file_delimiter=prs_args.file_delimiter)
-            for expression_file in expression_portal_files:
-                print("Subsampling expression matrix: "+expression_file.file_name)
-                sampled_expression_file = expression_file.subset_cells(sampled_cells)
-                expression_sample_file = PortalFiles.ExpressionFile(sampled_expression_file,
-                                                    file_delimiter=prs_args.file_delimiter)
-                sampled_expression_files.append(expression_sample_file)
-            for cluster in coordinates_files:
-                print("Subsampling cluster file: "+ cluster.file_name)
-                sampled_coordinate_file = cluster.subset_cells(sampled_cells)
-                coordinates_portal_file = PortalFiles.CoordinatesFile(sampled_coordinate_file,
+        prs_args = prsr_arguments.parse_args(study_args)
+    previous_settings = set_compression(prs_args.gzip_level, prs_args.gzip_threads)
+    try:
+        return(check_study(prs_args, executor))
+    finally:
+        set_compression(*previous_settings)
+
+def check_study(prs_args, executor=None):
+    """
+    Check the files of a study as parsed from its arguments, returning
+    the exit code the command line would exit with.
+    """
+    stream_conflicts = get_stream_conflicts(prs_args)
+    if stream_conflicts:
+        print("Error!\tCan not read a file from stdin: " + "; ".join(stream_conflicts) + ".")
+        return(56)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    if prs_args.peek or prs_args.quick:
+        if prs_args.quick and prs_args.gene_list_group:
+            print("Error!\tGene lists can not be quick checked, please check them without --quick.")
+            return(58)
+        # Lazy file objects do not read the files beyond what is peeked or sampled
+        triage_files = [PortalFiles.CoordinatesFile(coordinates_file,
+                                                    file_delimiter=prs_args.file_delimiter,
+                                                    lazy=True)
+                        for coordinates_file in prs_args.coordinates_file_group or []]
+        if prs_args.metadata_file:
+            triage_files.append(PortalFiles.MetadataFile(prs_args.metadata_file,
+                                                         file_delimiter=prs_args.file_delimiter,
+                                                         lazy=True))
+        triage_files.extend([PortalFiles.ExpressionFile(expression_file,
+                                                        file_delimiter=prs_args.file_delimiter,
+                                                        lazy=True)
+                             for expression_file in prs_args.expression_file or []])
+        triage_files.extend([PortalFiles.GeneListFile(gene_list,
                                                       file_delimiter=prs_args.file_delimiter,
-                                                      expected_header=PortalFiles.c_COORDINATES_HEADER)
-                sampled_coordinates_files.append(coordinates_portal_file)
-
-            expression_portal_files = sampled_expression_files
-            coordinates_files = sampled_coordinates_files
-            print("Subsampling complete without error.")
-
-# Deidentify all cell names (optionally) after all QC checks are made.
-if prs_args.do_deidentify_cell:
-    print("Deidentifying Cell Names/Ids")
-
-    deid_coordinates_files = []
-    deid_metadata_portal_file = None
-    deid_expression_portal_files = []
+                                                      lazy=True)
+                             for gene_list in prs_args.gene_list_group or []])
+        for triage_file in triage_files:
+            if prs_args.quick:
+                quick_check = triage_file.quick_check(prs_args.quick)
+                error_rate_bounds = quick_check["error_rate_bounds"]
+                print("\t".join([triage_file.file_name,
+                                 type(triage_file).__name__,
+                                 "header has errors" if triage_file.file_has_error and not quick_check["error_rows"] else "header checked",
+                                 " ".join([str(quick_check["error_rows"]), "of",
+                                           str(quick_check["sampled_rows"]), "rows sampled by",
+                                           quick_check["method"], "had errors"]),
+                                 "" if quick_check["error_rate"] is None else
+                                 "estimated error rate {:.2%} (95% bounds {:.2%} to {:.2%})".format(
+                                     quick_check["error_rate"], *error_rate_bounds)]))
+                continue
+            file_peek = triage_file.peek()
+            print("\t".join([file_peek["file_name"],
+                             type(triage_file).__name__,
+                             str(file_peek["size"]) + " bytes",
+                             "gzipped" if file_peek["gzipped"] else "text",
+                             ("header longer than the " + str(file_peek["peeked_size"]) + " bytes peeked"
+                              if file_peek["header_cut"] else str(file_peek["header_length"]) + " columns"),
+                             str(len(file_peek["rows"])) + (" rows" if file_peek["complete"] else " rows peeked")]))
+        return(0)
+
+    # Holds the file objects a opposed to the file names
+    coordinates_files = []
+    metadata_portal_file = None
+    expression_portal_files = []
+    gene_list_files = []
+
+    # Stages run among files and their errors
+    study_stages = []
+    study_output = TeeOutput(sys.stdout)
+
+    # Compare cell names first, from the cheap to read columns of the files
+    if ((prs_args.precheck_cell_names or prs_args.stop_on_cell_names) and prs_args.check_files and
+            not (prs_args.merged_expression_file or prs_args.add_expression_header_keyword)):
+        with contextlib.redirect_stdout(study_output):
+            cell_names_differ = precheck_cell_names(prs_args, study_stages)
+        if cell_names_differ and prs_args.stop_on_cell_names:
+            print("Error!\tThe cell names of the files differ, stopping before checking the files.")
+            return(57)
+
+    # Check each file in its own process, the files among themselves after
+    file_tasks = [(check_coordinates_file, coordinates_file)
+                  for coordinates_file in prs_args.coordinates_file_group or []]
+    if prs_args.metadata_file:
+        file_tasks.append((check_metadata_file, prs_args.metadata_file))
+    if not (prs_args.merged_expression_file or prs_args.add_expression_header_keyword):
+        file_tasks.extend([(check_expression_file, expression_file)
+                           for expression_file in prs_args.expression_file or []])
+        file_tasks.extend([(check_gene_list_file, gene_list)
+                           for gene_list in prs_args.gene_list_group or []])
+    check_outputs = []
+    checked_files = check_files_concurrently(file_tasks, prs_args, check_outputs, executor)
+    file_reports = [get_file_report(portal_file, check_output)
+                    for portal_file, check_output in zip(checked_files, check_outputs)]
+    transformed_reports = []
+    for portal_file in checked_files:
+        if isinstance(portal_file, PortalFiles.CoordinatesFile):
+            coordinates_files.append(portal_file)
+        elif isinstance(portal_file, PortalFiles.MetadataFile):
+            metadata_portal_file = portal_file
+        elif isinstance(portal_file, PortalFiles.ExpressionFile):
+            expression_portal_files.append(portal_file)
+        else:
+            gene_list_files.append(portal_file)
+
+    if prs_args.merged_expression_file:
+        if not prs_args.expression_file:
+            print("Please provide the expression files to merge.")
+            return(54)
+        merged_file = PortalFiles.merge_expression_files([PortalFiles.ExpressionFile(expression_file,
+                                                                                     file_delimiter=prs_args.file_delimiter)
+                                                          for expression_file in prs_args.expression_file],
+                                                         prs_args.merged_expression_file)
+        if not merged_file:
+            return(54)
+        print("Merged expression files into " + merged_file)
+        return(0)
 
-    # Holds the deidentified cell names if used
-    deid_names = {}
+    if prs_args.add_expression_header_keyword:
+        for expression_file in prs_args.expression_file or []:
+            PortalFiles.ExpressionFile(expression_file,
+                                       file_delimiter=prs_args.file_delimiter,
+                                       lazy=True).add_expression_header_keyword()
+        return(0)
 
-    if coordinates_files:
+    if prs_args.check_files:
+        with PortalFiles.timed_stage(study_stages, "cross_file_check") as stage_timing, \
+             contextlib.redirect_stdout(study_output):
+            # Compared again as checked, in case the files changed since the precheck
+            check_cell_names(expression_files=expression_portal_files,
+                             coordinates_file_group=coordinates_files,
+                             metadata_file=metadata_portal_file)
+
+            check_gene_names(expression_files=expression_portal_files,
+                             gene_files=gene_list_files)
+            stage_timing["rows"] = sum(file_report["cells"] or 0 for file_report in file_reports)
+
+    # Subsample based on metadatum
+    sampled_cells = None
+    if not prs_args.subsample is None or not prs_args.subsample_metadata is None or not prs_args.subsample_list is None:
+        if (prs_args.subsample is None or prs_args.subsample_metadata is None) and prs_args.subsample_list is None:
+            print("".join(["In order to subsample please provide both an amount",
+                           "to subsample and a metadata to use in subsampling"]))
+        else:
+            print("Sampling cells.")
+            sampled_cells = []
+            if not prs_args.subsample_list is None:
+                with open(prs_args.subsample_list,'r') as gene_name_reader:
+                    for line in csv.reader(gene_name_reader,delimiter=prs_args.file_delimiter):
+                        sampled_cells.extend(line)
+            else:
+                sampled_cells = metadata_portal_file.select_subsample_cells(prs_args.subsample,prs_args.subsample_metadata)
+                with open(metadata_portal_file.create_safe_file_name("sampled_cells.txt"),'w') as write_sampled_cells:
+                    csv.writer(write_sampled_cells).writerows([[cell] for cell in sampled_cells])
+            if len(sampled_cells) < 1:
+                print("No sampling occured.")
+                sampled_cells = None
+
+    # Subsample and deidentify (optionally) after all QC checks are made,
+    # writing and checking one new file per file in a single pass.
+    if sampled_cells is not None or prs_args.do_deidentify_cell:
+        if sampled_cells is not None:
+            print("Subsampling cells.")
+        if prs_args.do_deidentify_cell:
+            print("Deidentifying Cell Names/Ids")
+
+        # Holds the deidentified cell names if used
+        deid_names = {} if prs_args.do_deidentify_cell else None
+        source_files = coordinates_files + [metadata_portal_file] + expression_portal_files
+        source_files = [portal_file for portal_file in source_files if portal_file]
+
+        transformed_coordinates_files = []
         for coordinates_portal_file in coordinates_files:
-            deid_info = coordinates_portal_file.deidentify_cell_names(deid_names)
-            if not deid_info:
-                exit(51)
-            deid_file = deid_info["name"]
-            deid_names = deid_info["mapping"]
-            print(" ".join(["A version of the coordinates file with",
-                            "deidentifed cells names was named",
-                            str(deid_file)]))
-            print("Checking format of new file.")
-            # Reset to deidentified file
-            coordinates_portal_file = PortalFiles.CoordinatesFile(deid_file,
-                                                  file_delimiter=prs_args.file_delimiter,
-                                                  expected_header=PortalFiles.c_COORDINATES_HEADER)
-            coordinates_portal_file.check()
-            deid_coordinates_files.append(coordinates_portal_file)
-
-    if metadata_portal_file:
-        deid_info = metadata_portal_file.deidentify_cell_names(deid_names)
-        if not deid_info:
-            exit(52)
-        deid_file = deid_info["name"]
-        deid_names = deid_info["mapping"]
-        print(" ".join(["A version of the metadata file with",
-                        "deidentifed cells names was named",
-                        str(deid_file)]))
-        print("Checking format of new file.")
-        # Reset to deidentified file
-        deid_metadata_portal_file = PortalFiles.MetadataFile(deid_file,
-                                      file_delimiter=prs_args.file_delimiter)
-        metadata_portal_file.check()
-
-    if expression_portal_files:
+            coordinates_portal_file, transform_output = transform_file(coordinates_portal_file, sampled_cells,
+                                                   deid_names, study_stages)
+            if not coordinates_portal_file:
+                return(51)
+            print("A new version of the coordinates file was named " + coordinates_portal_file.file_name)
+            transformed_reports.append(get_file_report(coordinates_portal_file, transform_output))
+            transformed_coordinates_files.append(coordinates_portal_file)
+
+        if metadata_portal_file:
+            metadata_portal_file, transform_output = transform_file(metadata_portal_file, sampled_cells,
+                                                                    deid_names, study_stages)
+            if not metadata_portal_file:
+                return(52)
+            print("A new version of the metadata file was named " + metadata_portal_file.file_name)
+            transformed_reports.append(get_file_report(metadata_portal_file, transform_output))
+
+        transformed_expression_files = []
         for expression_portal_file in expression_portal_files:
-            deid_info = expression_portal_file.deidentify_cell_names(deid_names)
-            if not deid_info:
-                exit(53)
-            deid_file = deid_info["name"]
-            deid_names = deid_info["mapping"]
-            print(" ".join(["A version of the expression file with",
-                            "deidentifed cells names was named",
-                            str(deid_file)]))
-            print("Checking format of new file.")
-            # Reset to deidentified file
-            deid_expression_portal_file = PortalFiles.ExpressionFile(deid_file,
-                                            file_delimiter=prs_args.file_delimiter)
-            deid_expression_portal_file.check()
-            deid_expression_portal_files.append(deid_expression_portal_file)
-
-    if prs_args.check_files:
-        print("If multiple files are given, checking among files.")
-        check_cell_names(expression_files=deid_expression_portal_files,
-                         coordinates_file_group=deid_coordinates_files,
-                         metadata_file=deid_metadata_portal_file)
+            expression_portal_file, transform_output = transform_file(expression_portal_file, sampled_cells,
+                                                   deid_names, study_stages)
+            if not expression_portal_file:
+                return(53)
+            print("A new version of the expression file was named " + expression_portal_file.file_name)
+            transformed_reports.append(get_file_report(expression_portal_file, transform_output))
+            transformed_expression_files.append(expression_portal_file)
+
+        coordinates_files = transformed_coordinates_files
+        expression_portal_files = transformed_expression_files
+        if deid_names:
+            mapping_file = source_files[0].write_cell_names_mapping(deid_names)
+            print("The deidentifed cell names mapping was named " + str(mapping_file))
 
+        if prs_args.check_files:
+            print("If multiple files are given, checking among files.")
+            with PortalFiles.timed_stage(study_stages, "cross_file_check") as stage_timing, \
+                 contextlib.redirect_stdout(study_output):
+                check_cell_names(expression_files=expression_portal_files,
+                                 coordinates_file_group=coordinates_files,
+                                 metadata_file=metadata_portal_file)
+                stage_timing["rows"] = sum(file_report["cells"] or 0
+                                           for file_report in transformed_reports)
+
+    # Index cluster files for region queries
+    if prs_args.index_clusters:
+        for cluster in coordinates_files:
+            print("Saved spatial index: " + cluster.save_spatial_index(cluster.get_spatial_index(metadata_portal_file)))
+
+    # Export cluster files for plotting
+    if prs_args.export_binary_clusters:
+        for cluster in coordinates_files:
+            print("Exported cluster file to: " + cluster.export_binary())
+
+    # Downsample cluster files for plotting
+    if prs_args.downsample_clusters:
+        for cluster in coordinates_files:
+            print("Downsampling cluster file: " + cluster.file_name)
+            downsample_info = cluster.downsample(prs_args.downsample_clusters)
+            if not downsample_info:
+                return(55)
+            print(" ".join(["Kept", str(len(downsample_info["cells"])),
+                            "points in", downsample_info["name"],
+                            "listing the cells in", downsample_info["cells_file"]]))
+
+    if prs_args.report_json:
+        with open(prs_args.report_json, "w") as report_handle:
+            json.dump({"validator_version": PortalFiles.c_VALIDATOR_VERSION,
+                       "files": file_reports,
+                       "transformed_files": transformed_reports,
+                       "stages": study_stages,
+                       "errors": get_errors(study_output.getvalue()),
+                       "wall_seconds": time.perf_counter() - wall_start,
+                       "cpu_seconds": time.process_time() - cpu_start},
+                      report_handle, indent=2)
+        print("Wrote the JSON report to " + prs_args.report_json)
+    return(0)
+
+def verify_manifest(manifest_file, jobs=None):
+    """
+    Check the studies listed in a manifest, one line of command line
+    arguments per study, in one process sharing one pool of workers.
+    Blank lines and lines starting with # are skipped.
+    Returns the exit codes of the studies in order.
+    """
+    with open(manifest_file) as manifest_handle:
+        studies = [shlex.split(line) for line in manifest_handle
+                   if line.strip() and not line.lstrip().startswith("#")]
+    exit_codes = []
+    jobs = jobs or os.cpu_count() or 1
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    try:
+        for study_number, study_args in enumerate(studies, 1):
+            print("Verifying study " + str(study_number) + ": " + " ".join(study_args))
+            try:
+                exit_code = verify_study(study_args, executor)
+            except SystemExit as study_exit:
+                # Arguments the parser could not use
+                exit_code = study_exit.code
+            except Exception as study_error:
+                # One failing study should not stop the studies after it
+                print("Error!\tStudy " + str(study_number) + " could not be verified.")
+                print(traceback.format_exc(), end="")
+                exit_code = 59
+                if isinstance(study_error, concurrent.futures.process.BrokenProcessPool):
+                    executor.shutdown()
+                    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+            print("Study " + str(study_number) + " finished with exit code " + str(exit_code))
+            exit_codes.append(exit_code)
+    finally:
+        executor.shutdown()
+    return(exit_codes)
+
+def main():
+    """
+    Check the files given on the command line, or the studies
+    listed in the manifest given on the command line.
+    """
+    prs_args = prsr_arguments.parse_args()
+    if prs_args.manifest:
+        exit_codes = verify_manifest(prs_args.manifest, prs_args.jobs)
+        exit(next((exit_code for exit_code in exit_codes if exit_code), 0))
+    exit(verify_study(prs_args))
+
+if __name__ == "__main__":
+    main()